@@ -17,13 +17,42 @@
 # You should have received a copy of the GNU General Public License
 # along with Linaro Image Tools.  If not, see <http://www.gnu.org/licenses/>.
 
+import atexit
+import json
 import os
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+from StringIO import StringIO
+
+from linaro_image_tools.root_helper import (
+    read_message,
+    write_message,
+)
 
 
 DEFAULT_PATH = '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin'
 CHROOT_ARGS = ['chroot']
 SUDO_ARGS = ['sudo', '-E']
+PKEXEC_ARGS = ['pkexec']
+# The installed root helper, which the polkit policy allows to be run with
+# pkexec.
+ROOT_HELPER_PATH = '/usr/bin/linaro-root-helper'
+
+# The environment variables which enable tracing of all commands run, by
+# naming the file to write the trace to, and which select its format.
+TRACE_ENV = 'LINARO_IMAGE_TOOLS_TRACE'
+TRACE_FORMAT_ENV = 'LINARO_IMAGE_TOOLS_TRACE_FORMAT'
+TRACE_FORMATS = ['chrome', 'jsonl']
+
+# The RootHelper which runs the commands that must be run as root, if one
+# has been started with start_root_helper().
+_root_helper = None
+# The CommandTracer recording the commands we run, if tracing has been
+# started with start_tracing().
+_tracer = None
 
 
 def sanitize_path(env):
@@ -36,7 +65,7 @@ def sanitize_path(env):
 
 
 def run(args, as_root=False, chroot=None, stdin=None, stdout=None,
-        stderr=None, cwd=None):
+        stderr=None, cwd=None, interactive=False):
     """Run the given command as a sub process.
 
     Return a Popen instance.
@@ -50,6 +79,9 @@ def run(args, as_root=False, chroot=None, stdin=None, stdout=None,
     :param stdin: Same as in subprocess.Popen().
     :param stdout: Same as in subprocess.Popen().
     :param stderr: Same as in subprocess.Popen().
+    :param interactive: May the command prompt for input on the terminal?
+        Such commands are run with sudo even when there is a root helper,
+        which runs the commands it's given without a terminal.
     """
     assert isinstance(args, (list, tuple)), (
         "The command to run must be a list or tuple, found: %s" % type(args))
@@ -58,9 +90,20 @@ def run(args, as_root=False, chroot=None, stdin=None, stdout=None,
     if chroot is not None:
         args = CHROOT_ARGS + [chroot] + args
         as_root = True
-    if as_root and os.getuid() != 0:
-        args = SUDO_ARGS + args
-    return Popen(args, stdin=stdin, stdout=stdout, stderr=stderr, cwd=cwd)
+    if (as_root and not interactive and _root_helper is not None and
+            RootHelperPopen.can_run(stdin, stdout, stderr)):
+        proc = RootHelperPopen(
+            _root_helper, args, stdin=stdin, stdout=stdout, stderr=stderr,
+            cwd=cwd)
+    else:
+        if as_root and os.getuid() != 0:
+            args = SUDO_ARGS + args
+        proc = Popen(args, stdin=stdin, stdout=stdout, stderr=stderr,
+                     cwd=cwd)
+    trace = getattr(proc, '_trace', None)
+    if trace is not None:
+        trace.update(as_root=as_root, chroot=chroot)
+    return proc
 
 
 class Popen(subprocess.Popen):
@@ -80,12 +123,17 @@ class Popen(subprocess.Popen):
         sanitize_path(os.environ)
         # and for subcommands
         sanitize_path(env)
+        self._trace = None
+        if _tracer is not None:
+            self._trace = _tracer.start(args)
         super(Popen, self).__init__(args, env=env, **kwargs)
 
     def communicate(self, input=None):
         self.except_on_cmd_fail = False
         stdout, stderr = super(Popen, self).communicate(input)
         self.except_on_cmd_fail = True
+        if self._trace is not None:
+            _tracer.finish(self._trace, self.returncode, stdout, stderr)
 
         if self.returncode != 0:
             raise SubcommandNonZeroReturnValue(self._my_args,
@@ -96,6 +144,8 @@ class Popen(subprocess.Popen):
 
     def wait(self):
         returncode = super(Popen, self).wait()
+        if self._trace is not None:
+            _tracer.finish(self._trace, returncode)
         if returncode != 0 and self.except_on_cmd_fail:
             raise SubcommandNonZeroReturnValue(self._my_args, returncode)
         return returncode
@@ -119,3 +169,391 @@ class SubcommandNonZeroReturnValue(Exception):
             message += '\nstderr was\n{0}'.format(self.stderr)
 
         return message
+
+
+def start_tracing(path=None, trace_format=None):
+    """Record every command we run, to be written to a trace file at exit.
+
+    A summary of the time spent on each command is also printed at exit.
+
+    :param path: The trace file to write, or None to use the one named by
+        the TRACE_ENV environment variable; if neither is given tracing is
+        not started.
+    :param trace_format: Either 'chrome', for the Chrome trace event format
+        (which can be loaded in chrome://tracing), or 'jsonl', for one JSON
+        record per line. Defaults to TRACE_FORMAT_ENV if that's set, or to
+        'chrome' for paths ending in '.json' and 'jsonl' otherwise.
+    """
+    global _tracer
+    if path is None:
+        path = os.environ.get(TRACE_ENV)
+    if not path or _tracer is not None:
+        return
+    if trace_format is None:
+        trace_format = os.environ.get(TRACE_FORMAT_ENV)
+    if trace_format is None:
+        if path.endswith('.json'):
+            trace_format = 'chrome'
+        else:
+            trace_format = 'jsonl'
+    assert trace_format in TRACE_FORMATS, (
+        "Unknown trace format: %s" % trace_format)
+    _tracer = CommandTracer()
+    atexit.register(stop_tracing, path, trace_format)
+
+
+def stop_tracing(path, trace_format):
+    """Write the trace started by start_tracing() and print its summary."""
+    global _tracer
+    if _tracer is None:
+        return
+    tracer, _tracer = _tracer, None
+    with open(path, 'w') as fd:
+        tracer.write(fd, trace_format)
+    sys.stderr.write(tracer.summary())
+
+
+class CommandTracer(object):
+    """Record the commands we run, and how long they take.
+
+    Each command is recorded as a dict with its 'argv', 'as_root' and
+    'chroot', its 'start' and 'end' wall time, its 'returncode' and the
+    number of bytes of stdout and stderr we captured from it.
+    """
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def start(self, args):
+        record = {
+            'argv': list(args), 'as_root': False, 'chroot': None,
+            'start': time.time(), 'end': None, 'returncode': None,
+            'stdout_bytes': 0, 'stderr_bytes': 0}
+        with self._lock:
+            self.records.append(record)
+        return record
+
+    def finish(self, record, returncode, stdout=None, stderr=None):
+        if record['end'] is None:
+            record['end'] = time.time()
+            record['returncode'] = returncode
+        if stdout:
+            record['stdout_bytes'] = len(stdout)
+        if stderr:
+            record['stderr_bytes'] = len(stderr)
+
+    @staticmethod
+    def command_name(record):
+        """Return the name of the recorded command, without sudo/chroot."""
+        argv = record['argv']
+        if argv[:len(SUDO_ARGS)] == SUDO_ARGS:
+            argv = argv[len(SUDO_ARGS):]
+        if argv[:len(CHROOT_ARGS)] == CHROOT_ARGS:
+            argv = argv[len(CHROOT_ARGS) + 1:]
+        return os.path.basename(argv[0]) if argv else ''
+
+    def _finished_records(self):
+        with self._lock:
+            return [r for r in self.records if r['end'] is not None]
+
+    def write(self, fd, trace_format):
+        records = self._finished_records()
+        if trace_format == 'chrome':
+            events = []
+            for record in records:
+                events.append({
+                    'name': self.command_name(record), 'cat': 'command',
+                    'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+                    'ts': int(record['start'] * 1e6),
+                    'dur': int((record['end'] - record['start']) * 1e6),
+                    'args': record})
+            json.dump({'traceEvents': events}, fd)
+        else:
+            for record in records:
+                fd.write(json.dumps(record) + '\n')
+
+    def summary(self):
+        """Return a table of the number of runs and time of each command."""
+        totals = {}
+        for record in self._finished_records():
+            name = self.command_name(record)
+            runs, failures, total, longest = totals.get(name, (0, 0, 0, 0))
+            duration = record['end'] - record['start']
+            totals[name] = (
+                runs + 1, failures + (record['returncode'] != 0),
+                total + duration, max(longest, duration))
+        lines = ['%-24s %6s %8s %10s %10s' % (
+            'Command', 'Runs', 'Failed', 'Total (s)', 'Max (s)')]
+        for name, (runs, failures, total, longest) in sorted(
+                totals.items(), key=lambda item: item[1][2], reverse=True):
+            lines.append('%-24s %6d %8d %10.2f %10.2f' % (
+                name, runs, failures, total, longest))
+        return '\n'.join(lines) + '\n'
+
+
+def _find_executable(name):
+    for directory in os.environ.get('PATH', DEFAULT_PATH).split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def start_root_helper():
+    """Start a root helper to run all commands that must be run as root.
+
+    Once started, run() hands the commands with as_root=True over to the
+    helper, which only needs to be given root privileges once. We use sudo
+    for that, or pkexec with the polkit policy if sudo is not available.
+    The helper is stopped when the process exits.
+    """
+    global _root_helper
+    if _root_helper is not None:
+        return
+    args = [sys.executable, '-c',
+            'from linaro_image_tools.root_helper import main; main()']
+    if os.getuid() != 0:
+        if _find_executable(SUDO_ARGS[0]) is None and os.path.exists(
+                ROOT_HELPER_PATH):
+            args = PKEXEC_ARGS + [ROOT_HELPER_PATH]
+        else:
+            args = SUDO_ARGS + args
+    env = os.environ.copy()
+    # Make sure the helper imports the same linaro_image_tools as we do.
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        [package_dir] + [p for p in env.get('PYTHONPATH', '').split(
+            os.pathsep) if p])
+    _root_helper = RootHelper(args, env=env)
+    atexit.register(stop_root_helper)
+
+
+def stop_root_helper():
+    """Stop the root helper started by start_root_helper(), if any."""
+    global _root_helper
+    if _root_helper is not None:
+        _root_helper.close()
+        _root_helper = None
+
+
+def write_file(path, data, as_root=False):
+    """Write data to the file on the given path.
+
+    :param as_root: Should the file be written as root? Without a root
+        helper that means writing the data to a tempfile and moving it on top
+        of the given file with sudo.
+    """
+    if as_root and _root_helper is not None:
+        _root_helper.write_file(path, data)
+    elif as_root:
+        _, tmpfile = tempfile.mkstemp()
+        with open(tmpfile, 'w') as fd:
+            fd.write(data)
+        run(['mv', '-f', tmpfile, path], as_root=True).wait()
+    else:
+        with open(path, 'w') as fd:
+            fd.write(data)
+
+
+class RootHelper(object):
+    """The client side of the root helper.
+
+    Requests are sent to the helper as soon as they're made, and the replies,
+    which may come in any order, are read in a separate thread. So is the
+    output the commands stream to our stdout and stderr, which is written
+    there as it comes.
+    """
+
+    def __init__(self, args, env=None):
+        self._proc = subprocess.Popen(
+            args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env,
+            close_fds=True)
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._pending = {}
+        self._reader = threading.Thread(target=self._read_replies)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _read_replies(self):
+        while True:
+            reply = read_message(self._proc.stdout)
+            if reply is None:
+                break
+            if 'output' in reply:
+                stream = getattr(sys, reply['output'])
+                stream.write(reply['data'])
+                stream.flush()
+                continue
+            with self._lock:
+                done, replies = self._pending.pop(reply['id'])
+            replies.append(reply)
+            done.set()
+        # The helper is gone; fail whatever it didn't reply to.
+        with self._lock:
+            pending = self._pending.values()
+            self._pending = {}
+        for done, replies in pending:
+            replies.append(
+                {'returncode': -1, 'stdout': '',
+                 'stderr': 'The root helper exited unexpectedly\n'})
+            done.set()
+
+    def submit(self, request):
+        """Send the given request to the helper.
+
+        :return: A (threading.Event, list) tuple; the event is set once the
+            reply has been appended to the list.
+        """
+        ticket = (threading.Event(), [])
+        with self._lock:
+            request['id'] = self._next_id
+            self._next_id += 1
+            self._pending[request['id']] = ticket
+            write_message(self._proc.stdin, request)
+        return request['id'], ticket
+
+    def terminate(self, request_id):
+        with self._lock:
+            write_message(
+                self._proc.stdin, {'op': 'terminate', 'id': request_id})
+
+    def write_file(self, path, data):
+        _, (done, replies) = self.submit(
+            {'op': 'write-file', 'path': path, 'data': data})
+        done.wait()
+        reply = replies[0]
+        if reply['returncode'] != 0:
+            raise SubcommandNonZeroReturnValue(
+                ['write-file', path], reply['returncode'],
+                stderr=reply['stderr'])
+
+    def close(self):
+        self._proc.stdin.close()
+        self._proc.wait()
+        self._reader.join()
+
+
+class RootHelperPopen(object):
+    """A stand-in for Popen for commands run by the root helper.
+
+    Like Popen, it raises SubcommandNonZeroReturnValue once the command
+    completes with a non-zero returncode. The output of commands whose
+    stdout or stderr is not redirected is streamed to our own stdout or
+    stderr, and their stdin is /dev/null unless it's a pipe.
+    """
+
+    def __init__(self, helper, args, stdin=None, stdout=None, stderr=None,
+                 cwd=None):
+        self._helper = helper
+        self._my_args = args
+        self._stdout = stdout
+        self._stderr = stderr
+        self._input = None
+        self._reply = None
+        self._request_id = None
+        self.returncode = None
+        self._trace = None
+        if _tracer is not None:
+            self._trace = _tracer.start(args)
+        env = os.environ.copy()
+        env['LC_ALL'] = 'C'
+        sanitize_path(env)
+        self._request = {
+            'op': 'run', 'args': args, 'cwd': cwd, 'env': env,
+            'stdin': None, 'stdout': self._wiring(stdout),
+            'stderr': self._wiring(stderr)}
+        if stdin == subprocess.PIPE:
+            # The input is only known once communicate() is called.
+            self.stdin = StringIO()
+        else:
+            self.stdin = None
+            self._submit()
+
+    @staticmethod
+    def _is_devnull(f):
+        return getattr(f, 'name', None) == os.devnull
+
+    @classmethod
+    def can_run(cls, stdin, stdout, stderr):
+        """Can the root helper run a command with the given stdio?
+
+        It can't pass file descriptors on to the commands it runs, so only
+        pipes, /dev/null and our own stdio are supported.
+        """
+        def supported(f):
+            return f in (None, subprocess.PIPE) or cls._is_devnull(f)
+        return (supported(stdin) and supported(stdout) and
+                (stderr == subprocess.STDOUT or supported(stderr)))
+
+    def _wiring(self, f):
+        if f is None:
+            return 'stream'
+        elif f == subprocess.STDOUT:
+            return 'stdout'
+        elif self._is_devnull(f):
+            return 'devnull'
+        return 'capture'
+
+    def _submit(self):
+        self._request_id, self._ticket = self._helper.submit(self._request)
+
+    def _finish(self):
+        if self._request_id is None:
+            if self.stdin is not None:
+                self._request['stdin'] = self.stdin.getvalue()
+            self._submit()
+        if self._reply is None:
+            done, replies = self._ticket
+            done.wait()
+            self._reply = replies[0]
+            self.returncode = self._reply['returncode']
+            if self._trace is not None:
+                _tracer.finish(
+                    self._trace, self.returncode, self._reply['stdout'],
+                    self._reply['stderr'])
+            if self._stdout is None:
+                sys.stdout.write(self._reply['stdout'])
+            if self._stderr is None:
+                sys.stderr.write(self._reply['stderr'])
+        return self._reply
+
+    @property
+    def stdout(self):
+        if self._stdout != subprocess.PIPE:
+            return None
+        return StringIO(self._finish()['stdout'])
+
+    @property
+    def stderr(self):
+        if self._stderr != subprocess.PIPE:
+            return None
+        return StringIO(self._finish()['stderr'])
+
+    def communicate(self, input=None):
+        if input is not None:
+            self.stdin.write(input)
+        reply = self._finish()
+        stdout = reply['stdout'] if self._stdout == subprocess.PIPE else None
+        stderr = reply['stderr'] if self._stderr == subprocess.PIPE else None
+        if self.returncode != 0:
+            raise SubcommandNonZeroReturnValue(
+                self._my_args, self.returncode, stdout, stderr)
+        return stdout, stderr
+
+    def wait(self):
+        self._finish()
+        if self.returncode != 0:
+            raise SubcommandNonZeroReturnValue(
+                self._my_args, self.returncode)
+        return self.returncode
+
+    def poll(self):
+        if self._request_id is None or not self._ticket[0].is_set():
+            return None
+        return self._finish()['returncode']
+
+    def terminate(self):
+        if self._request_id is not None and self._reply is None:
+            self._helper.terminate(self._request_id)
@@ -0,0 +1,162 @@
+# Copyright (C) 2010, 2011, 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""A cache of the packages downloaded by PackageFetcher.
+
+The cache is a directory shared between builds, and between the
+architectures of a build, so that a package is only downloaded once. Each
+package is stored under its SHA-256 and file name, and is checked against
+the digests apt expects before being reused.
+
+The cache has an index recording the size of each package and when it was
+last used, which is locked while it's read or changed so that builds can
+share the cache. The least recently used packages are removed when the cache
+grows bigger than its maximum size.
+"""
+
+from contextlib import contextmanager
+import errno
+import fcntl
+import json
+import logging
+import os
+import shutil
+import time
+
+from linaro_image_tools.hwpack.digests import get_digests
+
+logger = logging.getLogger(__name__)
+
+INDEX_NAME = 'index.json'
+# The default maximum size of the cache, in MiB.
+DEFAULT_MAX_SIZE = 10 * 1024
+
+
+def link_or_copy(src, dest):
+    """Hard link src to dest, or copy it if they're on different filesystems.
+    """
+    try:
+        os.link(src, dest)
+    except OSError, e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy(src, dest)
+
+
+class ArchiveCache(object):
+    """A cache of downloaded packages, shared between builds."""
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE * 1024 * 1024):
+        """
+        :param directory: The directory of the cache, which is created if it
+            doesn't exist.
+        :param max_size: The size, in bytes, the cache is trimmed to.
+        """
+        self.directory = os.path.abspath(directory)
+        self.max_size = max_size
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.index_path = os.path.join(self.directory, INDEX_NAME)
+
+    @contextmanager
+    def _index(self):
+        """Lock the index and give it to the block, saving it afterwards."""
+        fd = os.open(self.index_path, os.O_RDWR | os.O_CREAT, 0644)
+        index_file = os.fdopen(fd, 'r+')
+        try:
+            fcntl.flock(index_file, fcntl.LOCK_EX)
+            content = index_file.read()
+            index = {'entries': {}}
+            if content:
+                index = json.loads(content)
+            yield index
+            index_file.seek(0)
+            index_file.truncate()
+            json.dump(index, index_file, indent=2, sort_keys=True)
+        finally:
+            index_file.close()
+
+    def _entry_name(self, filename, sha256):
+        return '%s_%s' % (sha256, filename)
+
+    def _entry_path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _remove(self, name):
+        try:
+            os.unlink(self._entry_path(name))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def fetch(self, filename, sha256, size, dest):
+        """Put the cached package with the given file name and SHA-256 at dest.
+
+        The package is hard linked to dest when possible, and copied
+        otherwise.
+
+        :param size: The size the package should have.
+        :return: Whether the package was in the cache, with the right size
+            and SHA-256.
+        """
+        name = self._entry_name(filename, sha256)
+        with self._index() as index:
+            entry = index['entries'].get(name)
+            if entry is None:
+                return False
+            path = self._entry_path(name)
+            if (not os.path.exists(path) or os.path.getsize(path) != size or
+                    get_digests(path, ('sha256',))['sha256'] != sha256):
+                logger.debug("Removing the corrupt cached package %s" % name)
+                self._remove(name)
+                del index['entries'][name]
+                return False
+            link_or_copy(path, dest)
+            entry['last_used'] = time.time()
+        return True
+
+    def store(self, path, filename, sha256):
+        """Store the package at path in the cache.
+
+        The least recently used packages are then removed until the cache is
+        no bigger than its maximum size.
+        """
+        name = self._entry_name(filename, sha256)
+        tmp_path = '%s.tmp-%d' % (self._entry_path(name), os.getpid())
+        link_or_copy(path, tmp_path)
+        try:
+            with self._index() as index:
+                os.rename(tmp_path, self._entry_path(name))
+                index['entries'][name] = {
+                    'size': os.path.getsize(path), 'last_used': time.time()}
+                self._evict(index)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def _evict(self, index):
+        """Remove the least recently used packages, until the cache fits."""
+        entries = index['entries']
+        total = sum(entry['size'] for entry in entries.values())
+        for name in sorted(entries, key=lambda k: entries[k]['last_used']):
+            if total <= self.max_size:
+                break
+            logger.debug("Removing the cached package %s" % name)
+            self._remove(name)
+            total -= entries.pop(name)['size']
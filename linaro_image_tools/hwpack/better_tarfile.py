@@ -21,7 +21,17 @@
 
 from contextlib import contextmanager
 from StringIO import StringIO
-from tarfile import DIRTYPE, TarFile as StandardTarFile, TarInfo
+from tarfile import (
+    BLOCKSIZE,
+    DIRTYPE,
+    RECORDSIZE,
+    REGTYPE,
+    TarFile as StandardTarFile,
+    TarInfo,
+)
+import hashlib
+import json
+import os
 
 """Improvements to the standard library's tarfile module.
 
@@ -29,8 +39,21 @@ In particular this module provides a tarfile.TarFile subclass that aids
 in adding paths to the tarfile that aren't present on the filesystem,
 with the ability to specify file content as strings, and provide
 default values for the mtime, uid, etc. of the created paths.
+
+It can also record where the content of each file is in an uncompressed
+tarfile, and write that down in a trailing index member, so that readers
+can seek straight to any file instead of reading all the ones before it.
+The index is JSON, followed by a footer line with INDEX_MAGIC and the size
+of the JSON, so that it can be found from the end of the tarfile.
 """
 
+INDEX_FILENAME = 'INDEX'
+INDEX_MAGIC = 'TARFILE-INDEX'
+# Enough of the end of a tarfile to hold the footer of its index, after the
+# padding of the index member, the end-of-archive blocks and the padding of
+# the last record.
+INDEX_TAIL_SIZE = RECORDSIZE + 4 * BLOCKSIZE
+
 
 @contextmanager
 def writeable_tarfile(backing_file, mode="w", **kwargs):
@@ -80,6 +103,9 @@ class TarFile(StandardTarFile):
         self.default_gid = kwargs.pop("default_gid", None)
         self.default_uname = kwargs.pop("default_uname", None)
         self.default_gname = kwargs.pop("default_gname", None)
+        self.index = None
+        if kwargs.pop("record_index", False):
+            self.index = []
         super(TarFile, self).__init__(*args, **kwargs)
 
     def _set_defaults(self, tarinfo):
@@ -101,12 +127,58 @@ class TarFile(StandardTarFile):
             tarfile.
         :param content: the content to put in the created file.
         """
+        self.create_file_from_fileobj(filename, StringIO(content),
+                                      len(content))
+
+    def create_file_from_fileobj(self, filename, fileobj, size, mode=None):
+        """Create a file with the contents read from a file object.
+
+        The contents are copied in fixed-size chunks, so they never need to
+        be held in memory all at once.
+
+        :param filename: the path to put the file at inside the
+            tarfile.
+        :param fileobj: the file object to read the content from.
+        :param size: the number of bytes to read from fileobj.
+        :param mode: the permissions of the created file, or None to use
+            the stdlib default.
+        """
         tarinfo = TarInfo(name=filename)
-        tarinfo.size = len(content)
+        tarinfo.size = size
+        if mode is not None:
+            tarinfo.mode = mode
         self._set_defaults(tarinfo)
-        fileobj = StringIO(content)
         self.addfile(tarinfo, fileobj=fileobj)
 
+    def addfile(self, tarinfo, fileobj=None):
+        """Add a path to the tarfile, recording it in the index if any."""
+        if self.index is None or not tarinfo.isreg() or fileobj is None:
+            return super(TarFile, self).addfile(tarinfo, fileobj=fileobj)
+        hashing_fileobj = _HashingFile(fileobj)
+        super(TarFile, self).addfile(tarinfo, fileobj=hashing_fileobj)
+        blocks, remainder = divmod(tarinfo.size, BLOCKSIZE)
+        if remainder:
+            blocks += 1
+        self.index.append({
+            'name': tarinfo.name,
+            'offset': self.offset - blocks * BLOCKSIZE,
+            'size': tarinfo.size,
+            'mode': tarinfo.mode,
+            'mtime': tarinfo.mtime,
+            'sha256': hashing_fileobj.hexdigest(),
+        })
+
+    def write_index(self):
+        """Add the index of the files added so far, as the last member.
+
+        The tarfile must not be compressed for the offsets in the index to
+        be of any use.
+        """
+        content = json.dumps({'members': self.index}, sort_keys=True) + '\n'
+        content += '%s %d\n' % (INDEX_MAGIC, len(content))
+        self.index = None
+        self.create_file_from_string(INDEX_FILENAME, content)
+
     def create_dir(self, path):
         """Create a directory within the tarfile.
 
@@ -117,3 +189,58 @@ class TarFile(StandardTarFile):
         tarinfo.mode = 0755
         self._set_defaults(tarinfo)
         self.addfile(tarinfo)
+
+
+class _HashingFile(object):
+    """A file object computing the SHA-256 of what's read from another."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sha256.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+
+def read_index(fileobj):
+    """Read the index at the end of an uncompressed tarfile.
+
+    :param fileobj: The file object of the tarfile, which must support
+        seeking.
+    :return: A list with a dict for each file in the index, with its
+        'name', the 'offset' and 'size' of its content, its 'mode', 'mtime'
+        and 'sha256'; or None if the tarfile has no index.
+    """
+    try:
+        fileobj.seek(0, os.SEEK_END)
+        end = fileobj.tell()
+        tail_start = max(0, end - INDEX_TAIL_SIZE)
+        fileobj.seek(tail_start)
+        tail = fileobj.read(end - tail_start).rstrip('\0')
+        footer_start = tail.rfind('\n', 0, len(tail) - 1) + 1
+        footer = tail[footer_start:].split()
+        if len(footer) != 2 or footer[0] != INDEX_MAGIC:
+            return None
+        size = int(footer[1])
+        fileobj.seek(tail_start + footer_start - size)
+        return json.loads(fileobj.read(size))['members']
+    except (IOError, ValueError, KeyError):
+        # Compressed tarfiles can't seek to their end, and we don't want to
+        # fail on a broken index when we can do without it.
+        return None
+
+
+def index_tarinfo(entry):
+    """Return a TarInfo for a file of the index, to extract it with."""
+    tarinfo = TarInfo(name=entry['name'].encode('utf-8'))
+    tarinfo.type = REGTYPE
+    tarinfo.size = entry['size']
+    tarinfo.mode = entry['mode']
+    tarinfo.mtime = entry['mtime']
+    tarinfo.offset_data = entry['offset']
+    return tarinfo
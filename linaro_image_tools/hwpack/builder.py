@@ -19,26 +19,36 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
 # USA.
 
+from contextlib import contextmanager
 import logging
 import errno
-import subprocess
+import multiprocessing
 import os
+import Queue
 import shutil
 from glob import iglob
+from multiprocessing.pool import ThreadPool
 
-from debian.debfile import DebFile
-from debian.arfile import ArError
-
-from linaro_image_tools import cmd_runner
+from linaro_image_tools import profiling
 
+from linaro_image_tools.hwpack.compression import DEFAULT_COMPRESSION
 from linaro_image_tools.hwpack.config import Config
+from linaro_image_tools.hwpack.fingerprint import (
+    compute_fingerprint,
+    get_build_mtime,
+    read_fingerprint,
+    remove_fingerprint,
+    write_fingerprint,
+)
 from linaro_image_tools.hwpack.hardwarepack import HardwarePack, Metadata
+from linaro_image_tools.hwpack.lockfile import Lockfile, LockedPackageFetcher
 from linaro_image_tools.hwpack.packages import (
     FetchedPackage,
     LocalArchiveMaker,
     PackageFetcher,
 )
 from linaro_image_tools.hwpack.package_unpacker import PackageUnpacker
+from linaro_image_tools.hwpack.deb_reader import DebReader, DebReaderError
 
 from linaro_image_tools.hwpack.hwpack_fields import (
     PACKAGE_FIELD,
@@ -50,6 +60,14 @@ PACKAGE_FIELDS = [PACKAGE_FIELD, SPL_PACKAGE_FIELD]
 logger = logging.getLogger(__name__)
 LOCAL_ARCHIVE_LABEL = 'hwpack-local'
 
+# Where packages keep their build information.
+BUILD_INFO_PATTERN = 'usr/share/doc/*/BUILD-INFO.txt'
+# Where the build information of the hardware pack is written.
+BUILD_INFO_NAME = 'BUILD-INFO.txt'
+
+# How often to check on the architectures built in parallel, in seconds.
+PARALLEL_BUILD_POLL_INTERVAL = 1
+
 
 class ConfigFileMissing(Exception):
 
@@ -59,10 +77,79 @@ class ConfigFileMissing(Exception):
             "No such config file: '%s'" % self.filename)
 
 
+class HardwarePackBuildError(Exception):
+    """The hardware pack of some architectures could not be built.
+
+    :ivar errors: the error of each of those architectures.
+    :type errors: dict
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super(HardwarePackBuildError, self).__init__(
+            "Failed to build the hardware pack for %s" %
+            ", ".join(sorted(errors)))
+
+
+class _PrefixFilter(logging.Filter):
+    """Prefix the messages logged with a string."""
+
+    def __init__(self, prefix):
+        logging.Filter.__init__(self)
+        self.prefix = prefix
+
+    def filter(self, record):
+        # The record goes through each handler, to be prefixed once.
+        if not getattr(record, 'prefixed', False):
+            record.msg = "%s%s" % (self.prefix, record.msg)
+            record.prefixed = True
+        return True
+
+
+@contextmanager
+def _log_prefix(prefix):
+    """Prefix what's logged in the block with the given string."""
+    log_filter = _PrefixFilter(prefix)
+    loggers = [logging.getLogger()] + [
+        log for log in logging.Logger.manager.loggerDict.values()
+        if isinstance(log, logging.Logger)]
+    handlers = set(handler for log in loggers for handler in log.handlers)
+    for handler in handlers:
+        handler.addFilter(log_filter)
+    try:
+        yield
+    finally:
+        for handler in handlers:
+            handler.removeFilter(log_filter)
+
+
+def _build_architecture_in_child(builder, lockfile, index, architecture,
+                                 results):
+    """Build an architecture, in a process forked by HardwarePackBuilder.
+
+    The error building it or None, its part of the lockfile if there is
+    one and the stages it went through are put in the results queue, with
+    the index of the architecture in those being built.
+    """
+    # Only report our own stages.
+    profiling.take_stages()
+    builder.build_info_name = builder._build_info_name_for(architecture)
+    if os.path.exists(builder.build_info_name):
+        os.unlink(builder.build_info_name)
+    error = builder._build_architecture_logged(lockfile, architecture)
+    locked = None
+    if lockfile is not None:
+        locked = lockfile.architectures.get(architecture)
+    results.put((index, (error, locked, profiling.take_stages())))
+
+
 class HardwarePackBuilder(object):
 
     def __init__(self, config_path, version, local_debs, backports=False,
-                 out_name=None):
+                 out_name=None, compression=DEFAULT_COMPRESSION,
+                 compression_level=None, indexed=False, archive_cache=None,
+                 lists_cache_dir=None, reuse_pkgcache=False, lockfile=None,
+                 locked=False, force=False, jobs=1, downloader=None):
         try:
             with open(config_path) as fp:
                 self.config = Config(fp, allow_unset_bootloader=True)
@@ -71,6 +158,7 @@ class HardwarePackBuilder(object):
                 raise ConfigFileMissing(config_path)
             raise
         self.config.validate()
+        self.config_path = config_path
         self.format = self.config.format
         self.version = version
         self.local_debs = local_debs
@@ -78,16 +166,49 @@ class HardwarePackBuilder(object):
         self.hwpack = None
         self.packages = None
         self.packages_added_to_hwpack = []
+        self.extractions = None
+        self._packages_by_name = None
         self.out_name = out_name
         self.backports = backports
+        self.compression = compression
+        self.compression_level = compression_level
+        self.indexed = indexed
+        self.archive_cache = archive_cache
+        self.lists_cache_dir = lists_cache_dir
+        self.reuse_pkgcache = reuse_pkgcache
+        # What to download the packages with, or None for apt.
+        self.downloader = downloader
+        # The lockfile to write the packages resolved to, or to fetch the
+        # packages from when locked.
+        self.lockfile = lockfile
+        self.locked = locked
+        # Whether to build the hardware packs even if they are up to date.
+        self.force = force
+        self.mtime = get_build_mtime()
+        # The number of architectures to build in parallel.
+        self.jobs = jobs
+        self.build_info_name = BUILD_INFO_NAME
+
+    def _index_packages(self, packages):
+        """Return the given packages in a dict by name.
+
+        The index is kept until it's asked for a different list of packages,
+        or the list changes size.
+        """
+        if (self._packages_by_name is None or
+                self._packages_by_name[0] is not packages or
+                self._packages_by_name[1] != len(packages)):
+            by_name = {}
+            for package in packages:
+                # Like a linear search, the first package with a name wins.
+                by_name.setdefault(package.name, package)
+            self._packages_by_name = (packages, len(packages), by_name)
+        return self._packages_by_name[2]
 
     def find_fetched_package(self, packages, wanted_package_name):
-        wanted_package = None
-        for package in packages:
-            if package.name == wanted_package_name:
-                wanted_package = package
-                break
-        else:
+        wanted_package = self._index_packages(packages).get(
+            wanted_package_name)
+        if wanted_package is None:
             raise AssertionError("Package '%s' was not fetched." %
                                  wanted_package_name)
         return wanted_package
@@ -119,9 +240,50 @@ class HardwarePackBuilder(object):
         return list(set(boot_packages))
 
     def do_extract_file(self, package, source_path, dest_path):
-        """Extract specified file from package to dest_path."""
+        """Plan the extraction of the specified file from package to dest_path.
+
+        The files are extracted by run_extractions() once all of them are
+        known.
+        """
         package_ref = self.find_fetched_package(self.packages, package)
-        return self.add_file_to_hwpack(package_ref, source_path, dest_path)
+        self.extractions.append((package_ref, source_path, dest_path))
+
+    def run_extractions(self):
+        """Extract the files planned by do_extract_file() into the hwpack.
+
+        Each package is read once for all the files wanted from it, however
+        many boards and bootloaders share it, and the packages are read in
+        parallel.
+        """
+        files_by_package = {}
+        packages = []
+        for package, source_path, dest_path in self.extractions:
+            if package.filepath not in files_by_package:
+                files_by_package[package.filepath] = []
+                packages.append(package.filepath)
+            if source_path not in files_by_package[package.filepath]:
+                files_by_package[package.filepath].append(source_path)
+
+        def extract(filepath):
+            return self.package_unpacker.get_files(
+                filepath, files_by_package[filepath])
+
+        if packages:
+            pool = ThreadPool(min(len(packages), multiprocessing.cpu_count()))
+            try:
+                extracted = dict(zip(packages, pool.map(extract, packages)))
+            finally:
+                pool.close()
+                pool.join()
+
+        added = set()
+        for package, source_path, dest_path in self.extractions:
+            tempfile_name = extracted[package.filepath][source_path]
+            if (tempfile_name, dest_path) in added:
+                continue
+            added.add((tempfile_name, dest_path))
+            self.packages_added_to_hwpack.append((package.name, dest_path))
+            self.hwpack.add_file(dest_path, tempfile_name)
 
     def do_extract_files(self):
         """Go through a bootloader config, search for files to extract."""
@@ -168,7 +330,10 @@ class HardwarePackBuilder(object):
             # a null operation for earlier configuration files
             return
 
+        self.extractions = []
         self.foreach_boards_and_bootloaders(self.do_extract_files)
+        self.run_extractions()
+        self.extractions = None
 
     def do_find_copy_files_packages(self):
         """Find packages referenced by copy_files (single board, bootloader)"""
@@ -185,77 +350,262 @@ class HardwarePackBuilder(object):
         del self.copy_files_packages
         return packages
 
+    def _get_fetcher(self, lockfile, architecture, sources, local_packages):
+        """Return the fetcher of the packages for the given architecture.
+
+        When building locked, it fetches the packages of the lockfile
+        instead of resolving them.
+        """
+        if self.locked:
+            packages = lockfile.get_packages(
+                architecture, self.packages, self.config.assume_installed,
+                self.config.include_debs)
+            return LockedPackageFetcher(
+                packages, sources=sources, local_packages=local_packages,
+                archive_cache=self.archive_cache, downloader=self.downloader)
+        return PackageFetcher(
+            sources, architecture=architecture,
+            backports=self.backports, prefer_label=LOCAL_ARCHIVE_LABEL,
+            archive_cache=self.archive_cache,
+            lists_cache_dir=self.lists_cache_dir,
+            reuse_pkgcache=self.reuse_pkgcache, downloader=self.downloader)
+
     def build(self):
-        for architecture in self.config.architectures:
-            logger.info("Building for %s" % architecture)
-            metadata = Metadata.from_config(
-                self.config, self.version, architecture)
-            self.hwpack = HardwarePack(metadata)
-            sources = self.config.sources
-            with LocalArchiveMaker() as local_archive_maker:
-                self.hwpack.add_apt_sources(sources)
-                if sources:
-                    sources = sources.values()
-                else:
-                    sources = []
-                self.packages = self.config.packages[:]
-                # Loop through multiple bootloaders.
-                # In V3 of hwpack configuration, all the bootloaders info and
-                # packages are in the bootloaders section.
-                if self.format.format_as_string == '3.0':
-                    if self.config.bootloaders is not None:
-                        self.packages.extend(self.find_bootloader_packages(
-                            self.config.bootloaders))
-                    if self.config.boards is not None:
-                        self.packages.extend(self.find_bootloader_packages(
-                            self.config.boards))
-
-                    self.packages.extend(self.find_copy_files_packages())
-                else:
-                    if self.config.bootloader_package is not None:
-                        self.packages.append(self.config.bootloader_package)
-                    if self.config.spl_package is not None:
-                        self.packages.append(self.config.spl_package)
-                local_packages = [
-                    FetchedPackage.from_deb(deb)
-                    for deb in self.local_debs]
-                sources.append(
-                    local_archive_maker.sources_entry_for_debs(
-                        local_packages, LOCAL_ARCHIVE_LABEL))
-                self.packages.extend([lp.name for lp in local_packages])
-                logger.info("Fetching packages")
-                fetcher = PackageFetcher(
-                    sources, architecture=architecture,
-                    backports=self.backports, prefer_label=LOCAL_ARCHIVE_LABEL)
-                with fetcher:
-                    with PackageUnpacker() as self.package_unpacker:
-                        fetcher.ignore_packages(self.config.assume_installed)
-                        self.packages = fetcher.fetch_packages(
-                            self.packages,
-                            download_content=self.config.include_debs)
+        """Build the hardware pack of each architecture.
 
+        The architectures are built by self.jobs processes in parallel.
+        When there's more than one architecture, the log of each is
+        prefixed with it, and they're all built even if some fail;
+        HardwarePackBuildError is then raised with the error of each of
+        those.
+        """
+        lockfile = None
+        if self.locked:
+            lockfile = Lockfile.read(self.lockfile)
+        elif self.lockfile is not None:
+            lockfile = Lockfile()
+        architectures = self.config.architectures
+        errors = {}
+        if len(architectures) == 1:
+            self._build_architecture(lockfile, architectures[0])
+        elif self.jobs > 1:
+            errors = self._build_in_parallel(lockfile, architectures)
+        else:
+            for architecture in architectures:
+                error = self._build_architecture_logged(
+                    lockfile, architecture)
+                if error is not None:
+                    errors[architecture] = error
+        if errors:
+            for architecture in architectures:
+                if architecture in errors:
+                    logger.error("Failed to build for %s: %s" % (
+                        architecture, errors[architecture]))
+            raise HardwarePackBuildError(errors)
+        if lockfile is not None and not self.locked:
+            lockfile.write(self.lockfile)
+            logger.info("Wrote %s" % self.lockfile)
+
+    def _build_in_parallel(self, lockfile, architectures):
+        """Build the given architectures in up to self.jobs processes.
+
+        Each architecture is built in a process of its own, forked from
+        this one, which hands back its part of the lockfile and of the
+        profile. The BUILD-INFO.txt of the last architecture wins, as when
+        they're built one after the other. An architecture whose process
+        dies fails, without stopping the others.
+
+        :return: a dict with the error of each architecture which failed.
+        """
+        queue = multiprocessing.Queue()
+        pending = list(enumerate(architectures))
+        running = {}
+        results = {}
+        errors = {}
+        try:
+            while pending or running:
+                while pending and len(running) < self.jobs:
+                    index, architecture = pending.pop(0)
+                    process = multiprocessing.Process(
+                        target=_build_architecture_in_child,
+                        args=(self, lockfile, index, architecture, queue))
+                    process.start()
+                    running[index] = process
+                # Whatever these put in the queue was flushed to it before
+                # they exited, so it's read below.
+                exited = [i for i, p in running.items() if not p.is_alive()]
+                # With a timeout, so that KeyboardInterrupt is not ignored
+                # while waiting and dead processes are noticed.
+                try:
+                    index, result = queue.get(
+                        timeout=PARALLEL_BUILD_POLL_INTERVAL)
+                    results[index] = result
+                    while True:
+                        index, result = queue.get_nowait()
+                        results[index] = result
+                except Queue.Empty:
+                    pass
+                for index, process in running.items():
+                    if index in results:
+                        process.join()
+                        del running[index]
+                    elif index in exited:
+                        errors[architectures[index]] = (
+                            "The process building it died with exit code "
+                            "%d" % process.exitcode)
+                        del running[index]
+        finally:
+            for process in running.values():
+                process.terminate()
+                process.join()
+        for index, architecture in enumerate(architectures):
+            if index not in results:
+                continue
+            error, locked, stages = results[index]
+            profiling.merge_stages(stages)
+            if error is not None:
+                errors[architecture] = error
+            if lockfile is not None and locked is not None:
+                lockfile.architectures[architecture] = locked
+            build_info_name = self._build_info_name_for(architecture)
+            if os.path.exists(build_info_name):
+                os.rename(build_info_name, BUILD_INFO_NAME)
+        return errors
+
+    def _build_info_name_for(self, architecture):
+        """The BUILD-INFO.txt a process building in parallel writes to."""
+        return "%s.%s" % (BUILD_INFO_NAME, architecture)
+
+    def _build_architecture_logged(self, lockfile, architecture):
+        """Build the given architecture, with its log prefixed with it.
+
+        :return: the error building it, or None if it was built.
+        """
+        with _log_prefix("[%s] " % architecture):
+            try:
+                self._build_architecture(lockfile, architecture)
+            except Exception, e:
+                logger.exception("Failed to build for %s" % architecture)
+                return str(e) or e.__class__.__name__
+        return None
+
+    def _build_architecture(self, lockfile, architecture):
+        """Build the hardware pack of the given architecture.
+
+        :param lockfile: the Lockfile to take the packages from when
+            building locked, or to record them in, or None.
+        """
+        logger.info("Building for %s" % architecture)
+        metadata = Metadata.from_config(
+            self.config, self.version, architecture)
+        self.hwpack = HardwarePack(metadata, self.compression,
+                                   self.compression_level, self.indexed,
+                                   mtime=self.mtime)
+        sources = self.config.sources
+        with LocalArchiveMaker() as local_archive_maker:
+            self.hwpack.add_apt_sources(sources)
+            if sources:
+                sources = sources.values()
+            else:
+                sources = []
+            self.packages = self.config.packages[:]
+            # Loop through multiple bootloaders.
+            # In V3 of hwpack configuration, all the bootloaders info and
+            # packages are in the bootloaders section.
+            if self.format.format_as_string == '3.0':
+                if self.config.bootloaders is not None:
+                    self.packages.extend(self.find_bootloader_packages(
+                        self.config.bootloaders))
+                if self.config.boards is not None:
+                    self.packages.extend(self.find_bootloader_packages(
+                        self.config.boards))
+
+                self.packages.extend(self.find_copy_files_packages())
+            else:
+                if self.config.bootloader_package is not None:
+                    self.packages.append(self.config.bootloader_package)
+                if self.config.spl_package is not None:
+                    self.packages.append(self.config.spl_package)
+            local_packages = [
+                FetchedPackage.from_deb(deb)
+                for deb in self.local_debs]
+            sources.append(
+                local_archive_maker.sources_entry_for_debs(
+                    local_packages, LOCAL_ARCHIVE_LABEL))
+            self.packages.extend([lp.name for lp in local_packages])
+            logger.info("Fetching packages")
+            fetcher = self._get_fetcher(
+                lockfile, architecture, sources, local_packages)
+            with fetcher:
+                with PackageUnpacker() as self.package_unpacker:
+                    fetcher.ignore_packages(self.config.assume_installed)
+                    requested = self.packages
+                    self.packages = fetcher.resolve_packages(
+                        self.packages,
+                        download_content=self.config.include_debs)
+                    if lockfile is not None and not self.locked:
+                        lockfile.add_packages(
+                            architecture, requested,
+                            self.config.assume_installed,
+                            self.config.include_debs, self.packages,
+                            local_packages)
+
+                    out_name = self.out_name
+                    if not out_name:
+                        out_name = self.hwpack.filename()
+                    fingerprint = self._fingerprint(
+                        architecture, local_packages)
+                    if (not self.force and
+                            read_fingerprint(out_name) == fingerprint):
+                        logger.info("%s is up to date" % out_name)
+                        return
+                    self.hwpack.fingerprint = fingerprint
+                    if self.config.include_debs:
+                        fetcher.download_packages(self.packages)
+
+                    with profiling.stage('file extraction'):
                         if self.format.format_as_string == '3.0':
                             self.extract_files()
                         else:
                             self._old_format_extract_files()
 
-                        self._add_packages_to_hwpack(local_packages)
+                    self._add_packages_to_hwpack(local_packages)
+                    with profiling.stage('contents index'):
+                        self.hwpack.add_contents()
 
-                        out_name = self.out_name
-                        if not out_name:
-                            out_name = self.hwpack.filename()
-
-                        manifest_name = os.path.splitext(out_name)[0]
-                        if manifest_name.endswith('.tar'):
-                            manifest_name = os.path.splitext(manifest_name)[0]
-                        manifest_name += '.manifest.txt'
+                    manifest_name = os.path.splitext(out_name)[0]
+                    if manifest_name.endswith('.tar'):
+                        manifest_name = os.path.splitext(manifest_name)[0]
+                    manifest_name += '.manifest.txt'
 
+                    remove_fingerprint(out_name)
+                    with profiling.stage('to_file') as stage:
                         self._write_hwpack_and_manifest(out_name,
                                                         manifest_name)
+                        stage['bytes'] = os.path.getsize(out_name)
 
-                        cache_dir = fetcher.cache.tempdir
+                    cache_dir = fetcher.tempdir
+                    with profiling.stage('build-info'):
                         self._extract_build_info(cache_dir, out_name,
                                                  manifest_name)
+                    write_fingerprint(out_name, fingerprint)
+
+    def _fingerprint(self, architecture, local_packages):
+        """Return the fingerprint of the hardware pack being built.
+
+        See linaro_image_tools.hwpack.fingerprint.
+        """
+        with open(self.config_path) as fp:
+            config_text = fp.read()
+        options = {
+            'compression': self.compression,
+            'compression-level': self.compression_level,
+            'indexed': self.indexed,
+            'mtime': self.mtime,
+        }
+        return compute_fingerprint(
+            config_text, self.version, architecture, self.packages,
+            local_packages, options)
 
     def _write_hwpack_and_manifest(self, out_name, manifest_name):
         """Write the real hwpack file and its manifest file.
@@ -344,31 +694,19 @@ class HardwarePackBuilder(object):
                 # e.g. fetched package with dummy information
                 continue
             try:
-                # Extract Build-Info attribute from debian control
-                deb_control = DebFile(deb_pkg_file_path).control.debcontrol()
-                build_info = deb_control.get('Build-Info')
-            except ArError:
+                with DebReader(deb_pkg_file_path) as reader:
+                    # Extract Build-Info attribute from debian control
+                    build_info = reader.control().get('Build-Info')
+                    if build_info is not None:
+                        build_info_available += 1
+                        # Extract only the build information out of the
+                        # package
+                        reader.extract_matching(BUILD_INFO_PATTERN,
+                                                build_info_dir)
+            except DebReaderError:
                 # Skip invalid debian package file
                 # e.g. fetched package with dummy information
                 continue
-            if build_info is not None:
-                build_info_available += 1
-                # Extract debian packages with build information
-                env = os.environ
-                env['LC_ALL'] = 'C'
-                env['NO_PKG_MANGLE'] = '1'
-                proc = cmd_runner.Popen(['dpkg-deb', '-x',
-                                        deb_pkg_file_path, build_info_dir],
-                                        env=env, stdout=subprocess.PIPE,
-                                        stderr=subprocess.PIPE)
-
-                (stdoutdata, stderrdata) = proc.communicate()
-                if proc.returncode:
-                    raise ValueError('dpkg-deb extract failed!\n%s' %
-                                     stderrdata)
-                if stderrdata:
-                    raise ValueError('dpkg-deb extract had warnings:\n%s' %
-                                     stderrdata)
 
         self._concatenate_build_info(build_info_available, build_info_dir,
                                      out_name, manifest_name)
@@ -387,10 +725,10 @@ class HardwarePackBuilder(object):
         :type manifest_name: str
         """
         logger.debug("Concatenating build-info files")
-        dst_file = open('BUILD-INFO.txt', 'wb')
+        dst_file = open(self.build_info_name, 'wb')
         if build_info_available > 0:
-            build_info_path = (r'%s/usr/share/doc/*/BUILD-INFO.txt' %
-                               build_info_dir)
+            build_info_path = os.path.join(build_info_dir,
+                                           BUILD_INFO_PATTERN)
             for src_file in iglob(build_info_path):
                 with open(src_file, 'rb') as f:
                     dst_file.write('\nFiles-Pattern: %s\n' % out_name)
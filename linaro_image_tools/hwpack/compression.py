@@ -0,0 +1,323 @@
+# Copyright (C) 2010, 2011, 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Compress hardware packs, and open them whatever their compression.
+
+Hardware packs are tarballs compressed with gzip (the default), xz or zstd,
+or not compressed at all. The compression of an existing hardware pack is
+detected from its magic bytes, not from its name.
+
+gzip output is compressed in parallel blocks by ParallelGzipWriter, like
+pigz does, and still decompresses with any gzip. xz and zstd output is
+compressed by the xz and zstd commands, using all the CPUs too.
+"""
+
+from collections import deque
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+import multiprocessing
+import shutil
+import struct
+import subprocess
+import tarfile
+import tempfile
+import threading
+import zlib
+
+from linaro_image_tools import cmd_runner
+from linaro_image_tools.hwpack.better_tarfile import TarFile
+
+COMPRESSIONS = ['gzip', 'xz', 'zstd', 'none']
+DEFAULT_COMPRESSION = 'gzip'
+
+# The extension of a hardware pack with each compression.
+EXTENSIONS = {
+    'gzip': '.tar.gz',
+    'xz': '.tar.xz',
+    'zstd': '.tar.zst',
+    'none': '.tar',
+}
+
+# The compression level used for each compression when none is given; the
+# same as tarfile's for gzip, and the commands' own defaults otherwise.
+DEFAULT_LEVELS = {
+    'gzip': 9,
+    'xz': 6,
+    'zstd': 3,
+}
+
+# The magic bytes at the start of a file for each compression format we know
+# how to read.
+COMPRESSION_MAGIC = [
+    ('gzip', '\x1f\x8b'),
+    ('bzip2', 'BZh'),
+    ('xz', '\xfd7zXZ\x00'),
+    ('zstd', '\x28\xb5\x2f\xfd'),
+]
+
+# The commands compressing stdin to stdout; given the level and the number of
+# threads to use (0 meaning one per CPU).
+COMPRESS_COMMANDS = {
+    'xz': ['xz', '-c', '-%(level)d', '-T%(threads)d'],
+    'zstd': ['zstd', '-c', '-q', '-%(level)d', '-T%(threads)d'],
+}
+
+# The commands decompressing stdin to stdout, for the formats tarfile can't
+# read itself.
+DECOMPRESS_COMMANDS = {
+    'xz': ['xz', '-d', '-c'],
+    'zstd': ['zstd', '-d', '-c'],
+}
+
+# The amount of uncompressed data compressed by each ParallelGzipWriter job.
+GZIP_BLOCK_SIZE = 1024 * 1024
+
+
+def detect_compression(path):
+    """Return the compression of the given file, from its magic bytes.
+
+    :return: One of the formats in COMPRESSION_MAGIC, or 'none' if the file
+        is not compressed with any of them.
+    """
+    with open(path, 'rb') as fd:
+        header = fd.read(8)
+    for compression, magic in COMPRESSION_MAGIC:
+        if header.startswith(magic):
+            return compression
+    return 'none'
+
+
+def open_tarfile(path):
+    """Open the hardware pack at the given path for reading.
+
+    The hardware packs tarfile can't decompress are decompressed into a
+    temporary file, so that their members can still be read in any order.
+    """
+    compression = detect_compression(path)
+    if compression not in DECOMPRESS_COMMANDS:
+        return tarfile.open(path, mode='r:*')
+    decompressed = tempfile.TemporaryFile()
+    with open(path, 'rb') as compressed:
+        cmd_runner.run(DECOMPRESS_COMMANDS[compression], stdin=compressed,
+                       stdout=decompressed).wait()
+    decompressed.seek(0)
+    return tarfile.open(fileobj=decompressed, mode='r:')
+
+
+def _deflate_block(block, level, last):
+    """Compress one block of a ParallelGzipWriter into raw deflate data.
+
+    Blocks other than the last end with a sync flush, which ends them on a
+    byte boundary without marking the end of the stream, so that the
+    compressed blocks can be concatenated.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    flush_mode = zlib.Z_SYNC_FLUSH
+    if last:
+        flush_mode = zlib.Z_FINISH
+    return compressor.compress(block) + compressor.flush(flush_mode)
+
+
+class ParallelGzipWriter(object):
+    """A file object writing what's written to it gzip compressed.
+
+    The data is split into blocks compressed in parallel by a pool of
+    threads (zlib releases the GIL while compressing), and written out in
+    order as a single gzip member, which any gzip can decompress.
+    """
+
+    def __init__(self, fileobj, level=DEFAULT_LEVELS['gzip'], threads=0,
+                 block_size=GZIP_BLOCK_SIZE):
+        """
+        :param fileobj: The file object to write the compressed data to.
+            It is not closed by close().
+        :param threads: The number of threads compressing blocks, or 0 to
+            use one per CPU.
+        """
+        if threads <= 0:
+            threads = multiprocessing.cpu_count()
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self.pool = ThreadPool(threads)
+        # The blocks being compressed, in order, up to a few per thread so
+        # that memory use is bounded.
+        self.jobs = deque()
+        self.max_jobs = threads * 2
+        self.buffer = []
+        self.buffered = 0
+        self.crc = 0
+        self.size = 0
+        # No file name and no mtime, so that the output only depends on the
+        # data; the OS is Unix.
+        self.fileobj.write('\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\x03')
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered < self.block_size:
+            return
+        pending = ''.join(self.buffer)
+        offset = 0
+        while len(pending) - offset >= self.block_size:
+            self._submit(
+                pending[offset:offset + self.block_size], last=False)
+            offset += self.block_size
+        self.buffer = [pending[offset:]]
+        self.buffered = len(pending) - offset
+
+    def tell(self):
+        return self.size
+
+    def _submit(self, block, last):
+        self.jobs.append(self.pool.apply_async(
+            _deflate_block, (block, self.level, last)))
+        while len(self.jobs) > self.max_jobs:
+            self.fileobj.write(self.jobs.popleft().get())
+
+    def close(self):
+        """Write out the rest of the data, and the gzip trailer."""
+        if self.pool is None:
+            return
+        try:
+            self._submit(''.join(self.buffer), last=True)
+            self.buffer = []
+            while self.jobs:
+                self.fileobj.write(self.jobs.popleft().get())
+            self.fileobj.write(struct.pack(
+                '<II', self.crc & 0xffffffff, self.size & 0xffffffff))
+        finally:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+class CommandWriter(object):
+    """A file object writing what's written to it through a command.
+
+    The output of the command is copied to another file object by a
+    separate thread.
+    """
+
+    def __init__(self, fileobj, args):
+        self.proc = cmd_runner.run(
+            args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.size = 0
+        self.copier = threading.Thread(
+            target=shutil.copyfileobj, args=(self.proc.stdout, fileobj))
+        self.copier.daemon = True
+        self.copier.start()
+
+    def write(self, data):
+        self.size += len(data)
+        self.proc.stdin.write(data)
+
+    def tell(self):
+        return self.size
+
+    def close(self):
+        if self.proc is None:
+            return
+        proc, self.proc = self.proc, None
+        proc.stdin.close()
+        self.copier.join()
+        proc.wait()
+
+
+class PlainWriter(object):
+    """A file object writing what's written to it as it is."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        self.fileobj.write(data)
+
+    def tell(self):
+        return self.size
+
+    def close(self):
+        pass
+
+
+def get_writer(fileobj, compression=DEFAULT_COMPRESSION, level=None,
+               threads=0):
+    """Return a file object compressing what's written to it into fileobj.
+
+    The compressed stream is only complete once the writer is closed;
+    fileobj itself is left open.
+
+    :param compression: One of COMPRESSIONS.
+    :param level: The compression level, or None for the default one.
+    :param threads: The number of threads to compress with, or 0 to use one
+        per CPU.
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError("Unknown compression: %s" % compression)
+    if compression == 'none':
+        return PlainWriter(fileobj)
+    if level is None:
+        level = DEFAULT_LEVELS[compression]
+    if compression == 'gzip':
+        return ParallelGzipWriter(fileobj, level=level, threads=threads)
+    return CommandWriter(fileobj, [
+        arg % {'level': level, 'threads': threads}
+        for arg in COMPRESS_COMMANDS[compression]])
+
+
+@contextmanager
+def compressed_file(fileobj, compression=DEFAULT_COMPRESSION, level=None,
+                    threads=0):
+    """A context manager compressing what's written to it into fileobj.
+
+    See get_writer().
+    """
+    writer = get_writer(fileobj, compression, level, threads)
+    try:
+        yield writer
+    finally:
+        writer.close()
+
+
+@contextmanager
+def create_tarfile(path, compression=DEFAULT_COMPRESSION, level=None,
+                   threads=0, indexed=False):
+    """A context manager to write a compressed tarfile to the given path.
+
+    See get_writer() for the meaning of the arguments.
+
+    :param indexed: Whether to end the tarfile with an index of its files;
+        see better_tarfile. Indexed tarfiles can't be compressed.
+    """
+    if indexed and compression != 'none':
+        raise ValueError("Indexed tarfiles can't be compressed.")
+    with open(path, 'wb') as fd:
+        with compressed_file(fd, compression, level, threads) as compressed:
+            tf = TarFile.open(fileobj=compressed, mode='w|',
+                              record_index=indexed)
+            try:
+                yield tf
+                if indexed:
+                    tf.write_index()
+            finally:
+                tf.close()
@@ -0,0 +1,199 @@
+# Copyright (C) 2010, 2011, 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""The Contents index of the files in the packages of a hardware pack.
+
+The index is stored in the hardware pack next to pkgs/Packages, as
+pkgs/Contents, so that the files of its packages can be looked up and
+globbed without unpacking them. It has a line for each file of each package,
+sorted by path, with these tab-separated fields:
+
+    path package type size mode offset linkname
+
+The path is relative to the root of the filesystem, the type is 'f' for
+regular files, 'l' for symlinks and 'h' for hard links, the mode is in
+octal and the offset is that of the content of the file in the uncompressed
+data part of the package. The linkname is empty for regular files.
+"""
+
+import fnmatch
+
+from linaro_image_tools.hwpack.deb_reader import (
+    DebReader,
+    _follow_symlinks,
+    _normalize_member_name,
+)
+
+REGULAR = 'f'
+SYMLINK = 'l'
+HARDLINK = 'h'
+
+
+def _glob_match(pattern, path):
+    """Whether the path matches the pattern, like glob.glob() would.
+
+    Unlike fnmatch, wildcards don't match across directories.
+    """
+    pattern_parts = pattern.split('/')
+    path_parts = path.split('/')
+    if len(pattern_parts) != len(path_parts):
+        return False
+    for pattern_part, path_part in zip(pattern_parts, path_parts):
+        if not fnmatch.fnmatchcase(path_part, pattern_part):
+            return False
+    return True
+
+
+class ContentsEntry(object):
+    """A file of a package in the Contents index."""
+
+    def __init__(self, path, package, type, size, mode, offset, linkname=''):
+        self.path = path
+        self.package = package
+        self.type = type
+        self.size = size
+        self.mode = mode
+        self.offset = offset
+        self.linkname = linkname
+
+    @classmethod
+    def from_tarinfo(cls, package, tarinfo):
+        """Create an entry from the TarInfo of a member of a package.
+
+        :return: The entry, or None for members which are not files.
+        """
+        if tarinfo.isfile():
+            type = REGULAR
+        elif tarinfo.issym():
+            type = SYMLINK
+        elif tarinfo.islnk():
+            type = HARDLINK
+        else:
+            return None
+        linkname = tarinfo.linkname
+        if type == HARDLINK:
+            linkname = _normalize_member_name(linkname)
+        return cls(_normalize_member_name(tarinfo.name), package, type,
+                   tarinfo.size, tarinfo.mode & 07777, tarinfo.offset_data,
+                   linkname)
+
+    @classmethod
+    def from_line(cls, line):
+        path, package, type, size, mode, offset, linkname = line.split('\t')
+        return cls(path, package, type, int(size), int(mode, 8),
+                   int(offset), linkname)
+
+    def to_line(self):
+        return '\t'.join([
+            self.path, self.package, self.type, str(self.size),
+            '%o' % self.mode, str(self.offset), self.linkname])
+
+    def __eq__(self, other):
+        return self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return "<ContentsEntry %s from %s>" % (self.path, self.package)
+
+
+class Contents(object):
+    """The Contents index of the files in a set of packages."""
+
+    def __init__(self):
+        # The entries of each package, by path.
+        self.packages = {}
+
+    def add_entry(self, entry):
+        self.packages.setdefault(entry.package, {})[entry.path] = entry
+
+    def add_deb(self, package, deb_path):
+        """Add the files of the .deb at deb_path, as those of package."""
+        files = self.packages.setdefault(package, {})
+        with DebReader(deb_path) as reader:
+            for tarinfo in reader.list_members():
+                entry = ContentsEntry.from_tarinfo(package, tarinfo)
+                if entry is not None:
+                    files[entry.path] = entry
+
+    def remove_package(self, package):
+        self.packages.pop(package, None)
+
+    def update(self, other):
+        """Add the packages of another Contents index to this one."""
+        self.packages.update(other.packages)
+
+    @classmethod
+    def parse(cls, text):
+        """Parse a Contents index, as written by __str__()."""
+        contents = cls()
+        for line in text.splitlines():
+            if line:
+                contents.add_entry(ContentsEntry.from_line(line))
+        return contents
+
+    def __str__(self):
+        entries = [entry for files in self.packages.values()
+                   for entry in files.values()]
+        entries.sort(key=lambda entry: (entry.path, entry.package))
+        return ''.join(entry.to_line() + '\n' for entry in entries)
+
+    def has_package(self, package):
+        return package in self.packages
+
+    def lookup(self, package, path):
+        """Return the entry of a regular file of a package.
+
+        The path is followed through any symlinks and hard links within the
+        package, as unpacking it would.
+
+        :return: The entry of the file the path resolves to, or None if
+            there's no such file in the package.
+        """
+        files = self.packages.get(package, {})
+        symlinks = dict((entry.path, entry.linkname)
+                        for entry in files.values() if entry.type == SYMLINK)
+        path = _follow_symlinks(_normalize_member_name(path), symlinks)
+        entry = files.get(path)
+        if entry is not None and entry.type == HARDLINK:
+            entry = files.get(entry.linkname)
+        if entry is None or entry.type != REGULAR:
+            return None
+        return entry
+
+    def glob(self, pattern, package=None):
+        """Return the paths of the files matching a shell-style pattern.
+
+        Like linaro_image_tools.media_create.boards._get_file_matching(),
+        symlinks are left out.
+
+        :param package: The package to look in, or None to look in all of
+            them.
+        """
+        pattern = _normalize_member_name(pattern)
+        packages = self.packages.keys()
+        if package is not None:
+            packages = [package]
+        paths = set()
+        for name in packages:
+            for entry in self.packages.get(name, {}).values():
+                if entry.type != SYMLINK and _glob_match(pattern, entry.path):
+                    paths.add(entry.path)
+        return sorted(paths)
@@ -0,0 +1,407 @@
+# Copyright (C) 2010, 2011, 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Read .deb packages without unpacking them with dpkg.
+
+A .deb is an ar archive holding a debian-binary file and two (possibly
+compressed) tarballs: control.tar.* with the package's metadata and
+data.tar.* with the files it installs. DebReader parses the ar archive and
+streams the members of those tarballs on demand, so that a single file can
+be read out of a package without writing the rest of it to disk.
+"""
+
+from contextlib import contextmanager
+import bz2
+import fnmatch
+import os
+import posixpath
+import shutil
+import subprocess
+import tarfile
+import threading
+import zlib
+
+from debian.deb822 import Deb822
+
+from linaro_image_tools import cmd_runner
+from linaro_image_tools.utils import try_import
+
+lzma = try_import('lzma', try_import('backports.lzma'))
+zstandard = try_import('zstandard')
+
+AR_MAGIC = '!<arch>\n'
+AR_HEADER_SIZE = 60
+READ_SIZE = 1024 * 1024
+
+# How many symlinks we follow when looking for a file in a package, like
+# the kernel's MAXSYMLINKS.
+MAX_SYMLINKS = 40
+
+
+class DebReaderError(Exception):
+    """The file is not a .deb we can read."""
+
+
+def _normalize_member_name(name):
+    """Return the name of a package's member relative to its root."""
+    return posixpath.normpath(name.lstrip('/'))
+
+
+def _resolve_link(name, linkname):
+    """Return where the symlink with the given name points to."""
+    if linkname.startswith('/'):
+        return _normalize_member_name(linkname)
+    return _normalize_member_name(
+        posixpath.join(posixpath.dirname(name), linkname))
+
+
+def _follow_symlinks(target, symlinks):
+    """Follow the target through the given symlinks.
+
+    :param symlinks: A dict mapping the names of symlinks to their targets.
+    :return: The path the target resolves to.
+    """
+    for hop in range(MAX_SYMLINKS):
+        for name, linkname in symlinks.items():
+            if target == name or target.startswith(name + '/'):
+                target = _resolve_link(name, linkname) + target[len(name):]
+                break
+        else:
+            return target
+    raise DebReaderError("Too many levels of symbolic links.")
+
+
+class _MemberFile(object):
+    """A file object reading the data of a member of an ar archive."""
+
+    def __init__(self, fileobj, offset, size):
+        self.fileobj = fileobj
+        self.offset = offset
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        self.fileobj.seek(self.offset)
+        data = self.fileobj.read(size)
+        self.offset += len(data)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        pass
+
+
+class _DecompressingFile(object):
+    """A file object decompressing the data read from another one."""
+
+    def __init__(self, fileobj, decompressor):
+        self.fileobj = fileobj
+        self.decompressor = decompressor
+        self.buffer = ''
+        self.position = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) - self.position < size:
+            data = self.fileobj.read(READ_SIZE)
+            if not data:
+                break
+            self.buffer = (self.buffer[self.position:] +
+                           self.decompressor.decompress(data))
+            self.position = 0
+        if size < 0:
+            size = len(self.buffer) - self.position
+        data = self.buffer[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+    def close(self):
+        pass
+
+
+class _CommandFile(object):
+    """A file object reading the output of a decompression command.
+
+    The command is fed the data read from another file object.
+    """
+
+    def __init__(self, fileobj, args):
+        self.proc = cmd_runner.run(
+            args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.feeder = threading.Thread(target=self._feed, args=(fileobj,))
+        self.feeder.daemon = True
+        self.feeder.start()
+
+    def _feed(self, fileobj):
+        try:
+            shutil.copyfileobj(fileobj, self.proc.stdin, READ_SIZE)
+        except IOError:
+            # The command exited before reading everything, which happens
+            # when we stop reading its output early.
+            pass
+        finally:
+            self.proc.stdin.close()
+
+    def read(self, size=-1):
+        return self.proc.stdout.read(size)
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.stdout.close()
+            self.proc.terminate()
+            self.proc.except_on_cmd_fail = False
+        self.proc.wait()
+        self.feeder.join()
+
+
+def _open_decompressed(fileobj, compression):
+    """Return a file object with the decompressed data of fileobj."""
+    if compression == '':
+        return fileobj
+    if compression == 'gz':
+        return _DecompressingFile(
+            fileobj, zlib.decompressobj(16 + zlib.MAX_WBITS))
+    if compression == 'bz2':
+        return _DecompressingFile(fileobj, bz2.BZ2Decompressor())
+    if compression in ('xz', 'lzma'):
+        if lzma is not None:
+            return _DecompressingFile(fileobj, lzma.LZMADecompressor())
+        return _CommandFile(fileobj, ['xz', '-dc'])
+    if compression == 'zst':
+        if zstandard is not None:
+            return _DecompressingFile(
+                fileobj, zstandard.ZstdDecompressor().decompressobj())
+        return _CommandFile(fileobj, ['zstd', '-dc'])
+    raise DebReaderError("Unsupported compression: %s" % compression)
+
+
+class DebReader(object):
+    """Read the members of a .deb package, without unpacking it."""
+
+    def __init__(self, path):
+        self.path = path
+        self.fileobj = open(path, 'rb')
+        try:
+            self.members = self._read_ar_members()
+        except Exception:
+            self.fileobj.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self.fileobj.close()
+
+    def _read_ar_members(self):
+        """Return a dict with the (offset, size) of each ar member."""
+        if self.fileobj.read(len(AR_MAGIC)) != AR_MAGIC:
+            raise DebReaderError("%s is not a .deb package" % self.path)
+        members = {}
+        offset = len(AR_MAGIC)
+        while True:
+            header = self.fileobj.read(AR_HEADER_SIZE)
+            if not header:
+                return members
+            if len(header) < AR_HEADER_SIZE or header[58:60] != '`\n':
+                raise DebReaderError(
+                    "%s has a corrupt ar header" % self.path)
+            name = header[:16].rstrip(' ').rstrip('/')
+            try:
+                size = int(header[48:58])
+            except ValueError:
+                raise DebReaderError(
+                    "%s has a corrupt ar header" % self.path)
+            offset += AR_HEADER_SIZE
+            members[name] = (offset, size)
+            # Members are aligned on even offsets.
+            offset += size + size % 2
+            self.fileobj.seek(offset)
+
+    def _find_part(self, part):
+        for name in self.members:
+            if name == part or name.startswith(part + '.'):
+                return name
+        raise DebReaderError("%s has no %s member" % (self.path, part))
+
+    @contextmanager
+    def _open_part(self, part):
+        """Open the control or data tarball of the package, for streaming.
+
+        :param part: 'control.tar' or 'data.tar'.
+        """
+        name = self._find_part(part)
+        offset, size = self.members[name]
+        compression = name[len(part) + 1:]
+        fileobj = _open_decompressed(
+            _MemberFile(self.fileobj, offset, size), compression)
+        try:
+            try:
+                part_tarfile = tarfile.open(fileobj=fileobj, mode='r|')
+            except tarfile.TarError, e:
+                raise DebReaderError("%s: %s" % (self.path, e))
+            yield part_tarfile
+        finally:
+            fileobj.close()
+
+    def get_control_file(self, name='control'):
+        """Return the content of a file in the control part of the package.
+        """
+        with self._open_part('control.tar') as control_tarfile:
+            for member in control_tarfile:
+                if (member.isfile() and
+                        _normalize_member_name(member.name) == name):
+                    return control_tarfile.extractfile(member).read()
+        raise DebReaderError("%s has no %s file" % (self.path, name))
+
+    def control(self):
+        """Return the control file of the package, parsed."""
+        return Deb822(self.get_control_file())
+
+    def list_files(self):
+        """Return the names of the files in the data part of the package.
+
+        The names are relative to the root of the filesystem, without a
+        leading './', and in the order they are found in the package.
+        """
+        return [member.name for member in self.list_members()]
+
+    def list_members(self):
+        """Return the TarInfos of the members of the data part.
+
+        Their names are those list_files() returns, and their offset_data
+        is the offset of their content in the uncompressed data part.
+        """
+        members = []
+        with self._open_part('data.tar') as data_tarfile:
+            for member in data_tarfile:
+                member.name = _normalize_member_name(member.name)
+                members.append(member)
+        return members
+
+    def _stream_files(self, targets):
+        """Look for the target files in a single pass over the data part.
+
+        :param targets: A dict mapping the destination of each file to its
+            path in the package.
+        :return: A dict like targets, with the files which were only found
+            to resolve to a path after passing the member with that path,
+            and so need the data part to be read again.
+        """
+        pending = dict(targets)
+        again = {}
+        seen = set()
+        symlinks = {}
+        with self._open_part('data.tar') as data_tarfile:
+            for member in data_tarfile:
+                if not pending:
+                    break
+                name = _normalize_member_name(member.name)
+                seen.add(name)
+                if member.issym():
+                    symlinks[name] = member.linkname
+                    for dest, target in pending.items():
+                        resolved = _follow_symlinks(target, symlinks)
+                        if resolved != target and resolved in seen:
+                            del pending[dest]
+                            again[dest] = resolved
+                        else:
+                            pending[dest] = resolved
+                elif member.islnk():
+                    for dest, target in pending.items():
+                        if target == name:
+                            # The content is in the member linked to, which
+                            # came before this one.
+                            del pending[dest]
+                            again[dest] = _normalize_member_name(
+                                member.linkname)
+                elif member.isfile():
+                    dests = [dest for dest, target in pending.items()
+                             if target == name]
+                    if not dests:
+                        continue
+                    self._write_member(data_tarfile, member, dests[0])
+                    for dest in dests[1:]:
+                        shutil.copy(dests[0], dest)
+                    for dest in dests:
+                        del pending[dest]
+        if pending:
+            raise DebReaderError(
+                "The file '%s' was not found in the package '%s'." % (
+                    sorted(pending.values())[0], self.path))
+        return again
+
+    def _write_member(self, data_tarfile, member, dest):
+        with open(dest, 'wb') as dest_file:
+            shutil.copyfileobj(data_tarfile.extractfile(member), dest_file)
+        os.chmod(dest, member.mode & 0777)
+
+    def extract_files(self, targets):
+        """Write the files on the given paths in the package.
+
+        Nothing else in the package is written to disk, and the package is
+        read once for all the files unless some are only found through
+        symlinks pointing back to members already passed. The files are
+        followed through any symlinks within the package.
+
+        :param targets: A dict mapping the destination of each file to its
+            path in the package.
+        """
+        targets = dict((dest, _normalize_member_name(path))
+                       for dest, path in targets.items())
+        for hop in range(MAX_SYMLINKS):
+            if not targets:
+                return
+            targets = self._stream_files(targets)
+        raise DebReaderError(
+            "Too many levels of symbolic links looking for '%s' in the "
+            "package '%s'." % (sorted(targets.values())[0], self.path))
+
+    def extract_file(self, path, dest):
+        """Write the file on the given path in the package to dest.
+
+        See extract_files().
+        """
+        self.extract_files({dest: path})
+        return dest
+
+    def extract_matching(self, pattern, dest_dir):
+        """Extract the files whose path matches a shell-style pattern.
+
+        :return: The paths of the files extracted, under dest_dir.
+        """
+        extracted = []
+        with self._open_part('data.tar') as data_tarfile:
+            for member in data_tarfile:
+                name = _normalize_member_name(member.name)
+                if name == '..' or name.startswith('../'):
+                    # It would be written outside dest_dir.
+                    continue
+                if member.isfile() and fnmatch.fnmatch(name, pattern):
+                    dest = os.path.join(dest_dir, name)
+                    if not os.path.isdir(os.path.dirname(dest)):
+                        os.makedirs(os.path.dirname(dest))
+                    with open(dest, 'wb') as dest_file:
+                        shutil.copyfileobj(
+                            data_tarfile.extractfile(member), dest_file)
+                    extracted.append(dest)
+        return extracted
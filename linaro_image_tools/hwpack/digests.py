@@ -0,0 +1,181 @@
+# Copyright (C) 2010, 2011, 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Compute the digests of files, remembering those of the files we've seen.
+
+All the digests wanted of a file are computed in a single pass over it, in
+constant memory. They are remembered, along with the inode, size and mtime
+of the file, so that it's not read again unless it has changed; in memory
+by default, and in a file shared between runs once use_digest_cache() has
+been called, except for temporary files.
+"""
+
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+
+DEFAULT_ALGORITHMS = ('md5', 'sha256')
+HASH_BLOCK_SIZE = 1024 * 1024
+DIGEST_CACHE_NAME = 'digests.json'
+
+
+def hash_fileobj(fileobj, algorithms=DEFAULT_ALGORITHMS):
+    """Return the digests of what's read from fileobj, up to its end.
+
+    :param algorithms: The names of the hashlib algorithms to use.
+    :return: A dict mapping each algorithm to the hex digest.
+    """
+    hashes = [(algorithm, hashlib.new(algorithm))
+              for algorithm in algorithms]
+    for block in iter(lambda: fileobj.read(HASH_BLOCK_SIZE), ''):
+        for algorithm, hash in hashes:
+            hash.update(block)
+    return dict((algorithm, hash.hexdigest()) for algorithm, hash in hashes)
+
+
+def _stat_key(stat):
+    return [stat.st_ino, stat.st_size, stat.st_mtime]
+
+
+def _is_temporary(path):
+    """Whether the file at path is in the directory of temporary files."""
+    tempdir = os.path.realpath(tempfile.gettempdir())
+    return os.path.realpath(path).startswith(tempdir + os.sep)
+
+
+class DigestCache(object):
+    """The digests of the files we've seen.
+
+    Each is stored under the path of the file, along with its inode, size
+    and mtime, and is only used while they haven't changed. The file the
+    digests are kept in is only written when some are added, and the
+    entries of the files which are gone or have changed are then dropped.
+    Temporary files won't be seen again, so their digests are only kept in
+    memory.
+    """
+
+    def __init__(self, path=None):
+        """
+        :param path: The file to keep the digests in, which is shared
+            between processes; or None to keep them in memory.
+        """
+        self.path = path
+        self.entries = {}
+
+    def _in_memory(self, path):
+        return self.path is None or _is_temporary(path)
+
+    @contextmanager
+    def _locked(self, exclusive):
+        """Lock the cache file and give it and its entries to the block."""
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0644)
+        cache_file = os.fdopen(fd, 'r+')
+        try:
+            if exclusive:
+                fcntl.flock(cache_file, fcntl.LOCK_EX)
+            else:
+                fcntl.flock(cache_file, fcntl.LOCK_SH)
+            content = cache_file.read()
+            entries = {}
+            if content:
+                try:
+                    entries = json.loads(content)
+                except ValueError:
+                    # A broken cache is only a cache miss.
+                    pass
+            yield cache_file, entries
+        finally:
+            cache_file.close()
+
+    def _lookup(self, path):
+        if self._in_memory(path):
+            return self.entries.get(path)
+        with self._locked(exclusive=False) as (cache_file, entries):
+            return entries.get(path)
+
+    def _store(self, path, entry):
+        if self._in_memory(path):
+            self.entries[path] = entry
+            return
+        with self._locked(exclusive=True) as (cache_file, entries):
+            for other in entries.keys():
+                try:
+                    key = _stat_key(os.stat(other))
+                except OSError:
+                    key = None
+                if key != entries[other]['key']:
+                    del entries[other]
+            entries[path] = entry
+            cache_file.seek(0)
+            cache_file.truncate()
+            json.dump(entries, cache_file, indent=2, sort_keys=True)
+
+    def get_digests(self, path, algorithms=DEFAULT_ALGORITHMS, fileobj=None):
+        """Return the digests of the file at path.
+
+        :param fileobj: The file already opened, if it is, to be read
+            instead of opening it again.
+        :return: A dict mapping each algorithm to the hex digest.
+        """
+        path = os.path.abspath(path)
+        if fileobj is not None:
+            stat = os.fstat(fileobj.fileno())
+        else:
+            stat = os.stat(path)
+        key = _stat_key(stat)
+        entry = self._lookup(path)
+        if entry is not None and entry['key'] == key:
+            digests = entry['digests']
+            if all(algorithm in digests for algorithm in algorithms):
+                return dict((algorithm, str(digests[algorithm]))
+                            for algorithm in algorithms)
+        if fileobj is None:
+            with open(path, 'rb') as fileobj:
+                digests = hash_fileobj(fileobj, algorithms)
+        else:
+            fileobj.seek(0)
+            digests = hash_fileobj(fileobj, algorithms)
+        self._store(path, {'key': key, 'digests': digests})
+        return digests
+
+
+_digest_cache = DigestCache()
+
+
+def use_digest_cache(directory):
+    """Keep the digests of the files we've seen in the given directory.
+
+    The digests are then remembered between runs, so that unchanged files
+    are not read again.
+    """
+    global _digest_cache
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    _digest_cache = DigestCache(os.path.join(directory, DIGEST_CACHE_NAME))
+
+
+def get_digests(path, algorithms=DEFAULT_ALGORITHMS, fileobj=None):
+    """Return the digests of the file at path, using the digest cache.
+
+    See DigestCache.get_digests().
+    """
+    return _digest_cache.get_digests(path, algorithms, fileobj)
@@ -0,0 +1,523 @@
+# Copyright (C) 2010, 2011, 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Download packages over several connections per host.
+
+The packages of each host are downloaded by up to connections_per_host
+threads, each keeping its connection alive from one package to the next.
+Packages are downloaded to a partial file, named after their SHA-256, and
+are only moved where they belong once their size and SHA-256 (or MD5, when
+their SHA-256 is not known), computed while they are downloaded, are right.
+When the partial files are kept in a directory shared between builds, a
+download which was interrupted is resumed from where it stopped.
+
+http: and https: URIs are downloaded, through the proxy of the
+http_proxy/https_proxy environment variables if there is one; apt's
+Acquire::*::Proxy settings are not read. file: URIs are symlinked to, once
+their digest is checked, as apt does.
+"""
+
+from contextlib import contextmanager
+import base64
+import errno
+import fcntl
+import hashlib
+import httplib
+import logging
+import os
+import Queue
+import shutil
+import socket
+import threading
+import time
+import urllib
+import urlparse
+
+from linaro_image_tools.__version__ import __version__
+from linaro_image_tools.hwpack.digests import get_digests
+
+logger = logging.getLogger(__name__)
+
+SCHEMES = ('file', 'http', 'https')
+DEFAULT_CONNECTIONS_PER_HOST = 4
+# How many times a download is retried, resuming it, after a network error.
+DEFAULT_RETRIES = 3
+# The timeout of the connections, in seconds.
+DEFAULT_TIMEOUT = 60
+# How often the progress of the downloads is logged, in seconds.
+PROGRESS_INTERVAL = 5
+BLOCK_SIZE = 64 * 1024
+MAX_REDIRECTS = 5
+PARTIAL_SUFFIX = '.partial'
+# The names of the digests in the errors.
+DIGEST_NAMES = {'sha256': 'SHA-256', 'md5': 'MD5'}
+
+
+class DownloadError(Exception):
+    """A package couldn't be downloaded."""
+
+
+class _TransientError(DownloadError):
+    """A download failed in a way that may not happen again."""
+
+
+_RETRIED_ERRORS = (_TransientError, httplib.HTTPException, socket.error)
+
+
+class Download(object):
+    """A file to download.
+
+    :ivar uri: the URI to download it from.
+    :ivar destfile: the path to download it to.
+    :ivar size: the size it should have, or None.
+    :ivar sha256: the SHA-256 it should have, or None.
+    :ivar md5: the MD5 it should have, or None. It's only checked when the
+        SHA-256 is not known.
+    """
+
+    def __init__(self, uri, destfile, size=None, sha256=None, md5=None):
+        self.uri = uri
+        self.destfile = destfile
+        self.size = size
+        self.sha256 = sha256
+        self.md5 = md5
+
+    @property
+    def digest(self):
+        """The algorithm and value of the digest the file is checked with.
+
+        Both are None if it has no digest.
+        """
+        if self.sha256:
+            return 'sha256', self.sha256
+        if self.md5:
+            return 'md5', self.md5
+        return None, None
+
+    def new_hash(self):
+        """Return a hash object computing the digest of the file."""
+        return hashlib.new(self.digest[0] or 'sha256')
+
+
+def hide_password(uri):
+    """Return the URI with its password, if it has one, hidden."""
+    parts = urlparse.urlsplit(uri)
+    if parts.password is None:
+        return uri
+    netloc = parts.netloc.replace(':%s@' % parts.password, ':***@', 1)
+    return urlparse.urlunsplit(parts._replace(netloc=netloc))
+
+
+def _basic_credentials(parts):
+    """Return the Basic credentials of the URI split in parts, or None."""
+    if parts.username is None:
+        return None
+    credentials = '%s:%s' % (
+        urllib.unquote(parts.username), urllib.unquote(parts.password or ''))
+    return 'Basic ' + base64.b64encode(credentials)
+
+
+def _megabytes(count):
+    return count / (1024.0 * 1024)
+
+
+class DownloadProgress(object):
+    """The bytes downloaded, whose throughput is logged now and then."""
+
+    def __init__(self, total, interval=PROGRESS_INTERVAL):
+        """
+        :param total: the number of bytes to download.
+        :param interval: how often to log the progress, in seconds.
+        """
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.started = time.time()
+        self._last_logged = self.started
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        """The bytes downloaded per second so far."""
+        elapsed = time.time() - self.started
+        if elapsed <= 0:
+            return 0.0
+        return self.done / elapsed
+
+    def add(self, count):
+        """Record that count more bytes were downloaded."""
+        with self._lock:
+            self.done += count
+            now = time.time()
+            if now - self._last_logged < self.interval:
+                return
+            self._last_logged = now
+        logger.info("Downloaded %.1f of %.1f MiB (%.1f MiB/s)" % (
+            _megabytes(self.done), _megabytes(self.total),
+            _megabytes(self.rate)))
+
+    def finish(self):
+        logger.info("Downloaded %.1f MiB in %.1fs (%.1f MiB/s)" % (
+            _megabytes(self.done), time.time() - self.started,
+            _megabytes(self.rate)))
+
+
+@contextmanager
+def _locked_partial(path):
+    """Open and lock the partial file at path, creating it if needed.
+
+    The file may be renamed by whoever held the lock before, in which case
+    the new file at path is opened instead.
+    """
+    while True:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        partial = os.fdopen(fd, 'r+b')
+        try:
+            fcntl.flock(partial, fcntl.LOCK_EX)
+            try:
+                moved = os.stat(path).st_ino != os.fstat(fd).st_ino
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                moved = True
+        except:
+            partial.close()
+            raise
+        if not moved:
+            break
+        partial.close()
+    try:
+        yield partial
+    finally:
+        partial.close()
+
+
+def _truncate(partial):
+    partial.seek(0)
+    partial.truncate()
+
+
+def _file_path(uri):
+    return urllib.unquote(urlparse.urlsplit(uri).path)
+
+
+def _host(parts):
+    """Return the host and port of the URI split in parts, to connect to."""
+    if parts.port is not None:
+        return '%s:%d' % (parts.hostname, parts.port)
+    return parts.hostname
+
+
+def _host_key(uri):
+    """Return what the connections to the host of the URI are shared by."""
+    parts = urlparse.urlsplit(uri)
+    if parts.scheme == 'file':
+        return ('file', None)
+    return (parts.scheme, parts.hostname, parts.port)
+
+
+class Downloader(object):
+    """Download files over several connections per host, resuming them."""
+
+    def __init__(self, connections_per_host=DEFAULT_CONNECTIONS_PER_HOST,
+                 partial_dir=None, retries=DEFAULT_RETRIES,
+                 timeout=DEFAULT_TIMEOUT):
+        """
+        :param connections_per_host: the number of files downloaded from
+            each host at the same time.
+        :param partial_dir: the directory to download the files to before
+            they are complete, which can be shared between builds so that
+            interrupted downloads are resumed. The files are downloaded
+            next to where they belong when it's None.
+        :param retries: how many times a download is resumed after a
+            network error.
+        :param timeout: the timeout of the connections, in seconds.
+        """
+        assert connections_per_host >= 1
+        self.connections_per_host = connections_per_host
+        self.partial_dir = partial_dir
+        if partial_dir is not None and not os.path.isdir(partial_dir):
+            os.makedirs(partial_dir)
+        self.retries = retries
+        self.timeout = timeout
+
+    def can_download(self, uri):
+        """Whether the URI has a scheme the Downloader supports."""
+        return urlparse.urlsplit(uri).scheme in SCHEMES
+
+    def download(self, downloads):
+        """Download files, verifying their size and digest.
+
+        :param downloads: the Downloads.
+        :raises DownloadError: if any of the files couldn't be downloaded,
+            once all the others are.
+        """
+        progress = DownloadProgress(
+            sum(download.size or 0 for download in downloads))
+        queues = {}
+        for download in downloads:
+            queues.setdefault(
+                _host_key(download.uri), Queue.Queue()).put(download)
+        errors = []
+        threads = []
+        for queue in queues.values():
+            for i in range(min(self.connections_per_host, queue.qsize())):
+                thread = threading.Thread(
+                    target=self._download_queue,
+                    args=(queue, progress, errors))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+        for thread in threads:
+            # Joining with a timeout lets KeyboardInterrupt through.
+            while thread.is_alive():
+                thread.join(1)
+        if progress.done:
+            progress.finish()
+        if errors:
+            raise DownloadError(
+                "Some files could not be downloaded:\n%s" % "\n".join(
+                    sorted(errors)))
+
+    def _download_queue(self, queue, progress, errors):
+        """Download the files of the queue over a single connection."""
+        connection = None
+        try:
+            while True:
+                try:
+                    download = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    connection = self._download(download, connection, progress)
+                except Exception, e:
+                    if connection is not None:
+                        connection.close()
+                        connection = None
+                    errors.append("%s: %s" % (hide_password(download.uri), e))
+        finally:
+            if connection is not None:
+                connection.close()
+
+    def _partial_path(self, download):
+        name = os.path.basename(download.destfile)
+        if self.partial_dir is None:
+            return download.destfile + PARTIAL_SUFFIX
+        digest = download.digest[1]
+        if digest:
+            name = '%s_%s' % (digest, name)
+        return os.path.join(self.partial_dir, name + PARTIAL_SUFFIX)
+
+    def _download(self, download, connection, progress):
+        """Download a file, reusing the connection if it's not None.
+
+        :return: the connection to download the next file over, or None.
+        """
+        logger.debug(" ... %s" % hide_password(download.uri))
+        if urlparse.urlsplit(download.uri).scheme == 'file':
+            self._link_file(download)
+            return connection
+        partial_path = self._partial_path(download)
+        with _locked_partial(partial_path) as partial:
+            for attempt in range(self.retries + 1):
+                try:
+                    connection = self._fetch(
+                        download, partial, connection, progress)
+                    break
+                except _RETRIED_ERRORS, e:
+                    if connection is not None:
+                        connection.close()
+                        connection = None
+                    if attempt == self.retries:
+                        raise DownloadError(str(e) or e.__class__.__name__)
+                    logger.debug("Resuming %s after: %s" % (
+                        hide_password(download.uri), e))
+            shutil.move(partial_path, download.destfile)
+        return connection
+
+    def _link_file(self, download):
+        path = _file_path(download.uri)
+        if not os.path.exists(path):
+            raise DownloadError("No such file")
+        algorithm = download.digest[0]
+        digest = None
+        if algorithm is not None:
+            digest = get_digests(path, (algorithm,))[algorithm]
+        self._verify(download, os.path.getsize(path), digest)
+        os.symlink(path, download.destfile)
+
+    def _verify(self, download, size, digest):
+        """Check the size and the digest of what was downloaded.
+
+        :param digest: the hex digest of what was downloaded, with the
+            algorithm of download.digest.
+        """
+        if download.size is not None and size != download.size:
+            raise _TransientError(
+                "Size mismatch: expected %d bytes, got %d" % (
+                    download.size, size))
+        algorithm, expected = download.digest
+        if expected and digest != expected:
+            raise _TransientError(
+                "%s mismatch: expected %s, got %s" % (
+                    DIGEST_NAMES[algorithm], expected, digest))
+
+    def _start(self, download, partial):
+        """Return the hash and size of what's already been downloaded."""
+        digest = download.new_hash()
+        size = 0
+        partial.seek(0)
+        for block in iter(lambda: partial.read(BLOCK_SIZE), ''):
+            digest.update(block)
+            size += len(block)
+        return digest, size
+
+    def _fetch(self, download, partial, connection, progress):
+        """Download the rest of a file to its partial file.
+
+        :return: the connection, if it can be kept alive, or None.
+        """
+        digest, offset = self._start(download, partial)
+        if download.size is not None and offset >= download.size:
+            try:
+                self._verify(download, offset, digest.hexdigest())
+                return connection
+            except _TransientError:
+                logger.debug("Downloading %s again" % download.uri)
+                _truncate(partial)
+                digest, offset = download.new_hash(), 0
+        connection, response, uri = self._request(
+            download.uri, connection, offset)
+        if response.status == httplib.REQUESTED_RANGE_NOT_SATISFIABLE:
+            # The partial file is bigger than the file on the server.
+            response.read()
+            _truncate(partial)
+            raise _TransientError("%d %s" % (response.status, response.reason))
+        if offset and response.status != httplib.PARTIAL_CONTENT:
+            # The server sends the whole file instead.
+            _truncate(partial)
+            digest, offset = download.new_hash(), 0
+        size = offset
+        for block in iter(lambda: response.read(BLOCK_SIZE), ''):
+            digest.update(block)
+            partial.write(block)
+            size += len(block)
+            progress.add(len(block))
+        partial.flush()
+        if response.length:
+            # The connection was closed before the end of the response,
+            # which httplib doesn't complain about; it's resumed from there.
+            raise _TransientError(
+                "The connection was closed %d bytes before the end" %
+                response.length)
+        if response.will_close or _host_key(uri) != _host_key(download.uri):
+            connection.close()
+            connection = None
+        try:
+            self._verify(download, size, digest.hexdigest())
+        except _TransientError:
+            _truncate(partial)
+            raise
+        return connection
+
+    def _proxy(self, parts):
+        """Return the proxy for the URI split in parts, split, if any."""
+        proxy = urllib.getproxies().get(parts.scheme)
+        if not proxy or urllib.proxy_bypass(parts.hostname):
+            return None
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        return urlparse.urlsplit(proxy)
+
+    def _connect(self, parts, proxy):
+        """Return a connection to the host of the URI split in parts.
+
+        :param proxy: the proxy to connect through, split, or None.
+        """
+        host = _host(parts)
+        if proxy is None:
+            if parts.scheme == 'https':
+                return httplib.HTTPSConnection(host, timeout=self.timeout)
+            return httplib.HTTPConnection(host, timeout=self.timeout)
+        if parts.scheme == 'https':
+            connection = httplib.HTTPSConnection(
+                _host(proxy), timeout=self.timeout)
+            headers = {}
+            credentials = _basic_credentials(proxy)
+            if credentials is not None:
+                headers['Proxy-Authorization'] = credentials
+            connection.set_tunnel(host, headers=headers)
+            return connection
+        return httplib.HTTPConnection(_host(proxy), timeout=self.timeout)
+
+    def _request(self, uri, connection, offset):
+        """Request the URI from offset on, following redirections.
+
+        :param connection: the connection to the host of the URI, or None
+            to open one.
+        :return: the connection to read the response from, the response,
+            and the URI it's the response for.
+        """
+        for i in range(MAX_REDIRECTS + 1):
+            parts = urlparse.urlsplit(uri)
+            proxy = self._proxy(parts)
+            if connection is None:
+                connection = self._connect(parts, proxy)
+            headers = {'User-Agent': 'linaro-hwpack-create/%s' % __version__}
+            credentials = _basic_credentials(parts)
+            if credentials is not None:
+                headers['Authorization'] = credentials
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            if proxy is not None and parts.scheme == 'http':
+                # Requests through a proxy have the whole URI, and its
+                # credentials if it has some.
+                path = urlparse.urlunsplit(parts._replace(
+                    netloc=parts.netloc.rpartition('@')[2]))
+                credentials = _basic_credentials(proxy)
+                if credentials is not None:
+                    headers['Proxy-Authorization'] = credentials
+            if offset:
+                headers['Range'] = 'bytes=%d-' % offset
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+            if response.status in (
+                    httplib.OK, httplib.PARTIAL_CONTENT,
+                    httplib.REQUESTED_RANGE_NOT_SATISFIABLE):
+                return connection, response, uri
+            response.read()
+            new_uri = None
+            if response.status in (
+                    httplib.MOVED_PERMANENTLY, httplib.FOUND,
+                    httplib.SEE_OTHER, httplib.TEMPORARY_REDIRECT):
+                new_uri = urlparse.urljoin(
+                    uri, response.getheader('Location', ''))
+            if (response.will_close or new_uri is None or
+                    _host_key(new_uri) != _host_key(uri)):
+                connection.close()
+                connection = None
+            if new_uri is not None:
+                uri = new_uri
+                continue
+            error = "%d %s" % (response.status, response.reason)
+            if response.status >= 500:
+                raise _TransientError(error)
+            raise DownloadError(error)
+        raise DownloadError("Too many redirections")
@@ -0,0 +1,115 @@
+# Copyright (C) 2010, 2011, 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Fingerprints of what hardware packs are built from.
+
+The fingerprint of a hardware pack is a digest of everything it is built
+from: the configuration file, the version and architecture, the packages
+resolved and the local packages with their digests, the options changing
+the output and the version of linaro-image-tools. It is written in the
+hardware pack, and next to it in a file with the FINGERPRINT_SUFFIX, so that
+a hardware pack isn't built again when nothing it's built from changed.
+
+That relies on hardware packs being reproducible: everything in them is
+given the same mtime, SOURCE_DATE_EPOCH or 0 by default.
+"""
+
+import errno
+import hashlib
+import json
+import os
+
+from linaro_image_tools.__version__ import __version__
+
+FINGERPRINT_SUFFIX = '.fingerprint'
+
+
+def get_build_mtime():
+    """Return the mtime to give everything in the hardware packs built.
+
+    It's SOURCE_DATE_EPOCH if that's set in the environment, and 0
+    otherwise.
+    """
+    return int(os.environ.get('SOURCE_DATE_EPOCH', 0))
+
+
+def _package_key(package):
+    return [package.name, package.version, package.sha256]
+
+
+def compute_fingerprint(config_text, version, architecture, packages,
+                        local_packages, options):
+    """Return the fingerprint of a hardware pack.
+
+    :param config_text: the content of the configuration file.
+    :param packages: the FetchedPackages resolved, with their digests.
+    :param local_packages: the FetchedPackages of the local packages.
+    :param options: a dict of the options changing the output, which can
+        be serialized to JSON.
+    :return: the fingerprint, as a hex digest.
+    """
+    data = {
+        'tool-version': __version__,
+        'config': hashlib.sha256(config_text).hexdigest(),
+        'version': version,
+        'architecture': architecture,
+        'packages': sorted(_package_key(package) for package in packages),
+        'local-packages': sorted(
+            _package_key(package) for package in local_packages),
+        'options': options,
+    }
+    return hashlib.sha256(json.dumps(data, sort_keys=True)).hexdigest()
+
+
+def fingerprint_path(out_name):
+    """Return the path of the fingerprint of the hardware pack out_name."""
+    return out_name + FINGERPRINT_SUFFIX
+
+
+def read_fingerprint(out_name):
+    """Return the fingerprint of the hardware pack out_name.
+
+    :return: the fingerprint, or None if the hardware pack or its
+        fingerprint don't exist.
+    """
+    if not os.path.exists(out_name):
+        return None
+    try:
+        with open(fingerprint_path(out_name)) as f:
+            return f.read().strip()
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+
+def write_fingerprint(out_name, fingerprint):
+    """Write the fingerprint of the hardware pack out_name next to it."""
+    with open(fingerprint_path(out_name), 'w') as f:
+        f.write("%s\n" % fingerprint)
+
+
+def remove_fingerprint(out_name):
+    """Remove the fingerprint of the hardware pack out_name, if it has one.
+    """
+    try:
+        os.unlink(fingerprint_path(out_name))
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
@@ -23,10 +23,16 @@ import logging
 import os
 import re
 import shutil
-import tarfile
 import tempfile
 
+from linaro_image_tools.hwpack.better_tarfile import (
+    index_tarinfo,
+    read_index,
+)
+from linaro_image_tools.hwpack.compression import open_tarfile
 from linaro_image_tools.hwpack.config import Config
+from linaro_image_tools.hwpack.contents import Contents
+from linaro_image_tools.hwpack.hardwarepack_format import INDEXED_FORMAT
 from linaro_image_tools.hwpack.package_unpacker import PackageUnpacker
 from linaro_image_tools.utils import DEFAULT_LOGGER_NAME
 
@@ -38,9 +44,11 @@ class HardwarepackHandler(object):
     FORMAT_1 = '1.0'
     FORMAT_2 = '2.0'
     FORMAT_3 = '3.0'
+    FORMAT_4 = INDEXED_FORMAT
     FORMAT_MIXED = '1.0and2.0'
     metadata_filename = 'metadata'
     format_filename = 'FORMAT'
+    contents_filename = 'pkgs/Contents'
     main_section = 'main'
     hwpack_tarfiles = []
     tempdir = None
@@ -51,8 +59,15 @@ class HardwarepackHandler(object):
         self.bootloader = bootloader
         self.board = board
         self.tempdirs = {}
-        # Used to store the config created from the metadata.
-        self.config = None
+        # The index of the members of each hwpack, and the content of its
+        # metadata and FORMAT files, built the first time it is opened.
+        self.hwpack_indexes = {}
+        # The Contents index of each hwpack, or None for those without one.
+        self.hwpack_contents = {}
+        # The config created from the metadata of each hwpack.
+        self.configs = {}
+        # The values of the fields we've already looked up.
+        self.fields = {}
 
     class FakeSecHead(object):
         """ Add a fake section header to the metadata file.
@@ -75,10 +90,94 @@ class HardwarepackHandler(object):
     def __enter__(self):
         self.tempdir = tempfile.mkdtemp()
         for hwpack in self.hwpacks:
-            hwpack_tarfile = tarfile.open(hwpack, mode='r:gz')
+            hwpack_tarfile = open_tarfile(hwpack)
             self.hwpack_tarfiles.append(hwpack_tarfile)
+            if hwpack not in self.hwpack_indexes:
+                self.hwpack_indexes[hwpack] = self._index_hwpack(
+                    hwpack_tarfile)
         return self
 
+    def _read_hwpack_index(self, hwpack_tarfile):
+        """Return the members listed in the index of an indexed hwpack.
+
+        :return: A list of TarInfos, or None if the hwpack has no index.
+        """
+        first = hwpack_tarfile.firstmember
+        if first is None or first.name != self.format_filename:
+            return None
+        format = hwpack_tarfile.extractfile(first).read().strip()
+        if format != self.FORMAT_4:
+            return None
+        entries = read_index(hwpack_tarfile.fileobj)
+        if entries is None:
+            return None
+        return [index_tarinfo(entry) for entry in entries]
+
+    def _index_hwpack(self, hwpack_tarfile):
+        """Read the members of a hwpack.
+
+        The members of indexed hwpacks are taken from their index, without
+        reading through the hwpack; other hwpacks are read in a single pass.
+
+        :return: A dict with the TarInfo of each member, by name, under
+            'members', the names of the packages it contains, in the order
+            they're found, under 'packages' and the content of the metadata
+            and FORMAT files (or None if they're missing) under their names.
+        """
+        index = {'members': {}, 'packages': [], self.metadata_filename: None,
+                 self.format_filename: None}
+        members = self._read_hwpack_index(hwpack_tarfile)
+        if members is None:
+            members = hwpack_tarfile
+        for member in members:
+            index['members'][member.name] = member
+            if member.name.startswith("pkgs/") and member.name.endswith(
+                    ".deb"):
+                index['packages'].append(member.name)
+            if member.name in (self.metadata_filename, self.format_filename):
+                index[member.name] = hwpack_tarfile.extractfile(
+                    member).read()
+        return index
+
+    def _get_index(self, hwpack_tarfile):
+        return self.hwpack_indexes[
+            self.hwpacks[self.hwpack_tarfiles.index(hwpack_tarfile)]]
+
+    def _get_contents(self, hwpack_tarfile):
+        """Return the Contents index of a hwpack, or None if it has none.
+
+        See linaro_image_tools.hwpack.contents.
+        """
+        hwpack = self.hwpacks[self.hwpack_tarfiles.index(hwpack_tarfile)]
+        if hwpack not in self.hwpack_contents:
+            member = self._get_index(hwpack_tarfile)['members'].get(
+                self.contents_filename)
+            contents = None
+            if member is not None:
+                contents = Contents.parse(
+                    hwpack_tarfile.extractfile(member).read())
+            self.hwpack_contents[hwpack] = contents
+        return self.hwpack_contents[hwpack]
+
+    def get_contents(self):
+        """Return the Contents index of the packages of all the hwpacks.
+
+        :return: A Contents, or None unless every hwpack has one.
+        """
+        all_contents = Contents()
+        for hwpack_tarfile in self.hwpack_tarfiles:
+            contents = self._get_contents(hwpack_tarfile)
+            if contents is None:
+                return None
+            all_contents.update(contents)
+        return all_contents
+
+    def _read_member(self, hwpack_tarfile, name):
+        content = self._get_index(hwpack_tarfile)[name]
+        if content is None:
+            raise KeyError("filename %r not found" % name)
+        return content
+
     def __exit__(self, type, value, traceback):
         for hwpack_tarfile in self.hwpack_tarfiles:
             if hwpack_tarfile is not None:
@@ -92,30 +191,41 @@ class HardwarepackHandler(object):
             if tempdir is not None and os.path.exists(tempdir):
                 shutil.rmtree(tempdir)
 
-    def _get_config_from_metadata(self, metadata):
+    def _get_config(self, hwpack_tarfile):
         """
-        Retrieves a Config object associated with the metadata.
+        Retrieves the Config object associated with the hwpack's metadata.
 
-        :param metadata: The metadata to parse.
+        :param hwpack_tarfile: The hwpack whose metadata to parse.
         :return: A Config instance.
         """
-        if not self.config:
-            lines = metadata.readlines()
+        hwpack = self.hwpacks[self.hwpack_tarfiles.index(hwpack_tarfile)]
+        if hwpack not in self.configs:
+            lines = StringIO(self._read_member(
+                hwpack_tarfile, self.metadata_filename)).readlines()
             if re.search("=", lines[0]) and not re.search(":", lines[0]):
                 # Probably V2 hardware pack without [hwpack] on the first line
                 lines = ["[hwpack]\n"] + lines
-            self.config = Config(StringIO("".join(lines)))
-            self.config.board = self.board
-            self.config.bootloader = self.bootloader
-        return self.config
+            config = Config(StringIO("".join(lines)))
+            config.board = self.board
+            config.bootloader = self.bootloader
+            self.configs[hwpack] = config
+        return self.configs[hwpack]
 
     def get_field(self, field, return_keys=False):
+        if field in self.fields and self.hwpack_tarfiles:
+            data, hwpack_index, keys = self.fields[field]
+            hwpack_with_data = None
+            if hwpack_index is not None:
+                hwpack_with_data = self.hwpack_tarfiles[hwpack_index]
+            if return_keys:
+                return data, hwpack_with_data, keys
+            return data, hwpack_with_data
+
         data = None
         hwpack_with_data = None
         keys = None
         for hwpack_tarfile in self.hwpack_tarfiles:
-            metadata = hwpack_tarfile.extractfile(self.metadata_filename)
-            parser = self._get_config_from_metadata(metadata)
+            parser = self._get_config(hwpack_tarfile)
             try:
                 new_data = parser.get_option(field)
                 if new_data is not None:
@@ -124,21 +234,26 @@ class HardwarepackHandler(object):
                                                               new_data)
                     data = new_data
                     hwpack_with_data = hwpack_tarfile
-                    if return_keys:
-                        keys = parser.get_last_used_keys()
+                    keys = parser.get_last_used_keys()
             except ConfigParser.NoOptionError:
                 continue
 
+        if self.hwpack_tarfiles:
+            hwpack_index = None
+            if hwpack_with_data is not None:
+                hwpack_index = self.hwpack_tarfiles.index(hwpack_with_data)
+            self.fields[field] = data, hwpack_index, keys
         if return_keys:
             return data, hwpack_with_data, keys
         return data, hwpack_with_data
 
     def get_format(self):
         format = None
-        supported_formats = [self.FORMAT_1, self.FORMAT_2, self.FORMAT_3]
+        supported_formats = [self.FORMAT_1, self.FORMAT_2, self.FORMAT_3,
+                             self.FORMAT_4]
         for hwpack_tarfile in self.hwpack_tarfiles:
-            format_file = hwpack_tarfile.extractfile(self.format_filename)
-            format_string = format_file.read().strip()
+            format_string = self._read_member(
+                hwpack_tarfile, self.format_filename).strip()
             if not format_string in supported_formats:
                 raise AssertionError(
                     "Format version '%s' is not supported." % format_string)
@@ -183,10 +298,11 @@ class HardwarepackHandler(object):
             # Check that the base path is needed. If the file doesn't exist,
             # try without it (this provides fallback to V2 style directory
             # layouts with a V3 config).
+            members = self._get_index(hwpack_tarfile)['members']
             path_inc_board_and_bootloader = os.path.join(base_path, f)
-            if path_inc_board_and_bootloader in hwpack_tarfile.getnames():
+            if path_inc_board_and_bootloader in members:
                 f = path_inc_board_and_bootloader
-            hwpack_tarfile.extract(f, self.tempdir)
+            hwpack_tarfile.extract(members.get(f, f), self.tempdir)
             f = os.path.join(self.tempdir, f)
             out_files.append(f)
         if single:
@@ -197,9 +313,8 @@ class HardwarepackHandler(object):
         """Return list of (package names, TarFile object containing them)"""
         packages = []
         for tf in self.hwpack_tarfiles:
-            for name in tf.getnames():
-                if name.startswith("pkgs/") and name.endswith(".deb"):
-                    packages.append((tf, name))
+            for name in self._get_index(tf)['packages']:
+                packages.append((tf, name))
         return packages
 
     def find_package_for(self, name, version=None, revision=None,
@@ -246,6 +361,38 @@ class HardwarepackHandler(object):
         # Failed to find a matching package - return None
         return None
 
+    def _check_file_in_package(self, tar_file, package, file_path,
+                               package_name):
+        """Fail unless the Contents index of the hwpack has the file.
+
+        Nothing is checked for hwpacks without a Contents index.
+        """
+        contents = self._get_contents(tar_file)
+        if contents is None or not contents.has_package(package_name):
+            return
+        if contents.lookup(package_name, file_path) is None:
+            raise AssertionError(
+                "The file '%s' was not found in the package '%s'." % (
+                    file_path, os.path.basename(package)))
+
+    def check_file_in_package(self, file_path, package_name,
+                              package_version=None, package_revision=None,
+                              package_architecture=None):
+        """Fail if the named file is known to be missing from the package.
+
+        This only looks at the Contents index of the hwpack, without
+        extracting anything, so that missing files are reported before
+        doing any work; see get_file_from_package() for the arguments.
+        """
+        package_info = self.find_package_for(package_name,
+                                             package_version,
+                                             package_revision,
+                                             package_architecture)
+        if package_info is not None:
+            tar_file, package = package_info
+            self._check_file_in_package(tar_file, package, file_path,
+                                        package_name)
+
     def get_file_from_package(self, file_path, package_name,
                               package_version=None, package_revision=None,
                               package_architecture=None):
@@ -253,7 +400,8 @@ class HardwarepackHandler(object):
 
         File is extracted from the package matching the given specification
         to a temporary directory. The absolute path to the extracted file is
-        returned.
+        returned. If the hwpack has a Contents index, a missing file is
+        reported from it, before extracting anything.
         """
 
         package_info = self.find_package_for(package_name,
@@ -263,6 +411,8 @@ class HardwarepackHandler(object):
         if package_info is None:
             return None
         tar_file, package = package_info
+        self._check_file_in_package(tar_file, package, file_path,
+                                    package_name)
 
         # Avoid unpacking hardware pack more than once by assigning each one
         # its own tempdir to unpack into.
@@ -272,11 +422,12 @@ class HardwarepackHandler(object):
             self.tempdirs[package] = tempfile.mkdtemp()
         tempdir = self.tempdirs[package]
 
-        # We extract everything in the hardware pack so we don't have to worry
-        # about chasing links (extract a link, find where it points to, extract
-        # that...). This is slower, but more reliable.
-        tar_file.extractall(tempdir)
+        # Only the package is extracted from the hardware pack, and only the
+        # file we want (following any links to it) from the package.
         package_path = os.path.join(tempdir, package)
+        if not os.path.exists(package_path):
+            tar_file.extract(
+                self._get_index(tar_file)['members'][package], tempdir)
 
         with PackageUnpacker() as self.package_unpacker:
             extracted_file = self.package_unpacker.get_file(package_path,
@@ -285,8 +436,8 @@ class HardwarepackHandler(object):
                                extracted_file).lstrip("/\\")
             extract_dir = os.path.join(tempdir, "extracted",
                                        os.path.dirname(after_tmp))
-            os.makedirs(extract_dir)
-            shutil.move(extracted_file, extract_dir)
-            extracted_file = os.path.join(extract_dir,
-                                          os.path.basename(extracted_file))
-        return extracted_file
+            if not os.path.isdir(extract_dir):
+                os.makedirs(extract_dir)
+            dest = os.path.join(extract_dir, os.path.basename(extracted_file))
+            shutil.move(extracted_file, dest)
+        return dest
@@ -19,11 +19,23 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
 # USA.
 
+from multiprocessing.pool import ThreadPool
+import multiprocessing
 import time
 import os
+import stat
 import urlparse
 
-from linaro_image_tools.hwpack.better_tarfile import writeable_tarfile
+from linaro_image_tools.hwpack.better_tarfile import (
+    INDEX_FILENAME,
+    writeable_tarfile,
+)
+from linaro_image_tools.hwpack.compression import (
+    DEFAULT_COMPRESSION,
+    EXTENSIONS,
+    compressed_file,
+)
+from linaro_image_tools.hwpack.contents import Contents
 from linaro_image_tools.hwpack.packages import (
     FetchedPackage,
     get_packages_file,
@@ -31,6 +43,7 @@ from linaro_image_tools.hwpack.packages import (
 )
 from linaro_image_tools.hwpack.hardwarepack_format import (
     HardwarePackFormatV1,
+    INDEXED_FORMAT,
 )
 from linaro_image_tools.hwpack.hwpack_convert import (
     dump,
@@ -451,33 +464,69 @@ class HardwarePack(object):
     MANIFEST_FILENAME = "manifest"
     PACKAGES_DIRNAME = "pkgs"
     PACKAGES_FILENAME = "%s/Packages" % PACKAGES_DIRNAME
+    CONTENTS_FILENAME = "%s/Contents" % PACKAGES_DIRNAME
+    FINGERPRINT_FILENAME = "FINGERPRINT"
     SOURCES_LIST_DIRNAME = "sources.list.d"
     SOURCES_LIST_GPG_DIRNAME = "sources.list.d.gpg"
     U_BOOT_DIR = "u-boot"
     SPL_DIR = "spl"
     BOOT_DIR = "boot"
 
-    def __init__(self, metadata):
+    def __init__(self, metadata, compression=DEFAULT_COMPRESSION,
+                 compression_level=None, indexed=False, mtime=None):
         """Create a HardwarePack.
 
         :param metadata: the metadata to use.
         :type metadata: Metadata
+        :param compression: how to compress the hardware pack, one of
+            compression.COMPRESSIONS.
+        :type compression: str
+        :param compression_level: the compression level, or None to use
+            the default one for the compression.
+        :type compression_level: int or None
+        :param indexed: whether to write the hardware pack in the indexed
+            format, INDEXED_FORMAT, instead of the format of its metadata.
+            Indexed hardware packs can't be compressed as a whole.
+        :type indexed: bool
+        :param mtime: the modification time to give everything in the
+            hardware pack, so that it only depends on what's in it, or None
+            to use the time it's written at.
+        :type mtime: int or None
         """
+        if indexed:
+            if not metadata.format.has_v2_fields:
+                raise ValueError("Only hardware packs with 2.0 or later "
+                                 "metadata can be indexed.")
+            if compression != 'none':
+                raise ValueError("Indexed hardware packs can't be "
+                                 "compressed.")
         self.metadata = metadata
+        self.compression = compression
+        self.compression_level = compression_level
+        self.indexed = indexed
         self.sources = {}
         self.packages = []
         self.format = metadata.format
         self.files = []
-
-    def filename(self, extension=".tar.gz"):
+        self.contents = None
+        self.mtime = mtime
+        # The fingerprint of what the hardware pack was built from, written
+        # to FINGERPRINT_FILENAME if it's set; see
+        # linaro_image_tools.hwpack.fingerprint.
+        self.fingerprint = None
+
+    def filename(self, extension=None):
         """The filename that this hardware pack should have.
 
         Returns the filename that the hardware pack should have, according
-        to the convention used.
+        to the convention used. The extension defaults to the one for the
+        compression of the hardware pack.
 
         :return: the filename that should be used.
         :rtype: str
         """
+        if extension is None:
+            extension = EXTENSIONS[self.compression]
         if self.metadata.support is None:
             support_suffix = ""
         else:
@@ -531,9 +580,35 @@ class HardwarePack(object):
                 relationships = {'Depends': ', '.join(packages_spec)}
             deb_file_path = maker.make_package(
                 dep_package_name, self.metadata.version,
-                relationships, self.metadata.architecture)
+                relationships, self.metadata.architecture,
+                mtime=self.mtime)
             self.packages.append(FetchedPackage.from_deb(deb_file_path))
 
+    def add_contents(self):
+        """Index the files of the packages added so far in pkgs/Contents.
+
+        See linaro_image_tools.hwpack.contents. The packages are read in
+        parallel.
+        """
+        packages = [package for package in self.packages
+                    if package.content is not None]
+
+        def index(package):
+            contents = Contents()
+            contents.add_deb(package.name, package.filepath)
+            return contents
+
+        self.contents = Contents()
+        if not packages:
+            return
+        pool = ThreadPool(min(len(packages), multiprocessing.cpu_count()))
+        try:
+            for contents in pool.map(index, packages):
+                self.contents.update(contents)
+        finally:
+            pool.close()
+            pool.join()
+
     def add_file(self, dir, file):
         target_file = os.path.join(dir, os.path.basename(file))
         self.files.append((file, target_file))
@@ -550,7 +625,8 @@ class HardwarePack(object):
         """Write the hwpack to a file object.
 
         The full hardware pack will be written to the file object in
-        gzip compressed tarball form as the spec requires.
+        compressed tarball form, gzip compressed by default as the spec
+        requires.
 
         :param fileobj: the file object to write to.
         :type fileobj: a file-like object
@@ -561,29 +637,50 @@ class HardwarePack(object):
         kwargs["default_gid"] = 1000
         kwargs["default_uname"] = "user"
         kwargs["default_gname"] = "group"
-        kwargs["default_mtime"] = time.time()
-        with writeable_tarfile(fileobj, mode="w:gz", **kwargs) as tf:
+        kwargs["default_mtime"] = self.mtime
+        if self.mtime is None:
+            kwargs["default_mtime"] = time.time()
+        with compressed_file(fileobj, self.compression,
+                             self.compression_level) as compressed:
+            self._write_tarfile(compressed, **kwargs)
+
+    def _write_tarfile(self, fileobj, **kwargs):
+        format = self.format
+        if self.indexed:
+            format = INDEXED_FORMAT
+        with writeable_tarfile(fileobj, mode="w|", record_index=self.indexed,
+                               **kwargs) as tf:
             tf.create_file_from_string(
-                self.FORMAT_FILENAME, "%s\n" % self.format)
+                self.FORMAT_FILENAME, "%s\n" % format)
             tf.create_file_from_string(
                 self.METADATA_FILENAME, str(self.metadata))
+            if self.fingerprint is not None:
+                tf.create_file_from_string(
+                    self.FINGERPRINT_FILENAME, "%s\n" % self.fingerprint)
             for fs_file_name, arc_file_name in self.files:
-                tf.add(fs_file_name, arcname=arc_file_name)
+                with open(fs_file_name, 'rb') as fs_file:
+                    fs_stat = os.fstat(fs_file.fileno())
+                    tf.create_file_from_fileobj(
+                        arc_file_name, fs_file, fs_stat.st_size,
+                        mode=stat.S_IMODE(fs_stat.st_mode))
             tf.create_dir(self.PACKAGES_DIRNAME)
             for package in self.packages:
                 if package.content is not None:
-                    tf.create_file_from_string(
+                    tf.create_file_from_fileobj(
                         self.PACKAGES_DIRNAME + "/" + package.filename,
-                        package.content.read())
+                        package.content, package.size)
             tf.create_file_from_string(
                 self.MANIFEST_FILENAME, self.manifest_text())
             tf.create_file_from_string(
                 self.PACKAGES_FILENAME,
                 get_packages_file(
                     [p for p in self.packages if p.content is not None]))
+            if self.contents is not None:
+                tf.create_file_from_string(
+                    self.CONTENTS_FILENAME, str(self.contents))
             tf.create_dir(self.SOURCES_LIST_DIRNAME)
 
-            for source_name, source_info in self.sources.items():
+            for source_name, source_info in sorted(self.sources.items()):
                 url_parsed = urlparse.urlsplit(source_info)
 
                 # Don't output sources with passwords in them
@@ -594,3 +691,31 @@ class HardwarePack(object):
                         "deb " + source_info + "\n")
             # TODO: include sources keys etc.
             tf.create_dir(self.SOURCES_LIST_GPG_DIRNAME)
+            if self.indexed:
+                tf.write_index()
+
+
+def add_unpacked_hwpack(tf, directory):
+    """Add the hardware pack unpacked in directory to a tarfile.
+
+    FORMAT and metadata are added first, like HardwarePack.to_file() does,
+    and any index of the unpacked hardware pack is left out, as the tarfile
+    gets an index of its own if it's indexed.
+    """
+    first = [HardwarePack.FORMAT_FILENAME, HardwarePack.METADATA_FILENAME]
+    names = first + sorted(
+        name for name in os.listdir(directory)
+        if name not in first and name != INDEX_FILENAME)
+    for name in names:
+        path = os.path.join(directory, name)
+        if os.path.lexists(path):
+            tf.add(path, arcname=name)
+
+
+def is_indexed_hwpack(directory):
+    """Whether the hardware pack unpacked in directory is indexed."""
+    format_path = os.path.join(directory, HardwarePack.FORMAT_FILENAME)
+    if not os.path.exists(format_path):
+        return False
+    with open(format_path) as fd:
+        return fd.read().strip() == INDEXED_FORMAT
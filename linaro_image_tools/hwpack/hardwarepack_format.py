@@ -24,6 +24,12 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# The format of hardware packs which have the metadata of a 2.0 or 3.0 one,
+# but are laid out as an uncompressed tarball with FORMAT and metadata first
+# and an index of its files at the end (see better_tarfile), so that any of
+# them can be read without reading the ones before it.
+INDEXED_FORMAT = "4.0"
+
 
 class HardwarePackFormat(object):
     def __init__(self):
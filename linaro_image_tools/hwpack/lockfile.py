@@ -0,0 +1,267 @@
+# Copyright (C) 2010, 2011, 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Lockfiles of the packages resolved for a hardware pack.
+
+A lockfile records, for each architecture, the packages apt resolved the
+packages of a hardware pack to: their name, version, architecture, file
+name, size, digests and relationships, and the URI they were downloaded
+from. LockedPackageFetcher then fetches exactly those packages, without
+building an apt cache or resolving anything, so that the hardware pack can
+be built again from the same packages.
+
+The credentials of the sources are left out of the URIs, and taken from
+the sources again when the packages are fetched. Local packages have no
+URI, and must be given again.
+"""
+
+import json
+import os
+import re
+import shutil
+import tempfile
+
+from linaro_image_tools.hwpack.packages import (
+    FetchedPackage,
+    acquire_packages,
+)
+
+LOCKFILE_FORMAT = 1
+
+# The fields of a FetchedPackage recorded for each package.
+PACKAGE_FIELDS = FetchedPackage._equality_attributes
+
+
+class LockfileError(Exception):
+    """The lockfile can't be used to build this hardware pack."""
+
+
+def strip_auth(uri):
+    """Return the URI without the credentials it has, if any."""
+    return re.sub(r"^([^:/]+://)[^/@]*@", r"\1", uri)
+
+
+def add_auth(uri, sources):
+    """Return the URI with the credentials of the source it belongs to.
+
+    :param sources: the sources, as given to PackageFetcher.
+    :return: the URI, with the credentials of the source whose URL it
+        starts with, if that has any.
+    """
+    for source in sources:
+        url = source.split()[0].rstrip('/')
+        stripped_url = strip_auth(url)
+        if stripped_url != url and uri.startswith(stripped_url + '/'):
+            return url + uri[len(stripped_url):]
+    return uri
+
+
+def _to_str(value):
+    """Return the value read from JSON with str instead of unicode."""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+class Lockfile(object):
+    """The packages resolved for each architecture of a hardware pack.
+
+    The packages are stored with what they were resolved from: the packages
+    asked for, those assumed to be installed and whether the dependencies
+    were included, so that a lockfile is not used for a different hardware
+    pack.
+    """
+
+    def __init__(self):
+        self.architectures = {}
+
+    def _request(self, packages, assume_installed, with_dependencies):
+        return {
+            'packages': sorted(packages),
+            'assume-installed': sorted(assume_installed),
+            'with-dependencies': with_dependencies,
+        }
+
+    def add_packages(self, architecture, packages, assume_installed,
+                     with_dependencies, fetched, local_packages=()):
+        """Record the packages resolved for an architecture.
+
+        :param packages: the names of the packages asked for.
+        :param assume_installed: the names of the packages ignored.
+        :param with_dependencies: whether the dependencies were fetched too.
+        :param fetched: the FetchedPackages resolved.
+        :param local_packages: the FetchedPackages of the local packages,
+            which are recorded without a URI.
+        """
+        local = set((package.name, package.version, package.sha256)
+                    for package in local_packages)
+        entries = []
+        for package in sorted(fetched, key=lambda p: p.name):
+            entry = dict((field, getattr(package, field))
+                         for field in PACKAGE_FIELDS)
+            entry['uri'] = None
+            if (package.name, package.version, package.sha256) not in local:
+                entry['uri'] = strip_auth(package.uri)
+            entries.append(entry)
+        self.architectures[architecture] = {
+            'request': self._request(
+                packages, assume_installed, with_dependencies),
+            'packages': entries,
+        }
+
+    def get_packages(self, architecture, packages, assume_installed,
+                     with_dependencies):
+        """Return the packages recorded for an architecture.
+
+        See add_packages() for the arguments.
+
+        :return: FetchedPackages without content, whose uri is None for
+            local packages.
+        :raises LockfileError: if the packages weren't recorded for that
+            architecture, or were resolved from other packages.
+        """
+        if architecture not in self.architectures:
+            raise LockfileError(
+                "The lockfile has no packages for %s." % architecture)
+        locked = self.architectures[architecture]
+        if locked['request'] != self._request(
+                packages, assume_installed, with_dependencies):
+            raise LockfileError(
+                "The lockfile was created for different packages for %s."
+                % architecture)
+        fetched = []
+        for entry in locked['packages']:
+            package = FetchedPackage(
+                **dict((field, _to_str(entry[field]))
+                       for field in PACKAGE_FIELDS))
+            package.uri = _to_str(entry['uri'])
+            fetched.append(package)
+        return fetched
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump({'format': LOCKFILE_FORMAT,
+                       'architectures': self.architectures},
+                      f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    @classmethod
+    def read(cls, path):
+        with open(path) as f:
+            try:
+                data = json.load(f)
+            except ValueError, e:
+                raise LockfileError("Invalid lockfile %s: %s" % (path, e))
+        if data.get('format') != LOCKFILE_FORMAT:
+            raise LockfileError(
+                "Unsupported lockfile format: %s" % data.get('format'))
+        lockfile = cls()
+        lockfile.architectures = data['architectures']
+        return lockfile
+
+
+class LockedPackageFetcher(object):
+    """Fetch the packages recorded in a lockfile.
+
+    It can be used in place of a PackageFetcher, but nothing is resolved:
+    the packages fetched are those of the lockfile, whatever is asked for.
+    """
+
+    def __init__(self, packages, sources=(), local_packages=(),
+                 archive_cache=None, downloader=None):
+        """Create a LockedPackageFetcher.
+
+        :param packages: the packages returned by Lockfile.get_packages().
+        :param sources: the sources the packages come from, for their
+            credentials.
+        :param local_packages: the FetchedPackages of the local packages.
+        :param archive_cache: the cache to take the packages from, if they
+            are in it, instead of downloading them, and to store the
+            packages downloaded in.
+        :param downloader: what to download the packages whose URIs it
+            supports with, instead of apt.
+        """
+        self.packages = packages
+        self.sources = sources
+        self.local_packages = local_packages
+        self.archive_cache = archive_cache
+        self.downloader = downloader
+        self.tempdir = None
+
+    def prepare(self):
+        self.tempdir = tempfile.mkdtemp(prefix="hwpack-locked-")
+        return self
+
+    __enter__ = prepare
+
+    def cleanup(self):
+        if self.tempdir is not None and os.path.exists(self.tempdir):
+            shutil.rmtree(self.tempdir)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+        return False
+
+    def ignore_packages(self, packages):
+        """Do nothing, as the lockfile has no ignored packages."""
+
+    def _find_local_package(self, package):
+        for local_package in self.local_packages:
+            if ((local_package.name, local_package.version,
+                 local_package.sha256) ==
+                    (package.name, package.version, package.sha256)):
+                return local_package
+        raise LockfileError(
+            "The local package %s %s of the lockfile was not given." % (
+                package.name, package.version))
+
+    def fetch_packages(self, packages, download_content=True):
+        """Fetch the packages of the lockfile.
+
+        :param packages: ignored, as Lockfile.get_packages() already
+            checked that the lockfile has the packages resolved from them.
+        :param download_content: whether to download the content of the
+            packages.
+        :return: the packages of the lockfile, with their content if
+            download_content is True.
+        """
+        fetched = self.resolve_packages(packages, download_content)
+        if download_content:
+            self.download_packages(fetched)
+        return fetched
+
+    def resolve_packages(self, packages, download_content=True):
+        """Return the packages of the lockfile, without their content.
+
+        The local packages are those given to the fetcher, which have their
+        content.
+        """
+        if not download_content:
+            return self.packages
+        return [self._find_local_package(package)
+                if package.uri is None else package
+                for package in self.packages]
+
+    def download_packages(self, packages):
+        """Download the packages returned by resolve_packages()."""
+        acquire_packages(
+            [(package, add_auth(package.uri, self.sources),
+              os.path.join(self.tempdir, package.filename))
+             for package in packages if package.uri is not None],
+            self.archive_cache, self.downloader)
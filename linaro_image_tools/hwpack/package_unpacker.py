@@ -21,10 +21,9 @@ import logging
 import os
 import tempfile
 
-from subprocess import PIPE
 from shutil import rmtree
 
-from linaro_image_tools import cmd_runner
+from linaro_image_tools.hwpack.deb_reader import DebReader, DebReaderError
 
 logger = logging.getLogger(__name__)
 
@@ -43,24 +42,40 @@ class PackageUnpacker(object):
         package_dir = os.path.basename(package_file_name)
         return os.path.join(self.tempdir, package_dir, file_name)
 
-    def unpack_package(self, package_file_name):
-        # We could extract only a single file, but since dpkg will pipe
-        # the entire package through tar anyway we might as well extract all.
-        unpack_dir = self.get_path(package_file_name)
-        if not os.path.isdir(unpack_dir):
-            os.mkdir(unpack_dir)
-        p = cmd_runner.run(["tar", "-C", unpack_dir, "-xf", "-"], stdin=PIPE)
-        cmd_runner.run(["dpkg", "--fsys-tarfile", package_file_name],
-                       stdout=p.stdin).communicate()
-        p.communicate()
+    def get_files(self, package, files):
+        """Extract the given files out of the given package.
+
+        Only the requested files are written to disk, in a single pass over
+        the package where possible. The files are followed through any
+        symlinks within the package.
+
+        :return: A dict mapping each of the files to the path it was
+            extracted to, in the unpacker's tempdir.
+        """
+        temp_files = {}
+        for file in files:
+            # File path passed here must not be absolute, or file from
+            # real filesystem will be referenced.
+            assert file and file[0] != '/'
+            temp_file = self.get_path(package, file)
+            if not os.path.isdir(os.path.dirname(temp_file)):
+                os.makedirs(os.path.dirname(temp_file))
+            temp_files[file] = temp_file
+        try:
+            with DebReader(package) as reader:
+                reader.extract_files(
+                    dict((temp_file, file)
+                         for file, temp_file in temp_files.items()))
+        except DebReaderError, e:
+            raise AssertionError(str(e))
+        logger.debug("Extracted %s from %s." % (", ".join(files), package))
+        return temp_files
 
     def get_file(self, package, file):
-        # File path passed here must not be absolute, or file from
-        # real filesystem will be referenced.
-        assert file and file[0] != '/'
-        self.unpack_package(package)
-        logger.debug("Unpacked package %s." % package)
-        temp_file = self.get_path(package, file)
-        assert os.path.exists(temp_file), "The file '%s' was " \
-            "not found in the package '%s'." % (file, package)
-        return temp_file
+        """Extract a single file out of the given package.
+
+        See get_files().
+
+        :return: The path of the extracted file, in the unpacker's tempdir.
+        """
+        return self.get_files(package, [file])[file]
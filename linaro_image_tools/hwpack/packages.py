@@ -19,7 +19,10 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
 # USA.
 
+from contextlib import contextmanager
+import fcntl
 import hashlib
+import json
 import logging
 import os
 import re
@@ -34,9 +37,14 @@ from apt.cache import FetchFailedException
 from apt.package import FetchError
 import apt_pkg
 
-from debian.debfile import DebFile
-
-from linaro_image_tools import cmd_runner
+from linaro_image_tools import cmd_runner, profiling
+from linaro_image_tools.hwpack.deb_reader import DebReader
+from linaro_image_tools.hwpack.digests import get_digests
+from linaro_image_tools.hwpack.downloader import (
+    Download,
+    DownloadError,
+    hide_password,
+)
 
 
 logger = logging.getLogger(__name__)
@@ -229,7 +237,13 @@ Description: Dummy package to install a hwpack
 ''')
 
     def make_package(self, name, version, relationships, architecture='all',
-                     files=[]):
+                     files=[], mtime=None):
+        """Build a binary package, returning the path to it.
+
+        :param mtime: the modification time to give the files of the
+            package, for it to be reproducible, or None to leave them as
+            they are.
+        """
         tmp_dir = self.make_temporary_directory()
         filename = '%s_%s_%s' % (name, version, architecture)
         packaging_dir = os.path.join(tmp_dir, filename)
@@ -261,6 +275,13 @@ Description: Dummy package to install a hwpack
         env = os.environ
         env['LC_ALL'] = 'C'
         env['NO_PKG_MANGLE'] = '1'
+        if mtime is not None:
+            for dirpath, dirnames, filenames in os.walk(packaging_dir):
+                for entry in dirnames + filenames:
+                    os.utime(os.path.join(dirpath, entry), (mtime, mtime))
+            os.utime(packaging_dir, (mtime, mtime))
+            # dpkg-deb uses it for the timestamps of the ar members.
+            env = dict(env, SOURCE_DATE_EPOCH='%d' % mtime)
         proc = cmd_runner.Popen(
             ['dpkg-deb', '-b', '-Zgzip', packaging_dir],
             env=env,
@@ -333,6 +354,9 @@ class FetchedPackage(object):
         breaks as specified in debian/control. May be None if the
         package has none.
     :type breaks: str or None
+    :ivar uri: the URI the package can be downloaded from, or None if it
+        is not known.
+    :type uri: str or None
     """
 
     def __init__(self, name, version, filename, size, md5, sha256,
@@ -360,6 +384,7 @@ class FetchedPackage(object):
         self.breaks = breaks
         self.content = None
         self._file_path = None
+        self.uri = None
 
     @property
     def filepath(self):
@@ -392,26 +417,35 @@ class FetchedPackage(object):
         replaces = stringify_relationship(pkg, "Replaces")
         breaks = stringify_relationship(pkg, "Breaks")
         provides = ", ".join([a[0] for a in pkg._cand.provides_list]) or None
+        uri = pkg.uri
         pkg = cls(
             pkg.package.name, pkg.version, filename, pkg.size,
             pkg.md5, pkg.sha256, pkg.architecture, depends=depends,
             pre_depends=pre_depends, multi_arch=multi_arch,
             conflicts=conflicts, recommends=recommends, provides=provides,
             replaces=replaces, breaks=breaks)
+        pkg.uri = uri
         if content is not None:
             pkg.content = content
         return pkg
 
     @classmethod
     def from_deb(cls, deb_file_path):
-        """Create a FetchedPackage from a binary package on disk."""
-        debcontrol = DebFile(deb_file_path).control.debcontrol()
+        """Create a FetchedPackage from a binary package on disk.
+
+        The package is read once, for both its control file and its
+        digests, and not at all for the digests if it hasn't changed since
+        they were last computed; see linaro_image_tools.hwpack.digests.
+        """
+        with DebReader(deb_file_path) as reader:
+            debcontrol = reader.control()
+            digests = get_digests(deb_file_path, fileobj=reader.fileobj)
         name = debcontrol['Package']
         version = debcontrol['Version']
         filename = os.path.basename(deb_file_path)
         size = os.path.getsize(deb_file_path)
-        md5sum = hashlib.md5(open(deb_file_path).read()).hexdigest()
-        sha256sum = hashlib.sha256(open(deb_file_path).read()).hexdigest()
+        md5sum = digests['md5']
+        sha256sum = digests['sha256']
         architecture = debcontrol['Architecture']
         depends = debcontrol.get('Depends')
         pre_depends = debcontrol.get('Pre-Depends')
@@ -478,15 +512,115 @@ class FetchedPackage(object):
                 self.provides, self.replaces, self.breaks, has_content))
 
 
+def acquire_packages(downloads, archive_cache=None, downloader=None):
+    """Download packages, unless they are in the archive cache.
+
+    :param downloads: the FetchedPackages to download, each with the URI to
+        download it from and the file to download it to.
+    :type downloads: a list of (FetchedPackage, str, str)
+    :param archive_cache: the cache to take the packages from, if they are
+        in it, and to store the packages downloaded in.
+    :type archive_cache: archive_cache.ArchiveCache or None
+    :param downloader: what to download the packages whose URIs it supports
+        with; apt downloads the others, and all of them if it's None.
+    :type downloader: downloader.Downloader or None
+    :raises FetchError: if any of the packages couldn't be downloaded.
+    """
+    acq = None
+    acqfiles = []
+    cached = []
+    to_download = []
+    for package, uri, destfile in downloads:
+        if (archive_cache is not None and package.sha256 and
+                archive_cache.fetch(package.filename, package.sha256,
+                                    package.size, destfile)):
+            logger.debug(" ... %s from the archive cache" % package.name)
+            cached.append((package, destfile))
+            continue
+        if downloader is not None and downloader.can_download(uri):
+            to_download.append((package, uri, destfile))
+            continue
+        if acq is None:
+            acq = apt_pkg.Acquire(DummyProgress())
+        acqfile = apt_pkg.AcquireFile(
+            acq, uri, package.md5, package.size, package.filename,
+            destfile=destfile)
+        acqfiles.append((acqfile, package, destfile))
+        logger.debug(" ... %s from %s" % (
+            package.name, hide_password(acqfile.desc_uri)))
+    if to_download:
+        try:
+            downloader.download(
+                [Download(uri, destfile, package.size, package.sha256,
+                          package.md5)
+                 for package, uri, destfile in to_download])
+        except DownloadError, e:
+            raise FetchError(str(e))
+    if acqfiles:
+        acq.run()
+    downloaded = [(package, destfile)
+                  for package, uri, destfile in to_download]
+    for acqfile, package, destfile in acqfiles:
+        if acqfile.status != acqfile.STAT_DONE:
+            raise FetchError(
+                "The item %r could not be fetched: %s" %
+                (acqfile.destfile, acqfile.error_text))
+        downloaded.append((package, destfile))
+    for package, destfile in downloaded:
+        if archive_cache is not None and package.sha256:
+            archive_cache.store(destfile, package.filename, package.sha256)
+    for package, destfile in cached + downloaded:
+        package.content = open(destfile)
+        package._file_path = destfile
+
+
+def _is_local_source(source):
+    return source.startswith("file:")
+
+
+def _local_source_state(source):
+    """Return the size and mtime of the indexes of a file: source.
+
+    :return: A sorted list of the [path, size, mtime] of each index.
+    """
+    url, dist = source.split()[:2]
+    path = re.sub("^file:/*", "/", url)
+    if dist.endswith("/"):
+        # A flat repository, with its indexes at the top.
+        index_dir = os.path.join(path, dist)
+        paths = [os.path.join(index_dir, name)
+                 for name in os.listdir(index_dir)]
+    else:
+        index_dir = os.path.join(path, "dists", dist)
+        paths = [os.path.join(dirpath, name)
+                 for dirpath, dirnames, names in os.walk(index_dir)
+                 for name in names]
+    state = []
+    for index_path in paths:
+        name = os.path.basename(index_path)
+        if name.startswith(("Packages", "Release", "InRelease")):
+            stat = os.stat(index_path)
+            state.append([os.path.relpath(index_path, index_dir),
+                          stat.st_size, stat.st_mtime])
+    return sorted(state)
+
+
 class IsolatedAptCache(object):
     """A apt.cache.Cache wrapper that isolates it from the system it runs on.
 
+    The indexes of the sources are downloaded into the temporary root of the
+    cache, unless a lists_cache_dir is given. Then they are kept there,
+    under the architecture and the remote sources, and revalidated by apt
+    instead of being downloaded again when they haven't changed. Local
+    file: sources are only read again when their indexes change.
+
     :ivar cache: the isolated cache.
     :type cache: apt.cache.Cache
     """
 
     def __init__(self, sources, architecture=None, prefer_label=None,
-                 backports=False):
+                 backports=False, lists_cache_dir=None,
+                 reuse_pkgcache=False):
         """Create an IsolatedAptCache.
 
         :param sources: a list of sources such that they can be prefixed
@@ -494,12 +628,84 @@ class IsolatedAptCache(object):
         :type sources: an iterable of str
         :param architecture: the architecture to fetch packages for.
         :type architecture: str
+        :param lists_cache_dir: the directory to keep the indexes of the
+            sources in between runs, or None to download them every time.
+        :type lists_cache_dir: str or None
+        :param reuse_pkgcache: whether to keep the binary cache apt builds
+            out of the indexes with them too, so that it is only built again
+            when they change. Only used with a lists_cache_dir.
+        :type reuse_pkgcache: bool
         """
         self.sources = sources
         self.architecture = architecture
         self.tempdir = None
         self.prefer_label = prefer_label
         self.backports = backports
+        self.lists_cache_dir = lists_cache_dir
+        self.reuse_pkgcache = reuse_pkgcache
+
+    def _lists_dir(self):
+        """Return the directory to keep the indexes of the sources in."""
+        if self.lists_cache_dir is None:
+            return os.path.join(self.tempdir, "var", "lib", "apt", "lists")
+        # The local sources are left out, as they're often temporary, like
+        # the one of the local debs of HardwarePackBuilder.
+        key = [self.architecture or ""] + sorted(
+            source for source in self.sources
+            if not _is_local_source(source))
+        return os.path.join(
+            os.path.abspath(self.lists_cache_dir),
+            hashlib.sha256("\0".join(key)).hexdigest())
+
+    @contextmanager
+    def _lock_lists(self):
+        """Lock the indexes of the sources while they're updated and read.
+
+        Nothing is locked unless they're in a lists_cache_dir, shared with
+        other runs.
+        """
+        if self.lists_cache_dir is None:
+            yield
+            return
+        with open(os.path.join(self._lists_dir(), "lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _lists_state(self):
+        """Return the state of the sources, to know when they change.
+
+        :return: The state of the sources if they're all local, or None.
+        """
+        if not all(_is_local_source(source) for source in self.sources):
+            return None
+        return {"sources": sorted(self.sources),
+                "indexes": [_local_source_state(source)
+                            for source in sorted(self.sources)]}
+
+    def _update_lists(self):
+        """Update the indexes of the sources, unless they can't have changed.
+        """
+        state_path = os.path.join(self._lists_dir(), "state.json")
+        state = None
+        if self.lists_cache_dir is not None:
+            state = self._lists_state()
+            if state is not None and os.path.exists(state_path):
+                with open(state_path) as f:
+                    if json.load(f) == state:
+                        logger.debug("Local sources unchanged, not updating "
+                                     "apt cache")
+                        return
+            if os.path.exists(state_path):
+                os.unlink(state_path)
+        logger.debug("Updating apt cache")
+        try:
+            self.cache.update()
+        except FetchFailedException, e:
+            obfuscated_e = re.sub(r"([^ ]https://).+?(@)", r"\1***\2", str(e))
+            raise FetchFailedException(obfuscated_e)
+        if state is not None:
+            with open(state_path, "w") as f:
+                json.dump(state, f)
 
     def prepare(self):
         """Prepare the IsolatedAptCache for use.
@@ -517,6 +723,9 @@ class IsolatedAptCache(object):
                 ]
         for d in dirs:
             os.makedirs(os.path.join(self.tempdir, d))
+        lists_dir = self._lists_dir()
+        if not os.path.isdir(os.path.join(lists_dir, "partial")):
+            os.makedirs(os.path.join(lists_dir, "partial"))
         self.set_installed_packages([], reopen=False)
         sources_list = os.path.join(
             self.tempdir, "etc", "apt", "sources.list")
@@ -554,12 +763,20 @@ class IsolatedAptCache(object):
                     source = re.sub("file://", "file:/", source)
                 f.write("deb %s\n" % source)
 
-        if self.architecture is not None:
-            apt_conf = os.path.join(self.tempdir, "etc", "apt", "apt.conf")
-            with open(apt_conf, 'w') as f:
+        apt_conf = os.path.join(self.tempdir, "etc", "apt", "apt.conf")
+        with open(apt_conf, 'w') as f:
+            if self.architecture is not None:
                 f.write(
                     'Apt {\nArchitecture "%s";\n'
                     'Install-Recommends "true";\n}\n' % self.architecture)
+            # apt's configuration is global, so these are always set, not to
+            # be left over from another IsolatedAptCache.
+            srcpkgcache = os.path.join(
+                self.tempdir, "var", "cache", "apt", "srcpkgcache.bin")
+            if self.lists_cache_dir is not None and self.reuse_pkgcache:
+                srcpkgcache = os.path.join(lists_dir, "srcpkgcache.bin")
+            f.write('Dir::State::Lists "%s/";\n' % lists_dir)
+            f.write('Dir::Cache::srcpkgcache "%s";\n' % srcpkgcache)
         apt_preferences = os.path.join(
             self.tempdir, "etc", "apt", "preferences")
         if self.backports:
@@ -577,13 +794,9 @@ class IsolatedAptCache(object):
         # XXX: This is a temporary workaround for bug 885895.
         apt_pkg.config.set("Dir::bin::dpkg", "/bin/false")
         self.cache = Cache(rootdir=self.tempdir, memonly=True)
-        logger.debug("Updating apt cache")
-        try:
-            self.cache.update()
-        except FetchFailedException, e:
-            obfuscated_e = re.sub(r"([^ ]https://).+?(@)", r"\1***\2", str(e))
-            raise FetchFailedException(obfuscated_e)
-        self.cache.open()
+        with self._lock_lists():
+            self._update_lists()
+            self.cache.open()
         return self
 
     def set_installed_packages(self, packages, reopen=True):
@@ -632,7 +845,8 @@ class PackageFetcher(object):
     """A class to fetch packages from a defined list of sources."""
 
     def __init__(self, sources, architecture=None, prefer_label=None,
-                 backports=False):
+                 backports=False, archive_cache=None, lists_cache_dir=None,
+                 reuse_pkgcache=False, downloader=None):
         """Create a PackageFetcher.
 
         Once created a PackageFetcher should have its `prepare` method
@@ -643,17 +857,33 @@ class PackageFetcher(object):
         :type sources: an iterable of str
         :param architecture: the architecture to fetch packages for.
         :type architecture: str
+        :param archive_cache: the cache to take the packages from, if they
+            are in it, instead of downloading them, and to store the
+            packages downloaded in.
+        :type archive_cache: archive_cache.ArchiveCache or None
+        :param lists_cache_dir: the directory to keep the indexes of the
+            sources in between runs; see IsolatedAptCache.
+        :type lists_cache_dir: str or None
+        :param reuse_pkgcache: whether to keep apt's binary cache with them.
+        :type reuse_pkgcache: bool
+        :param downloader: what to download the packages whose URIs it
+            supports with, instead of apt.
+        :type downloader: downloader.Downloader or None
         """
         self.cache = IsolatedAptCache(
             sources, architecture=architecture, prefer_label=prefer_label,
-            backports=backports)
+            backports=backports, lists_cache_dir=lists_cache_dir,
+            reuse_pkgcache=reuse_pkgcache)
+        self.archive_cache = archive_cache
+        self.downloader = downloader
 
     def prepare(self):
         """Prepare the PackageFetcher for use.
 
         Should be called before use.
         """
-        self.cache.prepare()
+        with profiling.stage('apt cache prepare'):
+            self.cache.prepare()
         return self
 
     __enter__ = prepare
@@ -670,6 +900,11 @@ class PackageFetcher(object):
         self.cleanup()
         return False
 
+    @property
+    def tempdir(self):
+        """The directory the packages are downloaded to."""
+        return self.cache.tempdir
+
     def ignore_packages(self, packages):
         """Ignore packages such that they will not be fetched.
 
@@ -744,6 +979,30 @@ class PackageFetcher(object):
         :raises KeyError: if any of the package names in the list couldn't
             be found.
         """
+        fetched = self.resolve_packages(packages, download_content)
+        if download_content:
+            self.download_packages(fetched)
+        return fetched
+
+    def resolve_packages(self, packages, download_content=True):
+        """Resolve the given list of package names, without downloading them.
+
+        :return: the FetchedPackages fetch_packages() would return, without
+            their content; download_packages() downloads them.
+        """
+        with profiling.stage('dependency resolution'):
+            fetched = self._resolve_packages(packages)
+            if download_content:
+                self._add_dependencies(fetched)
+        self.cache.cache.clear()
+        return fetched.values()
+
+    def _resolve_packages(self, packages):
+        """Mark the given packages, and their dependencies, to be installed.
+
+        :return: a dict mapping the names of the packages which aren't
+            ignored to their FetchedPackage, without their content.
+        """
         fetched = {}
         for package in packages:
             candidate = self.cache.cache[package].candidate
@@ -771,42 +1030,33 @@ class PackageFetcher(object):
             # raise SystemError, just to make sure.
             check_no_broken_packages()
         self._filter_ignored(fetched)
-        if not download_content:
-            self.cache.cache.clear()
-            return fetched.values()
-        acq = apt_pkg.Acquire(DummyProgress())
-        acqfiles = []
-        # re to remove the repo private key
-        deb_url_auth_re = re.compile(
-            r"(?P<transport>.*://)(?P<user>.*):.*@(?P<path>.*$)")
+        return fetched
+
+    def _add_dependencies(self, fetched):
+        """Add the dependencies marked to be installed to fetched.
+
+        :param fetched: the dict returned by _resolve_packages.
+        """
         for package in self.cache.cache.get_changes():
             if (package.marked_delete or package.marked_keep):
                 continue
-            logger.debug("Fetching %s ..." % package)
-            candidate = package.candidate
-            base = os.path.basename(candidate.filename)
             if package.name not in fetched:
-                result_package = FetchedPackage.from_apt(candidate, base)
-                fetched[package.name] = result_package
-            result_package = fetched[package.name]
-            destfile = os.path.join(self.cache.tempdir, base)
-            acqfile = apt_pkg.AcquireFile(
-                acq, candidate.uri, candidate.md5, candidate.size,
-                base, destfile=destfile)
-            acqfiles.append((acqfile, result_package, destfile))
-            # check if we have a private key in the pkg url
-            deb_url_auth = deb_url_auth_re.match(acqfile.desc_uri)
-            if deb_url_auth:
-                logger.debug(" ... from %s%s:***@%s" % deb_url_auth.groups())
-            else:
-                logger.debug(" ... from %s" % acqfile.desc_uri)
-        self.cache.cache.clear()
-        acq.run()
-        for acqfile, result_package, destfile in acqfiles:
-            if acqfile.status != acqfile.STAT_DONE:
-                raise FetchError(
-                    "The item %r could not be fetched: %s" %
-                    (acqfile.destfile, acqfile.error_text))
-            result_package.content = open(destfile)
-            result_package._file_path = destfile
-        return fetched.values()
+                candidate = package.candidate
+                base = os.path.basename(candidate.filename)
+                fetched[package.name] = FetchedPackage.from_apt(
+                    candidate, base)
+
+    def download_packages(self, packages):
+        """Download the packages returned by resolve_packages().
+
+        The packages in the archive cache, if there is one, are taken from
+        there instead, and those downloaded are stored in it.
+        """
+        with profiling.stage('fetch') as stage:
+            acquire_packages(
+                [(package, package.uri,
+                  os.path.join(self.cache.tempdir, package.filename))
+                 for package in packages],
+                self.archive_cache, self.downloader)
+            stage['bytes'] = sum(
+                package.size for package in packages if package.size)
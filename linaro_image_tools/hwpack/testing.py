@@ -76,6 +76,53 @@ def test_tarfile(contents=[], **kwargs):
         tf.close()
 
 
+def make_deb(path, contents=[], control='Package: dummy\n',
+             compression='gz'):
+    """Write a .deb package with the given contents to path.
+
+    The contents are specified as a list of tuples of (path, contents),
+    where if the path ends with '@' it is considered to be a symlink and
+    the contents are its target.
+
+    :param control: the content of the package's control file.
+    :param compression: how the package's data.tar is compressed.
+    """
+
+    def make_tarball(members, mode):
+        backing_file = StringIO()
+        tf = tarfile.open(fileobj=backing_file, mode=mode)
+        for name, content in members:
+            tarinfo = tarfile.TarInfo('./' + name.rstrip('@'))
+            if name.endswith('@'):
+                tarinfo.type = tarfile.SYMTYPE
+                tarinfo.linkname = content
+                tf.addfile(tarinfo)
+            else:
+                tarinfo.size = len(content)
+                tf.addfile(tarinfo, StringIO(content))
+        tf.close()
+        return backing_file.getvalue()
+
+    mode = 'w'
+    if compression:
+        mode = 'w:' + compression
+    members = [
+        ('debian-binary', '2.0\n'),
+        ('control.tar.gz', make_tarball([('control', control)], 'w:gz')),
+        ('data.tar' + (compression and '.' + compression),
+         make_tarball(contents, mode)),
+    ]
+    with open(path, 'wb') as deb:
+        deb.write('!<arch>\n')
+        for name, data in members:
+            deb.write('%-16s%-12d%-6d%-6d%-8s%-10d`\n' % (
+                name, 0, 0, 0, '100644', len(data)))
+            deb.write(data)
+            if len(data) % 2:
+                deb.write('\n')
+    return path
+
+
 class DummyFetchedPackage(FetchedPackage):
     """A FetchedPackage with dummy information.
 
@@ -100,6 +147,7 @@ class DummyFetchedPackage(FetchedPackage):
         self._no_content = no_content
         self._content = content
         self._file_path = None
+        self.uri = None
 
     @property
     def filename(self):
@@ -24,13 +24,21 @@ import unittest
 
 def test_suite():
     module_names = [
+        'linaro_image_tools.hwpack.tests.test_archive_cache',
         'linaro_image_tools.hwpack.tests.test_better_tarfile',
         'linaro_image_tools.hwpack.tests.test_builder',
+        'linaro_image_tools.hwpack.tests.test_compression',
         'linaro_image_tools.hwpack.tests.test_config',
+        'linaro_image_tools.hwpack.tests.test_contents',
         'linaro_image_tools.hwpack.tests.test_config_v3',
+        'linaro_image_tools.hwpack.tests.test_deb_reader',
+        'linaro_image_tools.hwpack.tests.test_digests',
+        'linaro_image_tools.hwpack.tests.test_downloader',
+        'linaro_image_tools.hwpack.tests.test_fingerprint',
         'linaro_image_tools.hwpack.tests.test_hardwarepack',
         'linaro_image_tools.hwpack.tests.test_hwpack_converter',
         'linaro_image_tools.hwpack.tests.test_hwpack_reader',
+        'linaro_image_tools.hwpack.tests.test_lockfile',
         'linaro_image_tools.hwpack.tests.test_packages',
         'linaro_image_tools.hwpack.tests.test_script',
         'linaro_image_tools.hwpack.tests.test_tarfile_matchers',
@@ -0,0 +1,97 @@
+# Copyright (C) 2010, 2011, 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+import hashlib
+import os
+import time
+
+from linaro_image_tools.hwpack.archive_cache import ArchiveCache
+from linaro_image_tools.testing import TestCaseWithFixtures
+from linaro_image_tools.tests.fixtures import CreateTempDirFixture
+
+
+class ArchiveCacheTests(TestCaseWithFixtures):
+
+    def setUp(self):
+        super(ArchiveCacheTests, self).setUp()
+        self.tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        self.cache = ArchiveCache(os.path.join(self.tempdir, 'cache'))
+
+    def make_package(self, filename, content):
+        path = os.path.join(self.tempdir, filename)
+        with open(path, 'w') as fd:
+            fd.write(content)
+        return path, hashlib.sha256(content).hexdigest()
+
+    def fetch(self, cache, filename, sha256, size):
+        dest = os.path.join(self.tempdir, 'fetched')
+        if os.path.exists(dest):
+            os.unlink(dest)
+        if cache.fetch(filename, sha256, size, dest):
+            return open(dest).read()
+        return None
+
+    def test_fetch_missing(self):
+        self.assertIs(
+            None, self.fetch(self.cache, 'foo.deb', 'abc', 3))
+
+    def test_store_and_fetch(self):
+        path, sha256 = self.make_package('foo.deb', 'foo')
+        self.cache.store(path, 'foo.deb', sha256)
+        self.assertEqual('foo', self.fetch(self.cache, 'foo.deb', sha256, 3))
+
+    def test_shared_between_instances(self):
+        path, sha256 = self.make_package('foo.deb', 'foo')
+        self.cache.store(path, 'foo.deb', sha256)
+        other = ArchiveCache(self.cache.directory)
+        self.assertEqual('foo', self.fetch(other, 'foo.deb', sha256, 3))
+
+    def test_fetch_other_sha256(self):
+        path, sha256 = self.make_package('foo.deb', 'foo')
+        self.cache.store(path, 'foo.deb', sha256)
+        self.assertIs(
+            None, self.fetch(self.cache, 'foo.deb', 'other', 3))
+
+    def test_fetch_corrupt(self):
+        path, sha256 = self.make_package('foo.deb', 'foo')
+        self.cache.store(path, 'foo.deb', sha256)
+        cached = os.path.join(self.cache.directory, '%s_foo.deb' % sha256)
+        os.unlink(cached)
+        with open(cached, 'w') as fd:
+            fd.write('bar')
+        self.assertIs(None, self.fetch(self.cache, 'foo.deb', sha256, 3))
+        self.assertFalse(os.path.exists(cached))
+
+    def test_evicts_least_recently_used(self):
+        self.cache.max_size = 6
+        foo_path, foo_sha256 = self.make_package('foo.deb', 'foo')
+        bar_path, bar_sha256 = self.make_package('bar.deb', 'bar')
+        baz_path, baz_sha256 = self.make_package('baz.deb', 'baz')
+        self.cache.store(foo_path, 'foo.deb', foo_sha256)
+        time.sleep(0.01)
+        self.cache.store(bar_path, 'bar.deb', bar_sha256)
+        time.sleep(0.01)
+        self.fetch(self.cache, 'foo.deb', foo_sha256, 3)
+        time.sleep(0.01)
+        self.cache.store(baz_path, 'baz.deb', baz_sha256)
+        self.assertEqual('foo', self.fetch(
+            self.cache, 'foo.deb', foo_sha256, 3))
+        self.assertIs(None, self.fetch(self.cache, 'bar.deb', bar_sha256, 3))
+        self.assertEqual('baz', self.fetch(
+            self.cache, 'baz.deb', baz_sha256, 3))
@@ -25,7 +25,12 @@ import tarfile
 
 from testtools import TestCase
 
-from linaro_image_tools.hwpack.better_tarfile import writeable_tarfile
+from linaro_image_tools.hwpack.better_tarfile import (
+    INDEX_FILENAME,
+    index_tarinfo,
+    read_index,
+    writeable_tarfile,
+)
 
 
 @contextmanager
@@ -96,6 +101,27 @@ class TarFileTests(TestCase):
         with standard_tarfile(backing_file) as tf:
             self.assertEqual('', tf.getmember("foo").linkname)
 
+    def test_create_file_from_fileobj_reads_size_bytes(self):
+        backing_file = StringIO()
+        with writeable_tarfile(backing_file) as tf:
+            tf.create_file_from_fileobj("foo", StringIO("barbaz"), 3)
+        with standard_tarfile(backing_file) as tf:
+            self.assertEqual("bar", tf.extractfile("foo").read())
+
+    def test_create_file_from_fileobj_sets_mode(self):
+        backing_file = StringIO()
+        with writeable_tarfile(backing_file) as tf:
+            tf.create_file_from_fileobj("foo", StringIO("bar"), 3, mode=0755)
+        with standard_tarfile(backing_file) as tf:
+            self.assertEqual(0755, tf.getmember("foo").mode)
+
+    def test_create_file_from_fileobj_short_read(self):
+        backing_file = StringIO()
+        with writeable_tarfile(backing_file) as tf:
+            self.assertRaises(
+                IOError, tf.create_file_from_fileobj, "foo", StringIO("b"),
+                3)
+
     def test_create_file_uses_default_mtime(self):
         now = 126793
         backing_file = self.create_simple_tarball(
@@ -131,6 +157,42 @@ class TarFileTests(TestCase):
         with standard_tarfile(backing_file) as tf:
             self.assertEqual(gname, tf.getmember("foo").gname)
 
+    def test_write_index_adds_index_last(self):
+        backing_file = StringIO()
+        with writeable_tarfile(backing_file, record_index=True) as tf:
+            tf.create_file_from_string("foo", "bar")
+            tf.write_index()
+        with standard_tarfile(backing_file) as tf:
+            self.assertEqual(["foo", INDEX_FILENAME], tf.getnames())
+
+    def test_read_index_gives_offsets(self):
+        backing_file = StringIO()
+        with writeable_tarfile(backing_file, record_index=True) as tf:
+            tf.create_dir("dir")
+            tf.create_file_from_string("foo", "bar")
+            tf.create_file_from_string("baz", "quux")
+            tf.write_index()
+        entries = read_index(backing_file)
+        self.assertEqual(["foo", "baz"],
+                         [entry['name'] for entry in entries])
+        for entry, content in zip(entries, ["bar", "quux"]):
+            backing_file.seek(entry['offset'])
+            self.assertEqual(content, backing_file.read(entry['size']))
+
+    def test_index_tarinfo_extracts_content(self):
+        backing_file = StringIO()
+        with writeable_tarfile(backing_file, record_index=True) as tf:
+            tf.create_file_from_string("foo", "bar")
+            tf.write_index()
+        entry = read_index(backing_file)[0]
+        with standard_tarfile(backing_file) as tf:
+            self.assertEqual(
+                "bar", tf.extractfile(index_tarinfo(entry)).read())
+
+    def test_read_index_without_index(self):
+        backing_file = self.create_simple_tarball([("foo", "bar")])
+        self.assertIs(None, read_index(backing_file))
+
     def test_create_dir_adds_path(self):
         backing_file = self.create_simple_tarball([("foo/", "")])
         with standard_tarfile(backing_file) as tf:
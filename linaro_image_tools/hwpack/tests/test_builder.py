@@ -19,20 +19,24 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
 # USA.
 
+import logging
 import os
+import signal
 import tarfile
 
 from testtools import TestCase
 from testtools.matchers import Equals
 
+from linaro_image_tools.hwpack import builder as builder_module
 from linaro_image_tools.hwpack.builder import (
     ConfigFileMissing,
     HardwarePackBuilder,
+    HardwarePackBuildError,
     logger as builder_logger,
 )
 from linaro_image_tools.hwpack.package_unpacker import PackageUnpacker
 from linaro_image_tools.hwpack.config import HwpackConfigError
-from linaro_image_tools.hwpack.hardwarepack import Metadata
+from linaro_image_tools.hwpack.hardwarepack import HardwarePack, Metadata
 from linaro_image_tools.hwpack.packages import (
     FetchedPackage,
     PackageMaker,
@@ -47,14 +51,12 @@ from linaro_image_tools.hwpack.testing import (
     DummyFetchedPackage,
     EachOf,
     IsHardwarePack,
+    make_deb,
     MatchesStructure,
     Not,
 )
 from linaro_image_tools.testing import TestCaseWithFixtures
-from linaro_image_tools.tests.fixtures import (
-    MockSomethingFixture,
-    MockCmdRunnerPopenFixture,
-)
+from linaro_image_tools.tests.fixtures import MockSomethingFixture
 
 
 class ConfigFileMissingTests(TestCase):
@@ -76,37 +78,39 @@ class PackageUnpackerTests(TestCaseWithFixtures):
             tempdir = package_unpacker.tempdir
         self.assertFalse(os.path.exists(tempdir))
 
-    def test_unpack_package(self):
-        fixture = MockCmdRunnerPopenFixture(assert_child_finished=False)
-        self.useFixture(fixture)
-        package_file_name = "package-to-unpack"
-        with PackageUnpacker() as package_unpacker:
-            package_unpacker.unpack_package(package_file_name)
-            package_dir = package_unpacker.get_path(package_file_name)
-        self.assertEquals(
-            ["tar -C %s -xf -" % package_dir,
-             "dpkg --fsys-tarfile %s" % package_file_name],
-            fixture.mock.commands_executed)
+    def make_deb(self, contents):
+        return make_deb(self.createTempFileAsFixture(), contents)
 
     def test_get_file_returns_tempfile(self):
-        package = 'package'
+        package = self.make_deb([('dummyfile', 'content')])
         file = 'dummyfile'
         with PackageUnpacker() as package_unpacker:
-            self.useFixture(MockSomethingFixture(
-                package_unpacker, 'unpack_package', lambda package: None))
-            self.useFixture(MockSomethingFixture(
-                os.path, 'exists', lambda file: True))
             tempfile = package_unpacker.get_file(package, file)
             self.assertEquals(tempfile,
                               os.path.join(package_unpacker.get_path(package),
                                            file))
+            self.assertEqual('content', open(tempfile).read())
+
+    def test_get_file_extracts_only_the_file(self):
+        package = self.make_deb(
+            [('usr/a', 'a'), ('usr/b', 'b'), ('usr/c', 'c')])
+        with PackageUnpacker() as package_unpacker:
+            package_unpacker.get_file(package, 'usr/b')
+            written = [
+                name for _, _, names in os.walk(package_unpacker.tempdir)
+                for name in names]
+        self.assertEqual(['b'], written)
+
+    def test_get_file_follows_symlinks(self):
+        package = self.make_deb([('usr/a', 'a'), ('usr/b@', '/usr/a')])
+        with PackageUnpacker() as package_unpacker:
+            tempfile = package_unpacker.get_file(package, 'usr/b')
+            self.assertEqual('a', open(tempfile).read())
 
     def test_get_file_raises(self):
-        package = 'package'
+        package = self.make_deb([('otherfile', 'content')])
         file = 'dummyfile'
         with PackageUnpacker() as package_unpacker:
-            self.useFixture(MockSomethingFixture(
-                package_unpacker, 'unpack_package', lambda package: None))
             self.assertRaises(AssertionError, package_unpacker.get_file,
                               package, file)
 
@@ -114,17 +118,23 @@ class PackageUnpackerTests(TestCaseWithFixtures):
         # Test that PackageUnpacker, asked to get the same file path
         # from 2 different packages, return reference to *different*
         # temporary files
-        package1 = 'package1'
-        package2 = 'package2'
+        package1 = self.make_deb([('dummyfile', 'content1')])
+        package2 = self.make_deb([('dummyfile', 'content2')])
         file = 'dummyfile'
         with PackageUnpacker() as package_unpacker:
-            self.useFixture(MockSomethingFixture(
-                package_unpacker, 'unpack_package', lambda package: None))
-            self.useFixture(MockSomethingFixture(
-                os.path, 'exists', lambda file: True))
             tempfile1 = package_unpacker.get_file(package1, file)
             tempfile2 = package_unpacker.get_file(package2, file)
             self.assertNotEquals(tempfile1, tempfile2)
+            self.assertEqual('content1', open(tempfile1).read())
+
+    def test_get_files(self):
+        package = self.make_deb([('usr/a', 'a'), ('usr/b@', 'a')])
+        with PackageUnpacker() as package_unpacker:
+            tempfiles = package_unpacker.get_files(package, ['usr/a', 'usr/b'])
+            self.assertEqual(
+                [('usr/a', 'a'), ('usr/b', 'a')],
+                sorted((file, open(tempfile).read())
+                       for file, tempfile in tempfiles.items()))
 
 
 class HardwarePackBuilderTests(TestCaseWithFixtures):
@@ -223,6 +233,47 @@ class HardwarePackBuilderTests(TestCaseWithFixtures):
         self.assertRaises(AssertionError, builder.find_fetched_package,
                           packages, wanted_package_name)
 
+    def test_run_extractions_reads_each_package_once(self):
+        _, config = self.makeMetaDataAndConfigFixture(
+            ["u-boot"], {"ubuntu": "http://example.org/ ubuntu main"},
+            extra_config=self.extra_config)
+        builder = HardwarePackBuilder(config.filename, "1.0", [])
+        builder.hwpack = HardwarePack(Metadata("ahwpack", "1.0", "armel"))
+        uboot = DummyFetchedPackage("u-boot", "1.0")
+        uboot._file_path = make_deb(
+            self.createTempFileAsFixture(),
+            [('usr/lib/u-boot.img', 'u-boot'), ('usr/lib/MLO', 'spl')])
+        other = DummyFetchedPackage("other", "1.0")
+        other._file_path = make_deb(
+            self.createTempFileAsFixture(), [('usr/lib/u-boot.img', 'other')])
+        builder.extractions = [
+            (uboot, 'usr/lib/u-boot.img', 'board1/u_boot/usr/lib'),
+            (uboot, 'usr/lib/MLO', 'board1/u_boot/usr/lib'),
+            (uboot, 'usr/lib/u-boot.img', 'board2/u_boot/usr/lib'),
+            (uboot, 'usr/lib/u-boot.img', 'board2/u_boot/usr/lib'),
+            (other, 'usr/lib/u-boot.img', 'board3/u_boot/usr/lib'),
+        ]
+        with PackageUnpacker() as builder.package_unpacker:
+            get_files = builder.package_unpacker.get_files
+            calls = []
+
+            def logging_get_files(package, files):
+                calls.append((package, files))
+                return get_files(package, files)
+            builder.package_unpacker.get_files = logging_get_files
+            builder.run_extractions()
+            self.assertEqual(
+                [(uboot.filepath, ['usr/lib/u-boot.img', 'usr/lib/MLO']),
+                 (other.filepath, ['usr/lib/u-boot.img'])],
+                sorted(calls, key=lambda call: call[0] != uboot.filepath))
+            self.assertEqual(
+                [('board1/u_boot/usr/lib/u-boot.img', 'u-boot'),
+                 ('board1/u_boot/usr/lib/MLO', 'spl'),
+                 ('board2/u_boot/usr/lib/u-boot.img', 'u-boot'),
+                 ('board3/u_boot/usr/lib/u-boot.img', 'other')],
+                [(target, open(source).read())
+                 for source, target in builder.hwpack.files])
+
     def test_creates_external_manifest(self):
         available_package = DummyFetchedPackage("foo", "1.1")
         sources_dict = self.sourcesDictForPackages([available_package])
@@ -247,6 +298,96 @@ class HardwarePackBuilderTests(TestCaseWithFixtures):
         self.assertTrue(os.path.isfile("hwpack_ahwpack_1.0_i386.tar.gz"))
         self.assertTrue(os.path.isfile("hwpack_ahwpack_1.0_armel.tar.gz"))
 
+    def test_skips_up_to_date_hwpack(self):
+        available_package = DummyFetchedPackage("foo", "1.1")
+        sources_dict = self.sourcesDictForPackages([available_package])
+        metadata, config = self.makeMetaDataAndConfigFixture(
+            ["foo"], sources_dict)
+        HardwarePackBuilder(config.filename, "1.0", []).build()
+        self.assertTrue(
+            os.path.isfile("hwpack_ahwpack_1.0_armel.tar.gz.fingerprint"))
+        builder = HardwarePackBuilder(config.filename, "1.0", [])
+        self.useFixture(MockSomethingFixture(
+            builder, '_write_hwpack_and_manifest', None))
+        # Doesn't write the hardware pack again.
+        builder.build()
+
+    def test_rebuilds_reproducibly(self):
+        available_package = DummyFetchedPackage("foo", "1.1")
+        sources_dict = self.sourcesDictForPackages([available_package])
+        metadata, config = self.makeMetaDataAndConfigFixture(
+            ["foo"], sources_dict)
+        HardwarePackBuilder(config.filename, "1.0", []).build()
+        first = open("hwpack_ahwpack_1.0_armel.tar.gz").read()
+        HardwarePackBuilder(config.filename, "1.0", [], force=True).build()
+        self.assertEqual(first, open("hwpack_ahwpack_1.0_armel.tar.gz").read())
+
+    def makeMultiArchBuilder(self, jobs=1):
+        metadata, config = self.makeMetaDataAndConfigFixture(
+            ["foo"], {'ubuntu': 'http://example.com/ubuntu precise main'},
+            architecture="i386 armel armhf")
+        builder = HardwarePackBuilder(config.filename, "1.0", [], jobs=jobs)
+
+        def build_architecture(lockfile, architecture):
+            builder_logger.info("Building")
+            if architecture == "armel":
+                raise ValueError("No armel here")
+            with open("hwpack_%s" % architecture, "w") as f:
+                f.write(architecture)
+        self.useFixture(MockSomethingFixture(
+            builder, '_build_architecture', build_architecture))
+        return builder
+
+    def test_failed_architecture_does_not_stop_the_others(self):
+        builder = self.makeMultiArchBuilder()
+        self.useFixture(MockSomethingFixture(builder_logger, 'disabled', True))
+        e = self.assertRaises(HardwarePackBuildError, builder.build)
+        self.assertEqual({"armel": "No armel here"}, e.errors)
+        self.assertTrue(os.path.isfile("hwpack_i386"))
+        self.assertTrue(os.path.isfile("hwpack_armhf"))
+
+    def test_builds_architectures_in_parallel(self):
+        builder = self.makeMultiArchBuilder(jobs=3)
+        self.useFixture(MockSomethingFixture(builder_logger, 'disabled', True))
+        e = self.assertRaises(HardwarePackBuildError, builder.build)
+        self.assertEqual({"armel": "No armel here"}, e.errors)
+        self.assertTrue(os.path.isfile("hwpack_i386"))
+        self.assertTrue(os.path.isfile("hwpack_armhf"))
+
+    def test_killed_parallel_build_does_not_stop_the_others(self):
+        builder = self.makeMultiArchBuilder(jobs=3)
+        build_architecture = builder._build_architecture
+
+        def kill_armhf(lockfile, architecture):
+            if architecture == "armhf":
+                os.kill(os.getpid(), signal.SIGKILL)
+            build_architecture(lockfile, architecture)
+        self.useFixture(MockSomethingFixture(
+            builder, '_build_architecture', kill_armhf))
+        self.useFixture(MockSomethingFixture(
+            builder_module, 'PARALLEL_BUILD_POLL_INTERVAL', 0.01))
+        self.useFixture(MockSomethingFixture(builder_logger, 'disabled', True))
+        e = self.assertRaises(HardwarePackBuildError, builder.build)
+        self.assertEqual(
+            {"armel": "No armel here",
+             "armhf": "The process building it died with exit code -9"},
+            e.errors)
+        self.assertTrue(os.path.isfile("hwpack_i386"))
+
+    def test_log_prefixed_with_architecture(self):
+        builder = self.makeMultiArchBuilder()
+        handler = AppendingHandler()
+        builder_logger.addHandler(handler)
+        self.addCleanup(builder_logger.removeHandler, handler)
+        self.useFixture(MockSomethingFixture(
+            builder_logger, 'level', logging.INFO))
+        self.assertRaises(HardwarePackBuildError, builder.build)
+        self.assertEqual(
+            ["[i386] Building", "[armel] Building",
+             "[armel] Failed to build for armel", "[armhf] Building",
+             "Failed to build for armel: No armel here"],
+            [message.getMessage() for message in handler.messages])
+
     def test_builds_correct_contents(self):
         package_name = "foo"
         available_package = DummyFetchedPackage(package_name, "1.1")
@@ -0,0 +1,138 @@
+# Copyright (C) 2010, 2011, 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+from StringIO import StringIO
+import gzip
+import os
+import random
+
+from linaro_image_tools.hwpack.compression import (
+    ParallelGzipWriter,
+    compressed_file,
+    create_tarfile,
+    detect_compression,
+    get_writer,
+    open_tarfile,
+)
+from linaro_image_tools.hwpack.hardwarepack import HardwarePack, Metadata
+from linaro_image_tools.testing import TestCaseWithFixtures
+from linaro_image_tools.utils import has_command
+
+
+class ParallelGzipWriterTests(TestCaseWithFixtures):
+
+    def compress(self, chunks, **kwargs):
+        backing_file = StringIO()
+        writer = ParallelGzipWriter(backing_file, **kwargs)
+        for chunk in chunks:
+            writer.write(chunk)
+        writer.close()
+        return backing_file.getvalue()
+
+    def decompress(self, data):
+        return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+    def test_empty(self):
+        self.assertEqual('', self.decompress(self.compress([])))
+
+    def test_many_blocks(self):
+        rand = random.Random(42)
+        data = ''.join(chr(rand.randrange(16)) for i in range(10000))
+        chunks = [data[i:i + 700] for i in range(0, len(data), 700)]
+        compressed = self.compress(chunks, threads=3, block_size=1024)
+        self.assertEqual(data, self.decompress(compressed))
+
+    def test_output_is_deterministic(self):
+        self.assertEqual(
+            self.compress(['foo' * 1000], block_size=100),
+            self.compress(['foo' * 1000], block_size=100))
+
+    def test_close_twice(self):
+        backing_file = StringIO()
+        writer = ParallelGzipWriter(backing_file)
+        writer.write('foo')
+        writer.close()
+        writer.close()
+        self.assertEqual('foo', self.decompress(backing_file.getvalue()))
+
+
+class CompressionTests(TestCaseWithFixtures):
+
+    def write_file(self, compression):
+        path = self.createTempFileAsFixture()
+        with open(path, 'wb') as fd:
+            with compressed_file(fd, compression) as compressed:
+                compressed.write('foo')
+        return path
+
+    def require_command(self, command):
+        if not has_command(command):
+            self.skipTest("%s is not installed" % command)
+
+    def test_detect_compression(self):
+        self.require_command('xz')
+        self.require_command('zstd')
+        for compression in ('gzip', 'xz', 'zstd', 'none'):
+            self.assertEqual(
+                compression, detect_compression(self.write_file(compression)))
+
+    def test_unknown_compression(self):
+        self.assertRaises(ValueError, get_writer, StringIO(), 'lzip')
+
+    def test_none(self):
+        with open(self.write_file('none')) as fd:
+            self.assertEqual('foo', fd.read())
+
+    def assertTarfileRoundTrips(self, compression):
+        path = self.createTempFileAsFixture()
+        source = self.createTempFileAsFixture()
+        with open(source, 'w') as fd:
+            fd.write('content')
+        with create_tarfile(path, compression) as tf:
+            tf.add(source, arcname='FORMAT')
+        self.assertEqual(compression, detect_compression(path))
+        tf = open_tarfile(path)
+        self.addCleanup(tf.close)
+        self.assertEqual('content', tf.extractfile('FORMAT').read())
+
+    def test_gzip_tarfile(self):
+        self.assertTarfileRoundTrips('gzip')
+
+    def test_xz_tarfile(self):
+        self.require_command('xz')
+        self.assertTarfileRoundTrips('xz')
+
+    def test_zstd_tarfile(self):
+        self.require_command('zstd')
+        self.assertTarfileRoundTrips('zstd')
+
+    def test_hwpack_filename(self):
+        hwpack = HardwarePack(Metadata("ahwpack", "4", "armel"), 'xz')
+        self.assertEqual("hwpack_ahwpack_4_armel.tar.xz", hwpack.filename())
+
+    def test_hwpack_to_file(self):
+        self.require_command('zstd')
+        hwpack = HardwarePack(Metadata("ahwpack", "4", "armel"), 'zstd')
+        path = self.createTempFileAsFixture()
+        with open(path, 'wb') as fd:
+            hwpack.to_file(fd)
+        tf = open_tarfile(path)
+        self.addCleanup(tf.close)
+        self.assertEqual('1.0\n', tf.extractfile('FORMAT').read())
+        self.assertTrue(os.path.getsize(path) > 0)
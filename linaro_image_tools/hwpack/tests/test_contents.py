@@ -0,0 +1,122 @@
+# Copyright (C) 2010, 2011, 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+import os
+
+from linaro_image_tools.hwpack.contents import (
+    Contents,
+    ContentsEntry,
+    REGULAR,
+    SYMLINK,
+)
+from linaro_image_tools.hwpack.deb_reader import DebReader
+from linaro_image_tools.hwpack.testing import make_deb
+from linaro_image_tools.testing import TestCaseWithFixtures
+from linaro_image_tools.tests.fixtures import CreateTempDirFixture
+
+
+class ContentsTests(TestCaseWithFixtures):
+
+    def setUp(self):
+        super(ContentsTests, self).setUp()
+        self.tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+
+    def make_contents(self, package, files):
+        path = make_deb(os.path.join(self.tempdir, package + '.deb'), files)
+        contents = Contents()
+        contents.add_deb(package, path)
+        return contents
+
+    def test_add_deb_indexes_files(self):
+        contents = self.make_contents(
+            'u-boot', [('usr/lib/u-boot/u-boot.img', 'u-boot')])
+        entry = contents.lookup('u-boot', 'usr/lib/u-boot/u-boot.img')
+        self.assertEqual(
+            ('usr/lib/u-boot/u-boot.img', 'u-boot', REGULAR, 6),
+            (entry.path, entry.package, entry.type, entry.size))
+
+    def test_add_deb_records_data_offset(self):
+        path = make_deb(os.path.join(self.tempdir, 'foo.deb'),
+                        [('a', 'first'), ('b', 'second')], compression='')
+        contents = Contents()
+        contents.add_deb('foo', path)
+        entry = contents.lookup('foo', 'b')
+        with DebReader(path) as reader:
+            data_offset = reader.members['data.tar'][0]
+        with open(path, 'rb') as deb:
+            deb.seek(data_offset + entry.offset)
+            self.assertEqual('second', deb.read(entry.size))
+
+    def test_lookup_missing_file(self):
+        contents = self.make_contents('foo', [('a', 'content')])
+        self.assertIs(None, contents.lookup('foo', 'b'))
+
+    def test_lookup_unknown_package(self):
+        contents = self.make_contents('foo', [('a', 'content')])
+        self.assertIs(None, contents.lookup('bar', 'a'))
+
+    def test_lookup_follows_symlinks(self):
+        contents = self.make_contents(
+            'foo', [('dir/real', 'content'), ('link@', 'dir/real'),
+                    ('dirlink@', '/dir')])
+        self.assertEqual('dir/real', contents.lookup('foo', 'link').path)
+        self.assertEqual('dir/real',
+                         contents.lookup('foo', '/dirlink/real').path)
+
+    def test_lookup_dangling_symlink(self):
+        contents = self.make_contents('foo', [('link@', 'nowhere')])
+        self.assertIs(None, contents.lookup('foo', 'link'))
+
+    def test_glob(self):
+        contents = self.make_contents(
+            'foo', [('boot/vmlinuz-3.8', 'kernel'),
+                    ('boot/sub/vmlinuz-3.9', 'kernel'),
+                    ('boot/vmlinuz@', 'vmlinuz-3.8')])
+        self.assertEqual(['boot/vmlinuz-3.8'],
+                         contents.glob('boot/vmlinuz*'))
+
+    def test_glob_in_package(self):
+        contents = self.make_contents('foo', [('boot/a.dtb', 'dtb')])
+        contents.update(self.make_contents('bar', [('boot/b.dtb', 'dtb')]))
+        self.assertEqual(['boot/a.dtb', 'boot/b.dtb'],
+                         contents.glob('boot/*.dtb'))
+        self.assertEqual(['boot/b.dtb'],
+                         contents.glob('boot/*.dtb', package='bar'))
+
+    def test_round_trip(self):
+        contents = Contents()
+        contents.add_entry(
+            ContentsEntry('boot/vmlinuz', 'linux', SYMLINK, 0, 0777, 512,
+                          'vmlinuz-3.8'))
+        contents.add_entry(
+            ContentsEntry('boot/vmlinuz-3.8', 'linux', REGULAR, 10, 0644,
+                          1024))
+        parsed = Contents.parse(str(contents))
+        self.assertEqual(contents.packages, parsed.packages)
+
+    def test_str_is_sorted_by_path(self):
+        contents = self.make_contents('foo', [('b', 'b'), ('a', 'a')])
+        self.assertEqual(
+            ['a', 'b'],
+            [line.split('\t')[0] for line in str(contents).splitlines()])
+
+    def test_remove_package(self):
+        contents = self.make_contents('foo', [('a', 'content')])
+        contents.remove_package('foo')
+        self.assertFalse(contents.has_package('foo'))
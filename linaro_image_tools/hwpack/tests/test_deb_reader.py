@@ -0,0 +1,152 @@
+# Copyright (C) 2010, 2011, 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+import os
+
+from linaro_image_tools.hwpack import deb_reader
+from linaro_image_tools.hwpack.deb_reader import DebReader, DebReaderError
+from linaro_image_tools.hwpack.testing import make_deb
+from linaro_image_tools.testing import TestCaseWithFixtures
+from linaro_image_tools.tests.fixtures import (
+    CreateTempDirFixture,
+    MockSomethingFixture,
+)
+
+
+class DebReaderTests(TestCaseWithFixtures):
+
+    def setUp(self):
+        super(DebReaderTests, self).setUp()
+        self.tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+
+    def make_reader(self, contents, **kwargs):
+        path = make_deb(
+            os.path.join(self.tempdir, 'package.deb'), contents, **kwargs)
+        reader = DebReader(path)
+        self.addCleanup(reader.close)
+        return reader
+
+    def count_reads(self):
+        """Count the passes made over the data part of the package."""
+        self.reads = 0
+        open_decompressed = deb_reader._open_decompressed
+
+        def counting_open_decompressed(fileobj, compression):
+            self.reads += 1
+            return open_decompressed(fileobj, compression)
+        self.useFixture(MockSomethingFixture(
+            deb_reader, '_open_decompressed', counting_open_decompressed))
+
+    def extract_file(self, reader, path):
+        dest = os.path.join(self.tempdir, 'extracted')
+        reader.extract_file(path, dest)
+        return open(dest).read()
+
+    def test_not_a_deb(self):
+        path = os.path.join(self.tempdir, 'package.deb')
+        with open(path, 'w') as fd:
+            fd.write('not a deb')
+        self.assertRaises(DebReaderError, DebReader, path)
+
+    def test_members(self):
+        reader = self.make_reader([])
+        self.assertEqual(
+            ['control.tar.gz', 'data.tar.gz', 'debian-binary'],
+            sorted(reader.members))
+
+    def test_control(self):
+        reader = self.make_reader(
+            [], control='Package: foo\nBuild-Info: yes\n')
+        self.assertEqual('yes', reader.control()['Build-Info'])
+
+    def test_list_files(self):
+        reader = self.make_reader([('usr/a', 'a'), ('usr/b@', 'a')])
+        self.assertEqual(['usr/a', 'usr/b'], reader.list_files())
+
+    def test_compressions(self):
+        for compression in ('gz', 'bz2', ''):
+            reader = self.make_reader(
+                [('usr/a', 'a' * 100)], compression=compression)
+            self.assertEqual('a' * 100, self.extract_file(reader, 'usr/a'))
+
+    def test_extract_file(self):
+        self.count_reads()
+        reader = self.make_reader(
+            [('usr/a', 'a'), ('usr/b', 'b'), ('usr/c', 'c')])
+        self.assertEqual('b', self.extract_file(reader, 'usr/b'))
+        self.assertEqual(1, self.reads)
+
+    def test_extract_file_follows_symlinks(self):
+        self.count_reads()
+        reader = self.make_reader(
+            [('usr/a', 'a'), ('usr/b@', 'a'), ('usr/c@', '/usr/b')])
+        self.assertEqual('a', self.extract_file(reader, 'usr/c'))
+        # The file linked to was passed before the links to it were found.
+        self.assertEqual(2, self.reads)
+
+    def test_extract_file_follows_symlinked_directories(self):
+        self.count_reads()
+        reader = self.make_reader(
+            [('usr/lib@', 'share'), ('usr/share/a', 'a')])
+        self.assertEqual('a', self.extract_file(reader, 'usr/lib/a'))
+        self.assertEqual(1, self.reads)
+
+    def test_extract_files(self):
+        self.count_reads()
+        reader = self.make_reader(
+            [('usr/a', 'a'), ('usr/b', 'b'), ('usr/c@', 'b')])
+        dests = [os.path.join(self.tempdir, name) for name in 'abc']
+        reader.extract_files(dict(zip(dests, ['usr/a', 'usr/b', 'usr/c'])))
+        self.assertEqual(
+            ['a', 'b', 'b'], [open(dest).read() for dest in dests])
+        # Only usr/c needed a second pass, as it links back to usr/b.
+        self.assertEqual(2, self.reads)
+
+    def test_extract_files_same_path(self):
+        self.count_reads()
+        reader = self.make_reader([('usr/a', 'a')])
+        dests = [os.path.join(self.tempdir, name) for name in 'xy']
+        reader.extract_files(dict.fromkeys(dests, 'usr/a'))
+        self.assertEqual(['a', 'a'], [open(dest).read() for dest in dests])
+        self.assertEqual(1, self.reads)
+
+    def test_extract_missing_file(self):
+        reader = self.make_reader([('usr/a', 'a')])
+        self.assertRaises(DebReaderError, self.extract_file, reader, 'usr/b')
+
+    def test_extract_file_symlink_loop(self):
+        reader = self.make_reader([('usr/a@', 'b'), ('usr/b@', 'a')])
+        self.assertRaises(DebReaderError, self.extract_file, reader, 'usr/a')
+
+    def test_extract_matching(self):
+        reader = self.make_reader(
+            [('usr/share/doc/a/BUILD-INFO.txt', 'a'),
+             ('usr/share/doc/b/copyright', 'b')])
+        self.assertEqual(
+            [os.path.join(self.tempdir, 'usr/share/doc/a/BUILD-INFO.txt')],
+            reader.extract_matching('usr/share/doc/*/BUILD-INFO.txt',
+                                    self.tempdir))
+
+    def test_extract_matching_stays_in_dest_dir(self):
+        dest_dir = os.path.join(self.tempdir, 'dest')
+        reader = self.make_reader([('../a', 'a'), ('usr/b', 'b')])
+        self.assertEqual(
+            [os.path.join(dest_dir, 'usr/b')],
+            reader.extract_matching('*', dest_dir))
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir, 'a')))
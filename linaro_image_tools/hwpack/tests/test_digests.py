@@ -0,0 +1,154 @@
+# Copyright (C) 2010, 2011, 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+from StringIO import StringIO
+import hashlib
+import json
+import os
+import tempfile
+
+from linaro_image_tools.hwpack import digests
+from linaro_image_tools.hwpack.digests import (
+    DigestCache,
+    hash_fileobj,
+)
+from linaro_image_tools.testing import TestCaseWithFixtures
+from linaro_image_tools.tests.fixtures import (
+    CreateTempDirFixture,
+    MockSomethingFixture,
+)
+
+
+class HashFileobjTests(TestCaseWithFixtures):
+
+    def test_hashes_in_one_pass(self):
+        data = 'x' * (digests.HASH_BLOCK_SIZE + 10)
+        self.assertEqual(
+            {'md5': hashlib.md5(data).hexdigest(),
+             'sha1': hashlib.sha1(data).hexdigest(),
+             'sha256': hashlib.sha256(data).hexdigest()},
+            hash_fileobj(StringIO(data), ('md5', 'sha1', 'sha256')))
+
+
+class DigestCacheTests(TestCaseWithFixtures):
+
+    def setUp(self):
+        super(DigestCacheTests, self).setUp()
+        self.tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        # Our files are not temporary, for the cache.
+        self.useFixture(MockSomethingFixture(
+            tempfile, 'tempdir', os.path.join(self.tempdir, 'tmp')))
+        self.cache_path = os.path.join(self.tempdir, 'digests.json')
+        self.path = self.make_file('file', 'content')
+
+    def make_file(self, name, content):
+        path = os.path.join(self.tempdir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fd:
+            fd.write(content)
+        return path
+
+    def cached_paths(self):
+        with open(self.cache_path) as fd:
+            return sorted(json.load(fd))
+
+    def count_hashes(self):
+        self.hashes = 0
+        real_hash_fileobj = digests.hash_fileobj
+
+        def counting_hash_fileobj(*args):
+            self.hashes += 1
+            return real_hash_fileobj(*args)
+        self.useFixture(MockSomethingFixture(
+            digests, 'hash_fileobj', counting_hash_fileobj))
+
+    def test_get_digests(self):
+        self.assertEqual(
+            {'md5': hashlib.md5('content').hexdigest(),
+             'sha256': hashlib.sha256('content').hexdigest()},
+            DigestCache(self.cache_path).get_digests(self.path))
+
+    def test_unchanged_file_is_not_hashed_again(self):
+        self.count_hashes()
+        DigestCache(self.cache_path).get_digests(self.path)
+        digests = DigestCache(self.cache_path).get_digests(self.path)
+        self.assertEqual(1, self.hashes)
+        self.assertEqual(hashlib.md5('content').hexdigest(), digests['md5'])
+
+    def test_cache_hit_does_not_write(self):
+        DigestCache(self.cache_path).get_digests(self.path)
+        dumps = []
+        self.useFixture(MockSomethingFixture(
+            json, 'dump', lambda *args, **kwargs: dumps.append(args)))
+        DigestCache(self.cache_path).get_digests(self.path)
+        self.assertEqual([], dumps)
+
+    def test_forgets_files_gone_or_changed(self):
+        cache = DigestCache(self.cache_path)
+        gone = self.make_file('gone', 'gone')
+        changed = self.make_file('changed', 'changed')
+        for path in (self.path, gone, changed):
+            cache.get_digests(path)
+        os.unlink(gone)
+        with open(changed, 'a') as fd:
+            fd.write('more')
+        cache.get_digests(self.make_file('new', 'new'))
+        self.assertEqual(
+            sorted([self.path, os.path.join(self.tempdir, 'new')]),
+            self.cached_paths())
+
+    def test_temporary_files_only_kept_in_memory(self):
+        self.count_hashes()
+        cache = DigestCache(self.cache_path)
+        cache.get_digests(self.path)
+        path = self.make_file('tmp/package.deb', 'package')
+        cache.get_digests(path)
+        cache.get_digests(path)
+        self.assertEqual(2, self.hashes)
+        self.assertEqual([self.path], self.cached_paths())
+
+    def test_changed_file_is_hashed_again(self):
+        self.count_hashes()
+        DigestCache(self.cache_path).get_digests(self.path)
+        with open(self.path, 'w') as fd:
+            fd.write('other content')
+        digests = DigestCache(self.cache_path).get_digests(self.path)
+        self.assertEqual(2, self.hashes)
+        self.assertEqual(
+            hashlib.md5('other content').hexdigest(), digests['md5'])
+
+    def test_new_algorithm_is_hashed(self):
+        cache = DigestCache()
+        cache.get_digests(self.path)
+        self.assertEqual(
+            hashlib.sha1('content').hexdigest(),
+            cache.get_digests(self.path, ('sha1',))['sha1'])
+
+    def test_broken_cache_is_ignored(self):
+        with open(self.cache_path, 'w') as fd:
+            fd.write('garbage')
+        digests = DigestCache(self.cache_path).get_digests(self.path)
+        self.assertEqual(hashlib.md5('content').hexdigest(), digests['md5'])
+
+    def test_reads_fileobj(self):
+        with open(self.path, 'rb') as fileobj:
+            fileobj.read()
+            digests = DigestCache().get_digests(self.path, fileobj=fileobj)
+        self.assertEqual(hashlib.md5('content').hexdigest(), digests['md5'])
@@ -0,0 +1,116 @@
+# Copyright (C) 2010, 2011, 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+import os
+
+from linaro_image_tools.hwpack.fingerprint import (
+    compute_fingerprint,
+    get_build_mtime,
+    read_fingerprint,
+    remove_fingerprint,
+    write_fingerprint,
+)
+from linaro_image_tools.hwpack.testing import DummyFetchedPackage
+from linaro_image_tools.testing import TestCaseWithFixtures
+from linaro_image_tools.tests.fixtures import (
+    CreateTempDirFixture,
+    MockSomethingFixture,
+)
+
+
+class ComputeFingerprintTests(TestCaseWithFixtures):
+
+    def fingerprint(self, config_text="format: 3.0\n", version="1",
+                    architecture="armel", packages=None, local_packages=(),
+                    options=None):
+        if packages is None:
+            packages = [DummyFetchedPackage("foo", "1.0")]
+        if options is None:
+            options = {'compression': 'gzip'}
+        return compute_fingerprint(config_text, version, architecture,
+                                   packages, local_packages, options)
+
+    def test_same_inputs(self):
+        self.assertEqual(self.fingerprint(), self.fingerprint())
+
+    def test_package_order_ignored(self):
+        foo = DummyFetchedPackage("foo", "1.0")
+        bar = DummyFetchedPackage("bar", "1.0")
+        self.assertEqual(self.fingerprint(packages=[foo, bar]),
+                         self.fingerprint(packages=[bar, foo]))
+
+    def test_changes_with_inputs(self):
+        fingerprint = self.fingerprint()
+        self.assertNotEqual(
+            fingerprint, self.fingerprint(config_text="format: 2.0\n"))
+        self.assertNotEqual(fingerprint, self.fingerprint(version="2"))
+        self.assertNotEqual(
+            fingerprint, self.fingerprint(architecture="armhf"))
+        self.assertNotEqual(
+            fingerprint, self.fingerprint(
+                packages=[DummyFetchedPackage("foo", "1.1")]))
+        self.assertNotEqual(
+            fingerprint, self.fingerprint(
+                packages=[DummyFetchedPackage("foo", "1.0", content="x")]))
+        self.assertNotEqual(
+            fingerprint, self.fingerprint(
+                local_packages=[DummyFetchedPackage("bar", "1.0")]))
+        self.assertNotEqual(
+            fingerprint, self.fingerprint(options={'compression': 'xz'}))
+
+
+class GetBuildMtimeTests(TestCaseWithFixtures):
+
+    def test_default(self):
+        self.useFixture(MockSomethingFixture(os, 'environ', {}))
+        self.assertEqual(0, get_build_mtime())
+
+    def test_source_date_epoch(self):
+        self.useFixture(MockSomethingFixture(
+            os, 'environ', {'SOURCE_DATE_EPOCH': '1234'}))
+        self.assertEqual(1234, get_build_mtime())
+
+
+class FingerprintFileTests(TestCaseWithFixtures):
+
+    def setUp(self):
+        super(FingerprintFileTests, self).setUp()
+        tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        self.out_name = os.path.join(tempdir, 'hwpack.tar.gz')
+
+    def test_write_and_read(self):
+        open(self.out_name, 'w').close()
+        write_fingerprint(self.out_name, 'abc')
+        self.assertEqual('abc', read_fingerprint(self.out_name))
+
+    def test_read_missing(self):
+        open(self.out_name, 'w').close()
+        self.assertIs(None, read_fingerprint(self.out_name))
+
+    def test_read_without_hwpack(self):
+        write_fingerprint(self.out_name, 'abc')
+        self.assertIs(None, read_fingerprint(self.out_name))
+
+    def test_remove(self):
+        open(self.out_name, 'w').close()
+        write_fingerprint(self.out_name, 'abc')
+        remove_fingerprint(self.out_name)
+        self.assertIs(None, read_fingerprint(self.out_name))
+        # Removing it again is fine.
+        remove_fingerprint(self.out_name)
@@ -20,17 +20,26 @@
 # USA.
 
 from StringIO import StringIO
+import os
 import re
+import shutil
 import tarfile
+import tempfile
 
 from testtools import TestCase
 from testtools.matchers import Equals, MismatchError
 
+from linaro_image_tools.hwpack.better_tarfile import (
+    INDEX_FILENAME,
+    read_index,
+)
+from linaro_image_tools.hwpack.contents import Contents
 from linaro_image_tools.hwpack.hardwarepack import HardwarePack, Metadata
 from linaro_image_tools.hwpack.packages import get_packages_file
 from linaro_image_tools.hwpack.testing import (
     DummyFetchedPackage,
     HardwarePackHasFile,
+    make_deb,
     MatchesAsPackagesFile,
     MatchesAsPackageContent,
     MatchesPackageRelationshipList,
@@ -41,6 +50,7 @@ from linaro_image_tools.hwpack.hardwarepack_format import (
     HardwarePackFormatV1,
     HardwarePackFormatV2,
     HardwarePackFormatV3,
+    INDEXED_FORMAT,
 )
 
 
@@ -465,6 +475,83 @@ class HardwarePackTests(TestCase):
             HardwarePackHasFile("pkgs/%s" % package2.filename,
                                 content=package2.content.read()))
 
+    def test_adds_files(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, "u-boot.img")
+        with open(path, "w") as fd:
+            fd.write("u-boot")
+        os.chmod(path, 0755)
+        hwpack = HardwarePack(self.metadata)
+        hwpack.add_file("u_boot", path)
+        tf = self.get_tarfile(hwpack)
+        self.assertThat(
+            tf,
+            HardwarePackHasFile("u_boot/u-boot.img", content="u-boot",
+                                mode=0755))
+
+    def get_indexed_hwpack(self):
+        metadata = Metadata("ahwpack", "4", "armel",
+                            format=HardwarePackFormatV2())
+        metadata.add_v2_config()
+        return HardwarePack(metadata, compression='none', indexed=True)
+
+    def test_indexed_requires_v2_metadata(self):
+        self.assertRaises(
+            ValueError, HardwarePack, self.metadata, compression='none',
+            indexed=True)
+
+    def test_indexed_can_not_be_compressed(self):
+        metadata = Metadata("ahwpack", "4", "armel",
+                            format=HardwarePackFormatV2())
+        self.assertRaises(ValueError, HardwarePack, metadata, indexed=True)
+
+    def test_indexed_layout(self):
+        hwpack = self.get_indexed_hwpack()
+        fileobj = StringIO()
+        hwpack.to_file(fileobj)
+        fileobj.seek(0)
+        tf = tarfile.open(mode="r:", fileobj=fileobj)
+        self.addCleanup(tf.close)
+        names = tf.getnames()
+        self.assertEqual(["FORMAT", "metadata"], names[:2])
+        self.assertEqual(INDEX_FILENAME, names[-1])
+        self.assertEqual(INDEXED_FORMAT + "\n",
+                         tf.extractfile("FORMAT").read())
+
+    def test_indexed_index_lists_files(self):
+        hwpack = self.get_indexed_hwpack()
+        package = DummyFetchedPackage("foo", "1.1")
+        hwpack.add_packages([package])
+        fileobj = StringIO()
+        hwpack.to_file(fileobj)
+        entries = dict((entry['name'], entry)
+                       for entry in read_index(fileobj))
+        entry = entries["pkgs/%s" % package.filename]
+        fileobj.seek(entry['offset'])
+        self.assertEqual(package.content.read(),
+                         fileobj.read(entry['size']))
+
+    def test_no_contents_by_default(self):
+        hwpack = HardwarePack(self.metadata)
+        tf = self.get_tarfile(hwpack)
+        self.assertThat(tf, Not(HardwarePackHasFile("pkgs/Contents")))
+
+    def test_add_contents_indexes_packages(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        deb_path = make_deb(os.path.join(tempdir, "foo_1.1_all.deb"),
+                            [("boot/vmlinuz", "kernel")])
+        package = DummyFetchedPackage(
+            "foo", "1.1", content=open(deb_path).read())
+        package._file_path = deb_path
+        hwpack = HardwarePack(self.metadata)
+        hwpack.add_packages([package])
+        hwpack.add_contents()
+        tf = self.get_tarfile(hwpack)
+        contents = Contents.parse(tf.extractfile("pkgs/Contents").read())
+        self.assertEqual(["boot/vmlinuz"], contents.glob("boot/*", "foo"))
+
     def test_add_packages_without_content_leaves_out_debs(self):
         package1 = DummyFetchedPackage("foo", "1.1", no_content=True)
         hwpack = HardwarePack(self.metadata)
@@ -615,6 +702,36 @@ class HardwarePackTests(TestCase):
             tf,
             HardwarePackHasFile("sources.list.d.gpg", type=tarfile.DIRTYPE))
 
+    def test_creates_FINGERPRINT_file(self):
+        hwpack = HardwarePack(self.metadata)
+        hwpack.fingerprint = "abc"
+        tf = self.get_tarfile(hwpack)
+        self.assertThat(
+            tf, HardwarePackHasFile("FINGERPRINT", content="abc\n"))
+
+    def test_no_FINGERPRINT_file_without_fingerprint(self):
+        hwpack = HardwarePack(self.metadata)
+        tf = self.get_tarfile(hwpack)
+        self.assertNotIn("FINGERPRINT", tf.getnames())
+
+    def test_mtime(self):
+        hwpack = HardwarePack(self.metadata, mtime=1234)
+        hwpack.add_packages([DummyFetchedPackage("foo", "1.1")])
+        tf = self.get_tarfile(hwpack)
+        self.assertEqual(
+            set([1234]), set(member.mtime for member in tf.getmembers()))
+
+    def test_reproducible_with_mtime(self):
+        def to_string():
+            hwpack = HardwarePack(self.metadata, mtime=1234)
+            hwpack.add_packages([DummyFetchedPackage("foo", "1.1")])
+            hwpack.add_apt_sources({"a": "http://a/ precise main",
+                                    "b": "http://b/ precise main"})
+            fileobj = StringIO()
+            hwpack.to_file(fileobj)
+            return fileobj.getvalue()
+        self.assertEqual(to_string(), to_string())
+
     def test_password_removed_from_urls(self):
         hwpack = HardwarePack(self.metadata)
 
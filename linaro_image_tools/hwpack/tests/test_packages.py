@@ -33,6 +33,9 @@ from debian import deb822
 from testtools import TestCase
 from testtools.matchers import Equals
 
+from linaro_image_tools.hwpack import digests
+from linaro_image_tools.hwpack.archive_cache import ArchiveCache
+from linaro_image_tools.hwpack.downloader import Downloader
 from linaro_image_tools.hwpack.packages import (
     DependencyNotSatisfied,
     DummyProgress,
@@ -44,14 +47,20 @@ from linaro_image_tools.hwpack.packages import (
     PackageMaker,
     stringify_relationship,
     TemporaryDirectoryManager,
+    acquire_packages,
 )
 from linaro_image_tools.hwpack.testing import (
     AptSourceFixture,
     ContextManagerFixture,
     DummyFetchedPackage,
     MatchesPackage,
+    make_deb,
 )
 from linaro_image_tools.testing import TestCaseWithFixtures
+from linaro_image_tools.tests.fixtures import (
+    CreateTempDirFixture,
+    MockSomethingFixture,
+)
 
 
 class GetPackagesFileTests(TestCase):
@@ -785,6 +794,21 @@ class FetchedPackageTests(TestCaseWithFixtures):
         created_package = FetchedPackage.from_deb(deb_file_path)
         self.assertEqual(target_package, created_package)
 
+    def test_from_deb_does_not_hash_unchanged_package_again(self):
+        tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        deb_file_path = make_deb(
+            os.path.join(tempdir, 'foo_1.0_all.deb'),
+            control='Package: foo\nVersion: 1.0\nArchitecture: all\n')
+        target_package = DummyFetchedPackage(
+            "foo", "1.0", content=open(deb_file_path).read())
+        self.assertEqual(
+            target_package, FetchedPackage.from_deb(deb_file_path))
+        self.useFixture(MockSomethingFixture(
+            digests, 'hash_fileobj',
+            lambda *args: self.fail('package hashed again')))
+        self.assertEqual(
+            target_package, FetchedPackage.from_deb(deb_file_path))
+
     def create_package_and_assert_from_deb_translates_relationships(
             self, relationships):
         maker = PackageMaker()
@@ -903,10 +927,76 @@ class AptCacheTests(TestCaseWithFixtures):
         self.addCleanup(cache.cleanup)
         cache.prepare()
         self.assertEqual(
-            'Apt {\nArchitecture "arch";\nInstall-Recommends "true";\n}\n',
+            'Apt {\nArchitecture "arch";\nInstall-Recommends "true";\n}\n'
+            'Dir::State::Lists "%s/";\n'
+            'Dir::Cache::srcpkgcache "%s/var/cache/apt/srcpkgcache.bin";\n'
+            % (cache._lists_dir(), cache.tempdir),
             open(os.path.join(
                 cache.tempdir, "etc", "apt", "apt.conf")).read())
 
+    def test_prepare_with_lists_cache_dir_keeps_lists_there(self):
+        lists_cache_dir = self.useFixture(
+            CreateTempDirFixture()).get_temp_dir()
+        cache = IsolatedAptCache([], lists_cache_dir=lists_cache_dir)
+        self.addCleanup(cache.cleanup)
+        cache.prepare()
+        lists_dir = cache._lists_dir()
+        self.assertTrue(lists_dir.startswith(lists_cache_dir))
+        self.assertTrue(os.path.isdir(os.path.join(lists_dir, "partial")))
+        self.assertIn(
+            'Dir::State::Lists "%s/";' % lists_dir,
+            open(os.path.join(cache.tempdir, "etc", "apt", "apt.conf")).read())
+
+    def test_lists_dir_ignores_local_sources(self):
+        lists_cache_dir = self.useFixture(
+            CreateTempDirFixture()).get_temp_dir()
+        remote = "http://ports.example.com/ubuntu precise main"
+        cache1 = IsolatedAptCache(
+            [remote, "file:/tmp/a ./"], architecture="armel",
+            lists_cache_dir=lists_cache_dir)
+        cache2 = IsolatedAptCache(
+            ["file:/tmp/b ./", remote], architecture="armel",
+            lists_cache_dir=lists_cache_dir)
+        cache3 = IsolatedAptCache(
+            [remote], architecture="armhf", lists_cache_dir=lists_cache_dir)
+        self.assertEqual(cache1._lists_dir(), cache2._lists_dir())
+        self.assertNotEqual(cache1._lists_dir(), cache3._lists_dir())
+
+    def test_lists_state_tracks_local_indexes(self):
+        source = self.useFixture(AptSourceFixture([]))
+        cache = IsolatedAptCache([source.sources_entry])
+        state = cache._lists_state()
+        self.assertEqual(state, cache._lists_state())
+        packages_path = os.path.join(source.rootdir, "Packages")
+        os.utime(packages_path, (0, 0))
+        self.assertNotEqual(state, cache._lists_state())
+
+    def test_lists_state_of_remote_sources(self):
+        cache = IsolatedAptCache(
+            ["http://ports.example.com/ubuntu precise main"])
+        self.assertEqual(None, cache._lists_state())
+
+    def test_update_lists_skipped_for_unchanged_local_sources(self):
+        lists_cache_dir = self.useFixture(
+            CreateTempDirFixture()).get_temp_dir()
+        source = self.useFixture(AptSourceFixture([]))
+        updates = []
+
+        class RecordingCache(object):
+            def update(self):
+                updates.append(True)
+
+        cache = IsolatedAptCache([source.sources_entry],
+                                 lists_cache_dir=lists_cache_dir)
+        os.makedirs(cache._lists_dir())
+        cache.cache = RecordingCache()
+        cache._update_lists()
+        cache._update_lists()
+        self.assertEqual(1, len(updates))
+        os.utime(os.path.join(source.rootdir, "Packages"), (0, 0))
+        cache._update_lists()
+        self.assertEqual(2, len(updates))
+
     def test_prepare_with_prefer_label_creates_etc_apt_preferences(self):
         label_text = 'random-label'
         cache = IsolatedAptCache([], prefer_label=label_text)
@@ -963,6 +1053,36 @@ class AptCacheTests(TestCaseWithFixtures):
         self.assertEqual("deb %s\n" % source1.sources_entry, sources_list)
 
 
+class AcquirePackagesTests(TestCaseWithFixtures):
+
+    def test_uses_downloader(self):
+        dummy = DummyFetchedPackage("foo", "1.0")
+        package = FetchedPackage(
+            dummy.name, dummy.version, dummy.filename, dummy.size, dummy.md5,
+            dummy.sha256, dummy.architecture)
+        tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        path = os.path.join(tempdir, "source.deb")
+        with open(path, 'w') as f:
+            f.write(dummy.content.read())
+        downloader = Downloader()
+        downloads = []
+
+        def download(to_download):
+            downloads.extend(to_download)
+            Downloader.download(downloader, to_download)
+        self.useFixture(MockSomethingFixture(downloader, 'download', download))
+        destfile = os.path.join(tempdir, package.filename)
+        acquire_packages(
+            [(package, "file:" + path, destfile)], downloader=downloader)
+        self.assertEqual(
+            [("file:" + path, destfile, package.size, package.sha256,
+              package.md5)],
+            [(d.uri, d.destfile, d.size, d.sha256, d.md5)
+             for d in downloads])
+        self.assertEqual(destfile, package.filepath)
+        self.assertEqual(dummy.content.read(), package.content.read())
+
+
 class PackageFetcherTests(TestCaseWithFixtures):
 
     def test_context_manager(self):
@@ -1010,6 +1130,25 @@ class PackageFetcherTests(TestCaseWithFixtures):
         fetcher = self.get_fetcher([source])
         self.assertEqual(1, len(fetcher.fetch_packages(["foo"])))
 
+    def test_fetch_packages_uses_archive_cache(self):
+        available_package = DummyFetchedPackage("foo", "1.0")
+        source = self.useFixture(AptSourceFixture([available_package]))
+        cache_dir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        archive_cache = ArchiveCache(cache_dir)
+        for i in range(2):
+            fetcher = PackageFetcher(
+                [source.sources_entry], archive_cache=archive_cache)
+            self.addCleanup(fetcher.cleanup)
+            fetcher.prepare()
+            fetched = fetcher.fetch_packages(["foo"])
+            self.assertEqual(available_package, fetched[0])
+            self.assertEqual(
+                available_package.content.read(), fetched[0].content.read())
+            # The second time, the package is not downloaded.
+            self.useFixture(MockSomethingFixture(
+                apt_pkg, 'AcquireFile',
+                lambda *args, **kwargs: self.fail('package downloaded')))
+
     def test_fetch_packages_fetches_correct_package(self):
         available_package = DummyFetchedPackage("foo", "1.0")
         source = self.useFixture(AptSourceFixture([available_package]))
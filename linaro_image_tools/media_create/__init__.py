@@ -25,6 +25,7 @@ from linaro_image_tools import cmd_runner
 from linaro_image_tools.media_create.boards import board_configs
 from linaro_image_tools.media_create.android_boards import (
     android_board_configs)
+from linaro_image_tools.media_create.rootfs_cache import DEFAULT_MAX_SIZE
 from linaro_image_tools.__version__ import __version__
 from linaro_image_tools.hwpack.hwpack_fields import (
     DEFAULT_BOOTLOADER
@@ -74,6 +75,22 @@ def add_common_options(parser):
     parser.add_argument(
         '--extra-boot-args-file', dest='extra_boot_args_file',
         required=False, help=('File containing extra boot arguments.'))
+    parser.add_argument(
+        '--unpack-threads', dest='unpack_threads', type=int, default=0,
+        help=('Number of threads to decompress tarballs with, when a '
+              'multi-threaded decompressor is available (defaults to one '
+              'per CPU).'))
+    parser.add_argument(
+        '--root-helper', dest='root_helper', action='store_true',
+        help=('Get root privileges once, for a helper process which then '
+              'runs all the commands that need them, instead of using sudo '
+              'for every one of those commands.'))
+    parser.add_argument(
+        '--trace', dest='trace', metavar='FILE',
+        help=('Record every command run, and how long it took, in FILE '
+              '(in the Chrome trace event format if FILE ends in .json, '
+              'as JSON lines otherwise) and print a summary of the time '
+              'spent on each command at exit.'))
     parser.add_argument("--debug", action="store_true")
 
 
@@ -165,6 +182,18 @@ def get_args_parser():
         '--align-boot-part', dest='should_align_boot_part',
         action='store_true',
         help='Align boot partition too (might break older x-loaders).')
+    parser.add_argument(
+        '--mount-free', dest='mount_free', action='store_true',
+        help=('Build the boot and root filesystems as standalone images and '
+              'write them into the image file, without using loopback '
+              'devices or mounting anything; use with --image_file only.'))
+    parser.add_argument(
+        '--unpack-to-partition', dest='unpack_to_partition',
+        action='store_true',
+        help=('Partition the media first and unpack the rootfs straight onto '
+              'the root partition instead of going through a temporary '
+              'directory; hardware packs are then installed on the root '
+              'partition itself.'))
     parser.add_argument(
         '--nocheck-mmc', dest='nocheck_mmc',
         action='store_true',
@@ -180,6 +209,22 @@ def get_args_parser():
         help="Select a DTB file from a hardware pack that contains more "
              "than one. If not specified, it will default to the first "
              "entry in 'dtb_files' list.")
+    parser.add_argument(
+        '--rootfs-cache', metavar='DIR',
+        help=('Keep the root filesystems with the hardware packs installed '
+              'in DIR, and reuse them when creating another image out of '
+              'the same binary tarball and hardware packs.'))
+    parser.add_argument(
+        '--rootfs-cache-size', type=int, metavar='MB',
+        default=DEFAULT_MAX_SIZE,
+        help=('The maximum size of the --rootfs-cache, in MiB (default: '
+              '%(default)s). The least recently used root filesystems are '
+              'removed when it gets bigger.'))
+    parser.add_argument(
+        '--profile', metavar='FILE',
+        help=('Time each stage of creating the image, writing a report of '
+              'the wall time, CPU time, peak memory and I/O of each stage '
+              'to FILE (as JSON) and to stderr (as a table).'))
 
     add_common_options(parser)
     return parser
@@ -174,6 +174,7 @@ class BoardConfig(object):
         self.bootfs_type = 'vfat'
         self.fdt_high = '0xffffffff'
         self.hardwarepack_handler = None
+        self.hwpack_contents = None
         self.hwpack_format = None
         self.initrd_addr = None
         self.initrd_high = '0xffffffff'
@@ -423,6 +424,7 @@ class BoardConfig(object):
 
             self.bootloader_copy_files = self.hardwarepack_handler.get_field(
                 "bootloader_copy_files")[0]
+            self.hwpack_contents = self.hardwarepack_handler.get_contents()
 
             # XXX: no reference in hwpackV3 format of these fields, double
             # check if they can be dropped when killing v1.
@@ -710,8 +712,7 @@ class BoardConfig(object):
                         if not os.path.exists(to_dir):
                             cmd_runner.run(["mkdir", "-p", to_dir],
                                            as_root=True).wait()
-                        dtb = _get_file_matching(os.path.join(search_dir,
-                                                              from_file))
+                        dtb = self._find_file(search_dir, from_file)
                         if not dtb:
                             logger.warn('Could not find a valid dtb file, '
                                         'skipping it.')
@@ -821,6 +822,7 @@ class BoardConfig(object):
         cmd_runner.run(['mkdir', '-p', boot_disk]).wait()
         with partition_mounted(boot_partition, boot_disk):
             with self.hardwarepack_handler:
+                self.check_copy_files()
                 if self.bootloader_file_in_boot_part:
                     # <legacy v1 support>
                     if self.bootloader_flavor is not None:
@@ -854,6 +856,22 @@ class BoardConfig(object):
                 bootloader_parts_dir, is_live, is_lowmem, consoles, chroot_dir,
                 rootfs_id, boot_disk, boot_device_or_file)
 
+    def check_copy_files(self):
+        """Fail if a file of the copy_files field is missing from its package.
+
+        Only the Contents index of the hwpacks is looked at, so that missing
+        files are reported before anything is extracted.
+        """
+        if self.bootloader_copy_files is None:
+            return
+
+        for source_package, file_list in \
+                self.bootloader_copy_files.iteritems():
+            for file_info in file_list:
+                for source_path in file_info:
+                    self.hardwarepack_handler.check_file_in_package(
+                        source_path, source_package)
+
     def copy_files(self, boot_disk):
         """Handle the copy_files metadata field."""
 
@@ -911,21 +929,40 @@ class BoardConfig(object):
             "No kernel found matching %s for flavors %s" % (
                 KERNEL_GLOB, " ".join(self.kernel_flavors)))
 
+    def _find_file(self, root, pattern):
+        """Return the file under root whose path matches the given glob.
+
+        The files of the packages of the hwpacks installed onto root are
+        looked up in their Contents index, without searching root; other
+        files, like an initrd generated when installing the kernel, are
+        globbed for. See _get_file_matching().
+        """
+        if self.hwpack_contents is not None:
+            files = [os.path.join(root, path)
+                     for path in self.hwpack_contents.glob(pattern)]
+            files = [path for path in files if os.path.exists(path)]
+            if len(files) == 1:
+                return files[0]
+            elif len(files) > 1:
+                raise ValueError("Too many files matching '%s' found." %
+                                 os.path.join(root, pattern))
+        return _get_file_matching(os.path.join(root, pattern))
+
     def _get_kflavor_files_v2(self, path):
         kernel = initrd = dtb = None
 
         if self.vmlinuz:
-            kernel = _get_file_matching(os.path.join(path, self.vmlinuz))
+            kernel = self._find_file(path, self.vmlinuz)
         if not self.vmlinuz or not kernel:
             raise ValueError("Unable to find a valid kernel image.")
 
         if self.initrd:
-            initrd = _get_file_matching(os.path.join(path, self.initrd))
+            initrd = self._find_file(path, self.initrd)
         if not self.initrd or not initrd:
             logger.warn("Could not find a valid initrd, skipping uInitrd.")
 
         if self.dtb_file:
-            dtb = _get_file_matching(os.path.join(path, self.dtb_file))
+            dtb = self._find_file(path, self.dtb_file)
         if not self.dtb_file or not dtb:
             logger.warn("Could not find a valid dtb file from dtb_file, "
                         "trying dtb_files...")
@@ -944,7 +981,7 @@ class BoardConfig(object):
                         # the file.
                         if not to_file:
                             to_file = os.path.basename(from_file)
-                        dtb = _get_file_matching(os.path.join(path, from_file))
+                        dtb = self._find_file(path, from_file)
         if not self.dtb_files and not dtb:
             logger.warn("Could not find a valid dtb file, skipping it.")
 
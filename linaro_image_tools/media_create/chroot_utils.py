@@ -150,7 +150,9 @@ def install_hwpack(rootfs_dir, hwpack_file, extract_kpkgs, hwpack_force_yes,
         args.append('/%s' % hwpack_basename)
         chroot_dir = rootfs_dir
 
-    cmd_runner.run(args, as_root=True, chroot=chroot_dir).wait()
+    # It may ask whether to install unauthenticated packages.
+    cmd_runner.run(
+        args, as_root=True, chroot=chroot_dir, interactive=True).wait()
     print "-" * 60
 
 
@@ -0,0 +1,512 @@
+# Copyright (C) 2010, 2011 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Read and write MBR and GPT partition tables without external tools.
+
+The layouts are described with the same sfdisk and sgdisk command strings
+the board configs generate (see BoardConfig.get_sfdisk_cmd() and
+BoardConfig.get_sgdisk_cmd()), and are interpreted the way sfdisk -uS and
+sgdisk interpret them.
+"""
+
+from binascii import crc32
+import os
+import struct
+import uuid
+
+SECTOR_SIZE = 512  # bytes
+
+MBR_SIGNATURE = '\x55\xaa'
+# Offset of the partition entries in the MBR and in EBRs.
+MBR_TABLE_OFFSET = 446
+MBR_BOOTABLE = 0x80
+MBR_PRIMARY_PARTITIONS = 4
+MBR_EXTENDED_TYPES = (0x05, 0x0F, 0x85)
+MBR_GPT_PROTECTIVE_TYPE = 0xEE
+# Partition types as abbreviated in sfdisk input.
+SFDISK_TYPES = {
+    '': 0x83,
+    'L': 0x83,
+    'S': 0x82,
+    'E': 0x05,
+    'X': 0x85,
+}
+
+GPT_SIGNATURE = 'EFI PART'
+GPT_REVISION = 0x00010000
+GPT_HEADER_SIZE = 92
+GPT_ENTRIES = 128
+GPT_ENTRY_SIZE = 128
+GPT_ENTRIES_SECTORS = GPT_ENTRIES * GPT_ENTRY_SIZE / SECTOR_SIZE
+# sgdisk aligns the start of partitions to this many sectors by default.
+GPT_ALIGNMENT_S = 2048
+GPT_ESP_TYPE = 'C12A7328-F81F-11D2-BA4B-00A0C93EC93B'
+# Partition type GUIDs for the sgdisk type codes we use.
+SGDISK_TYPES = {
+    '0700': 'EBD0A0A2-B9E5-4433-87C0-68B6B72699C7',
+    '8300': '0FC63DAF-8483-4772-8E79-3D69D8477DE4',
+    'DA00': '9E1A2D38-C612-4316-AA26-8B49521E5A8B',
+    'EF00': GPT_ESP_TYPE,
+}
+
+
+class PartitionTableError(Exception):
+    """Raised when a partition table can't be created or read."""
+
+
+class Partition(object):
+    """A partition, with its start and length in sectors.
+
+    :ivar type_id: The MBR partition type as an integer, or the GPT
+        partition type GUID as an upper case string.
+    :ivar logical: Whether this is a logical partition inside an MBR
+        extended partition.
+    """
+
+    def __init__(self, start, length, type_id, bootable=False,
+                 logical=False):
+        self.start = start
+        self.length = length
+        self.type_id = type_id
+        self.bootable = bootable
+        self.logical = logical
+
+    @property
+    def end(self):
+        return self.start + self.length - 1
+
+    @property
+    def offset(self):
+        return self.start * SECTOR_SIZE
+
+    @property
+    def size(self):
+        return self.length * SECTOR_SIZE
+
+    @property
+    def is_extended(self):
+        return self.type_id in MBR_EXTENDED_TYPES
+
+    def __eq__(self, other):
+        return (isinstance(other, Partition) and
+                (self.start, self.length, self.type_id, self.bootable,
+                 self.logical) ==
+                (other.start, other.length, other.type_id, other.bootable,
+                 other.logical))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Partition(%d, %d, %r, bootable=%r, logical=%r)' % (
+            self.start, self.length, self.type_id, self.bootable,
+            self.logical)
+
+
+def _parse_sfdisk_type(type_field):
+    type_field = type_field.strip()
+    if type_field.upper() in SFDISK_TYPES:
+        return SFDISK_TYPES[type_field.upper()]
+    try:
+        return int(type_field, 16)
+    except ValueError:
+        raise PartitionTableError(
+            "Unknown partition type: '%s'" % type_field)
+
+
+def _check_partition(partition, first, last):
+    if partition.length <= 0:
+        raise PartitionTableError("Empty partition: %r" % partition)
+    if partition.start < first or partition.end > last:
+        raise PartitionTableError(
+            "Partition %r doesn't fit between sectors %d and %d" % (
+                partition, first, last))
+
+
+def parse_sfdisk_cmd(commands, total_sectors):
+    """Return the partitions described by the given sfdisk commands.
+
+    Each line is 'start,size,type,bootable' in sectors, as given to
+    sfdisk -uS. The first four lines are primary partitions and any further
+    lines are logical partitions inside the extended one. Every logical
+    partition is preceded by an EBR; when there's no free sector for it right
+    before the partition, the partition starts one sector later but keeps its
+    end.
+
+    :param total_sectors: The size of the media, in sectors.
+    :return: A list of Partition objects, with the primary (including
+        extended) partitions first, followed by the logical ones.
+    """
+    primaries = []
+    logicals = []
+    extended = None
+    next_start = 1
+    for line in commands.strip().splitlines():
+        fields = (line.split(',') + ['', '', ''])[:4]
+        start_field, size_field, type_field, boot_field = [
+            field.strip() for field in fields]
+        type_id = _parse_sfdisk_type(type_field)
+        bootable = boot_field == '*'
+        is_logical = len(primaries) == MBR_PRIMARY_PARTITIONS
+        if is_logical:
+            if extended is None:
+                raise PartitionTableError(
+                    "Logical partitions require an extended partition")
+            first, last = extended.start, extended.end
+        else:
+            first, last = 1, total_sectors - 1
+        if start_field:
+            start = int(start_field)
+        else:
+            start = next_start
+        if size_field in ('', '-'):
+            length = last - start + 1
+        else:
+            length = int(size_field)
+        partition = Partition(start, length, type_id, bootable, is_logical)
+        if is_logical:
+            previous_end = extended.start - 1
+            if logicals:
+                previous_end = logicals[-1].end
+            if partition.start - 1 <= previous_end:
+                # No room for the EBR before this partition.
+                partition.start += 1
+                partition.length -= 1
+        _check_partition(partition, first, last)
+        if is_logical:
+            logicals.append(partition)
+        else:
+            if partition.is_extended:
+                if extended is not None:
+                    raise PartitionTableError(
+                        "Only one extended partition is allowed")
+                extended = partition
+            primaries.append(partition)
+        next_start = partition.end + 1
+    _check_overlaps(primaries)
+    _check_overlaps(logicals)
+    return primaries + logicals
+
+
+def _gpt_last_usable(total_sectors):
+    return total_sectors - GPT_ENTRIES_SECTORS - 2
+
+
+def _gpt_first_usable():
+    return GPT_ENTRIES_SECTORS + 2
+
+
+def parse_sgdisk_cmd(commands, total_sectors):
+    """Return the partitions described by the given sgdisk commands.
+
+    Only the -n (new partition, as number:start:end) and -t (type code, as
+    number:code) commands are supported. As in sgdisk, partition starts are
+    aligned to GPT_ALIGNMENT_S and an end of 0 or '-' means the last usable
+    sector.
+
+    :param total_sectors: The size of the media, in sectors.
+    :return: A list of Partition objects, in partition number order.
+    """
+    first_usable = _gpt_first_usable()
+    last_usable = _gpt_last_usable(total_sectors)
+    partitions = {}
+    types = {}
+    args = commands.split()
+    if len(args) % 2:
+        raise PartitionTableError("Malformed sgdisk commands: %s" % commands)
+    for option, value in zip(args[::2], args[1::2]):
+        if option == '-n':
+            number, start, end = value.split(':')
+            start = max(int(start or 0), first_usable)
+            if start % GPT_ALIGNMENT_S:
+                start += GPT_ALIGNMENT_S - start % GPT_ALIGNMENT_S
+            if end in ('', '-', '0'):
+                end = last_usable
+            elif end.startswith('+'):
+                end = start + int(end[1:]) - 1
+            else:
+                end = int(end)
+            partitions[int(number)] = (start, end)
+        elif option == '-t':
+            number, code = value.split(':')
+            if code.upper() not in SGDISK_TYPES:
+                raise PartitionTableError(
+                    "Unknown partition type code: '%s'" % code)
+            types[int(number)] = SGDISK_TYPES[code.upper()]
+        else:
+            raise PartitionTableError(
+                "Unsupported sgdisk command: %s" % option)
+    result = []
+    for number in sorted(partitions):
+        start, end = partitions[number]
+        type_id = types.get(number, SGDISK_TYPES['8300'])
+        partition = Partition(
+            start, end - start + 1, type_id,
+            bootable=type_id == GPT_ESP_TYPE)
+        _check_partition(partition, first_usable, last_usable)
+        result.append(partition)
+    _check_overlaps(result)
+    return result
+
+
+def _check_overlaps(partitions):
+    ordered = sorted(partitions, key=lambda p: p.start)
+    for previous, partition in zip(ordered, ordered[1:]):
+        if partition.start <= previous.end:
+            raise PartitionTableError(
+                "Partitions %r and %r overlap" % (previous, partition))
+
+
+def _chs(lba):
+    """Return the CHS address of the given sector, packed as in the MBR."""
+    heads, sectors = 255, 63
+    cylinder = lba // (heads * sectors)
+    if cylinder > 1023:
+        return '\xfe\xff\xff'
+    head = (lba // sectors) % heads
+    sector = lba % sectors + 1
+    return struct.pack(
+        '<BBB', head, ((cylinder >> 2) & 0xC0) | sector, cylinder & 0xFF)
+
+
+def _mbr_entry(start, length, type_id, bootable=False, base=0):
+    """Pack an MBR partition entry, with start relative to base."""
+    if start + length > 2 ** 32:
+        raise PartitionTableError(
+            "Partition ending at sector %d is too big for an MBR" % (
+                start + length - 1))
+    status = MBR_BOOTABLE if bootable else 0
+    return struct.pack(
+        '<B3sB3sII', status, _chs(start), type_id, _chs(start + length - 1),
+        start - base, length)
+
+
+def _mbr_sector(boot_sector, entries):
+    """Return boot_sector with its partition table replaced by entries.
+
+    The boot code and disk signature in boot_sector are preserved.
+    """
+    table = ''.join(entries).ljust(MBR_PRIMARY_PARTITIONS * 16, '\x00')
+    return boot_sector[:MBR_TABLE_OFFSET] + table + MBR_SIGNATURE
+
+
+def build_mbr(partitions, boot_sector=None):
+    """Return the sectors to write for an MBR with the given partitions.
+
+    :param partitions: A list of Partition objects as returned by
+        parse_sfdisk_cmd().
+    :param boot_sector: The current first sector of the media, whose boot
+        code should be kept.
+    :return: A list of (sector, data) tuples.
+    """
+    if boot_sector is None or len(boot_sector) < SECTOR_SIZE:
+        boot_sector = '\x00' * SECTOR_SIZE
+    primaries = [p for p in partitions if not p.logical]
+    logicals = [p for p in partitions if p.logical]
+    writes = [(0, _mbr_sector(boot_sector, [
+        _mbr_entry(p.start, p.length, p.type_id, p.bootable)
+        for p in primaries]))]
+    extended = [p for p in primaries if p.is_extended]
+    if not extended:
+        return writes
+    extended = extended[0]
+    # Each logical partition is described by an EBR right before it, which
+    # also points to the EBR of the next logical partition.
+    ebrs = [p.start - 1 for p in logicals]
+    empty_ebr = '\x00' * SECTOR_SIZE
+    for i, partition in enumerate(logicals):
+        entries = [_mbr_entry(
+            partition.start, partition.length, partition.type_id,
+            partition.bootable, base=ebrs[i])]
+        if i + 1 < len(logicals):
+            entries.append(_mbr_entry(
+                ebrs[i + 1], logicals[i + 1].end - ebrs[i + 1] + 1, 0x05,
+                base=extended.start))
+        writes.append((ebrs[i], _mbr_sector(empty_ebr, entries)))
+    if not logicals:
+        writes.append((extended.start, _mbr_sector(empty_ebr, [])))
+    return writes
+
+
+def _gpt_entries(partitions):
+    entries = []
+    for partition in partitions:
+        entries.append(struct.pack(
+            '<16s16sQQQ72s', uuid.UUID(partition.type_id).bytes_le,
+            uuid.uuid4().bytes_le, partition.start, partition.end, 0, ''))
+    return ''.join(entries).ljust(GPT_ENTRIES * GPT_ENTRY_SIZE, '\x00')
+
+
+def _gpt_header(current_lba, backup_lba, entries_lba, total_sectors,
+                disk_guid, entries_crc):
+    fields = [
+        GPT_SIGNATURE, GPT_REVISION, GPT_HEADER_SIZE, 0, 0, current_lba,
+        backup_lba, _gpt_first_usable(), _gpt_last_usable(total_sectors),
+        disk_guid.bytes_le, entries_lba, GPT_ENTRIES, GPT_ENTRY_SIZE,
+        entries_crc]
+    fmt = '<8sIIIIQQQQ16sQIII'
+    header_crc = crc32(struct.pack(fmt, *fields)) & 0xffffffff
+    fields[3] = header_crc
+    return struct.pack(fmt, *fields).ljust(SECTOR_SIZE, '\x00')
+
+
+def build_gpt(partitions, total_sectors, disk_guid=None):
+    """Return the sectors to write for a GPT with the given partitions.
+
+    This includes the protective MBR and the backup GPT at the end of the
+    media.
+
+    :param partitions: A list of Partition objects as returned by
+        parse_sgdisk_cmd().
+    :param total_sectors: The size of the media, in sectors.
+    :return: A list of (sector, data) tuples.
+    """
+    if disk_guid is None:
+        disk_guid = uuid.uuid4()
+    protective_mbr = _mbr_sector('\x00' * SECTOR_SIZE, [_mbr_entry(
+        1, min(total_sectors - 1, 2 ** 32 - 1), MBR_GPT_PROTECTIVE_TYPE)])
+    entries = _gpt_entries(partitions)
+    entries_crc = crc32(entries) & 0xffffffff
+    backup_lba = total_sectors - 1
+    backup_entries_lba = backup_lba - GPT_ENTRIES_SECTORS
+    primary = _gpt_header(
+        1, backup_lba, 2, total_sectors, disk_guid, entries_crc)
+    backup = _gpt_header(
+        backup_lba, 1, backup_entries_lba, total_sectors, disk_guid,
+        entries_crc)
+    return [(0, protective_mbr + primary + entries),
+            (backup_entries_lba, entries + backup)]
+
+
+def _read_sectors(fd, sector, count=1):
+    os.lseek(fd, sector * SECTOR_SIZE, os.SEEK_SET)
+    return os.read(fd, count * SECTOR_SIZE)
+
+
+def _write_sectors(fd, writes):
+    for sector, data in writes:
+        os.lseek(fd, sector * SECTOR_SIZE, os.SEEK_SET)
+        os.write(fd, data)
+
+
+def _get_total_sectors(fd):
+    return os.lseek(fd, 0, os.SEEK_END) // SECTOR_SIZE
+
+
+def write_partition_table(path, commands, part_table='mbr'):
+    """Partition the given media.
+
+    Any existing partition table is replaced, but the boot code in the first
+    sector is kept for MBR tables.
+
+    :param path: The image file or block device to partition.
+    :param commands: The sfdisk (for MBR) or sgdisk (for GPT) commands
+        describing the partitions.
+    :param part_table: Type of partition table, either 'mbr' or 'gpt'.
+    :return: The new partitions, as returned by read_partition_table().
+    """
+    fd = os.open(path, os.O_RDWR)
+    try:
+        total_sectors = _get_total_sectors(fd)
+        if part_table == 'gpt':
+            partitions = parse_sgdisk_cmd(commands, total_sectors)
+            writes = build_gpt(partitions, total_sectors)
+        else:
+            partitions = parse_sfdisk_cmd(commands, total_sectors)
+            writes = build_mbr(partitions, _read_sectors(fd, 0))
+            # Don't leave a stale GPT around for other tools to find.
+            for sector in (1, total_sectors - 1):
+                if _read_sectors(fd, sector).startswith(GPT_SIGNATURE):
+                    writes.append((sector, '\x00' * SECTOR_SIZE))
+        _write_sectors(fd, writes)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    return [p for p in partitions if not p.is_extended]
+
+
+def _parse_mbr_entries(sector):
+    entries = []
+    for i in range(MBR_PRIMARY_PARTITIONS):
+        offset = MBR_TABLE_OFFSET + i * 16
+        status, _, type_id, _, start, length = struct.unpack(
+            '<B3sB3sII', sector[offset:offset + 16])
+        entries.append((status, type_id, start, length))
+    return entries
+
+
+def _read_gpt(fd):
+    header = _read_sectors(fd, 1)
+    fields = struct.unpack('<8sIIIIQQQQ16sQIII', header[:GPT_HEADER_SIZE])
+    if fields[0] != GPT_SIGNATURE:
+        raise PartitionTableError("No GPT header found")
+    entries_lba, entries_count, entry_size = fields[10:13]
+    data = _read_sectors(
+        fd, entries_lba,
+        (entries_count * entry_size + SECTOR_SIZE - 1) // SECTOR_SIZE)
+    partitions = []
+    for i in range(entries_count):
+        entry = data[i * entry_size:i * entry_size + 48]
+        type_guid, _, first, last = struct.unpack('<16s16sQQ', entry)
+        if type_guid == '\x00' * 16:
+            continue
+        type_id = str(uuid.UUID(bytes_le=type_guid)).upper()
+        partitions.append(Partition(
+            first, last - first + 1, type_id,
+            bootable=type_id == GPT_ESP_TYPE))
+    return partitions
+
+
+def read_partition_table(path):
+    """Return the partitions of the given image file or block device.
+
+    :return: A list of Partition objects excluding MBR extended partitions,
+        in table order: primary partitions first followed by the logical
+        ones, or GPT partitions in entry order.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        mbr = _read_sectors(fd, 0)
+        if mbr[510:512] != MBR_SIGNATURE:
+            raise PartitionTableError("No partition table found on %s" % path)
+        entries = _parse_mbr_entries(mbr)
+        if any(type_id == MBR_GPT_PROTECTIVE_TYPE
+               for _, type_id, _, _ in entries):
+            return _read_gpt(fd)
+        primaries = []
+        logicals = []
+        for status, type_id, start, length in entries:
+            if type_id == 0:
+                continue
+            if type_id not in MBR_EXTENDED_TYPES:
+                primaries.append(Partition(
+                    start, length, type_id, status == MBR_BOOTABLE))
+                continue
+            ebr = start
+            while True:
+                logical, next_ebr = _parse_mbr_entries(
+                    _read_sectors(fd, ebr))[:2]
+                if logical[1] != 0:
+                    logicals.append(Partition(
+                        ebr + logical[2], logical[3], logical[1],
+                        logical[0] == MBR_BOOTABLE, logical=True))
+                if next_ebr[1] == 0 or next_ebr[2] == 0:
+                    break
+                ebr = start + next_ebr[2]
+        return primaries + logicals
+    finally:
+        os.close(fd)
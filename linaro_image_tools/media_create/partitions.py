@@ -21,20 +21,20 @@ from contextlib import contextmanager
 from math import ceil
 import atexit
 import dbus
+import fcntl
 import glob
 import logging
+import multiprocessing
+import os
 import re
 import subprocess
 import time
 
-from parted import (
-    Device,
-    Disk,
-    PARTITION_NORMAL,
-    PARTITION_EXTENDED,
-)
-
 from linaro_image_tools import cmd_runner
+from linaro_image_tools.media_create.partition_table import (
+    read_partition_table,
+    write_partition_table,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -44,28 +44,34 @@ SECTOR_SIZE = 512  # bytes
 CYLINDER_SIZE = HEADS * SECTORS * SECTOR_SIZE
 DBUS_PROPERTIES = 'org.freedesktop.DBus.Properties'
 UDISKS = "org.freedesktop.UDisks"
+# The BLKRRPART ioctl, which makes the kernel re-read a partition table.
+BLKRRPART = 0x125f
 # Max number of attempts to sleep (total sleep time in seconds =
 # 1+2+...+MAX_TTS)
 MAX_TTS = 10
+# How long to wait for the partitions of a block device to settle, in
+# seconds, and how often to check whether they have.
+SETTLE_TIMEOUT = 55
+SETTLE_POLL_INTERVAL = 0.1
+SETTLE_MAX_RETRY_INTERVAL = 2
 # Image size should be a multiple of 1MiB, expressed in bytes. This is also
 # the minimum image size possible.
 ROUND_IMAGE_TO = 2 ** 20
 MIN_IMAGE_SIZE = ROUND_IMAGE_TO
+# Size of the chunks in which filesystem images are written into an image
+# file by the mount-free assembly.
+IMAGE_WRITE_BLOCK_SIZE = 2 ** 20
 
 
 def setup_android_partitions(board_config, media, image_size, bootfs_label,
                              should_create_partitions,
                              should_align_boot_part=False):
     if not media.is_block_device:
-        image_size_in_bytes = get_partition_size_in_bytes(image_size)
-        proc = cmd_runner.run(
-            ['dd', 'of=%s' % media.path,
-             'bs=1', 'seek=%s' % image_size_in_bytes, 'count=0'],
-            stderr=open('/dev/null', 'w'))
-        proc.wait()
+        create_image_file(media.path, image_size)
 
+    partition_table = None
     if should_create_partitions:
-        create_partitions(
+        partition_table = create_partitions(
             board_config, media, should_align_boot_part=should_align_boot_part)
 
     if media.is_block_device:
@@ -77,7 +83,8 @@ def setup_android_partitions(board_config, media, image_size, bootfs_label,
         ensure_partition_is_not_mounted(data)
         ensure_partition_is_not_mounted(sdcard)
     else:
-        partitions = get_android_loopback_devices(media.path)
+        partitions = get_android_loopback_devices(
+            media.path, partition_table)
         bootfs = partitions[0]
         system = partitions[1]
         cache = partitions[2]
@@ -85,29 +92,102 @@ def setup_android_partitions(board_config, media, image_size, bootfs_label,
         sdcard = partitions[4]
 
     print "\nFormating boot partition\n"
-    proc = cmd_runner.run(
-        ['mkfs.vfat', '-F', str(board_config.fat_size), bootfs, '-n',
-         bootfs_label],
-        as_root=True)
-    proc.wait()
+    mkfs_commands = [
+        ('boot', ['mkfs.vfat', '-F', str(board_config.fat_size), bootfs,
+                  '-n', bootfs_label])]
 
     ext4_partitions = {"system": system, "cache": cache, "userdata": data}
     for label, dev in ext4_partitions.iteritems():
         mkfs = 'mkfs.%s' % "ext4"
-        proc = cmd_runner.run(
-            [mkfs, '-F', dev, '-L', label],
-            as_root=True)
-        proc.wait()
+        mkfs_commands.append((label, [mkfs, '-F', dev, '-L', label]))
 
-    proc = cmd_runner.run(
-        ['mkfs.vfat', '-F32', sdcard, '-n',
-         "sdcard"],
-        as_root=True)
-    proc.wait()
+    mkfs_commands.append(
+        ('sdcard', ['mkfs.vfat', '-F32', sdcard, '-n', "sdcard"]))
+    run_mkfs_commands(mkfs_commands)
 
     return bootfs, system, cache, data, sdcard
 
 
+class PartitionFormatError(Exception):
+    """Raised when the filesystem of one or more partitions can't be created.
+
+    :ivar failures: A list of (partition, error) tuples, one for each mkfs
+        that failed.
+    :ivar cancelled: The partitions whose mkfs was terminated because
+        another one failed.
+    """
+
+    def __init__(self, failures, cancelled=()):
+        self.failures = failures
+        self.cancelled = list(cancelled)
+
+    def __str__(self):
+        message = 'Failed to format partition(s): %s' % '; '.join(
+            '%s: %s' % (partition, error)
+            for partition, error in self.failures)
+        if self.cancelled:
+            message += ' (cancelled: %s)' % ', '.join(self.cancelled)
+        return message
+
+
+def run_mkfs_commands(mkfs_commands, max_jobs=None):
+    """Create the filesystems of several partitions concurrently.
+
+    The partitions must be distinct devices. At most max_jobs mkfs run at the
+    same time; once one of them fails no more are started and the ones still
+    running are terminated.
+
+    :param mkfs_commands: A list of (partition, command) tuples, where
+        partition is a name used to report errors.
+    :param max_jobs: The maximum number of mkfs to run at once; defaults to
+        the number of CPUs.
+    :raises PartitionFormatError: if any of the mkfs failed.
+    """
+    if max_jobs is None:
+        max_jobs = multiprocessing.cpu_count()
+    pending = list(mkfs_commands)
+    running = []
+    failures = []
+    cancelled = []
+    while pending or running:
+        while pending and len(running) < max_jobs and not failures:
+            partition, cmd = pending.pop(0)
+            running.append((partition, cmd_runner.run(cmd, as_root=True)))
+        partition, proc = running.pop(0)
+        try:
+            proc.wait()
+        except cmd_runner.SubcommandNonZeroReturnValue, e:
+            if partition in cancelled:
+                # It failed because it was terminated.
+                continue
+            failures.append((partition, e))
+            if pending:
+                logger.error("Not formatting %s partition(s) as %s failed" % (
+                    ', '.join(name for name, _ in pending), partition))
+                pending = []
+            for other_partition, other in running:
+                if other.poll() is None and other_partition not in cancelled:
+                    other.terminate()
+                    cancelled.append(other_partition)
+    if failures:
+        raise PartitionFormatError(failures, cancelled)
+
+
+def create_image_file(image_file, image_size):
+    """Create a sparse image file of the given size.
+
+    :param image_file: The path of the image file to create.
+    :param image_size: The size of the image, as accepted by
+        get_partition_size_in_bytes().
+    """
+    image_size_in_bytes = get_partition_size_in_bytes(image_size)
+    proc = cmd_runner.run(
+        ['dd', 'of=%s' % image_file,
+         'bs=1', 'seek=%s' % image_size_in_bytes, 'count=0'],
+        stderr=open('/dev/null', 'w'))
+    proc.wait()
+
+
 # I wonder if it'd make sense to convert this into a small shim which calls
 # the appropriate function for the given type of device?  I think it's still
 # small enough that there's not much benefit in doing that, but if it grows we
@@ -135,15 +215,11 @@ def setup_partitions(board_config, media, image_size, bootfs_label,
     :param part_table: Type of partition table, either 'mbr' or 'gpt'.
     """
     if not media.is_block_device:
-        image_size_in_bytes = get_partition_size_in_bytes(image_size)
-        proc = cmd_runner.run(
-            ['dd', 'of=%s' % media.path,
-             'bs=1', 'seek=%s' % image_size_in_bytes, 'count=0'],
-            stderr=open('/dev/null', 'w'))
-        proc.wait()
+        create_image_file(media.path, image_size)
 
+    partition_table = None
     if should_create_partitions:
-        create_partitions(
+        partition_table = create_partitions(
             board_config, media, should_align_boot_part=should_align_boot_part,
             part_table=part_table)
 
@@ -156,32 +232,129 @@ def setup_partitions(board_config, media, image_size, bootfs_label,
         ensure_partition_is_not_mounted(bootfs)
         ensure_partition_is_not_mounted(rootfs)
     else:
-        bootfs, rootfs = get_boot_and_root_loopback_devices(media.path)
+        bootfs, rootfs = get_boot_and_root_loopback_devices(
+            media.path, partition_table)
 
+    mkfs_commands = []
     if should_format_bootfs:
         print "\nFormating boot partition\n"
         mkfs = 'mkfs.%s' % board_config.bootfs_type
         if board_config.bootfs_type == 'vfat':
-            proc = cmd_runner.run(
-                [mkfs, '-F', str(board_config.fat_size), bootfs, '-n',
-                 bootfs_label],
-                as_root=True)
+            mkfs_commands.append(
+                ('boot', [mkfs, '-F', str(board_config.fat_size), bootfs,
+                          '-n', bootfs_label]))
         else:
-            proc = cmd_runner.run(
-                [mkfs, bootfs, '-L', bootfs_label], as_root=True)
-        proc.wait()
+            mkfs_commands.append(
+                ('boot', [mkfs, bootfs, '-L', bootfs_label]))
 
     if should_format_rootfs:
         print "\nFormating root partition\n"
         mkfs = 'mkfs.%s' % rootfs_type
-        proc = cmd_runner.run(
-            [mkfs, '-F', rootfs, '-L', rootfs_label],
-            as_root=True)
-        proc.wait()
+        mkfs_commands.append(
+            ('root', [mkfs, '-F', rootfs, '-L', rootfs_label]))
+    run_mkfs_commands(mkfs_commands)
 
     return bootfs, rootfs
 
 
+def setup_partition_images(board_config, media, image_size,
+                           should_align_boot_part=False, part_table="mbr"):
+    """Partition an image file for mount-free assembly.
+
+    Unlike setup_partitions() this doesn't register any loopback devices nor
+    create any filesystems; the boot and root filesystems are later built as
+    standalone images with make_partition_image() and spliced into the image
+    file with write_partition_image().
+
+    :param board_config: A BoardConfig class.
+    :param media: The Media we should partition; must be an image file.
+    :param image_size: The size of the image file.
+    :param should_align_boot_part: Whether to align the boot partition too.
+    :param part_table: Type of partition table, either 'mbr' or 'gpt'.
+    :return: A 4-tuple containing the size and offset of the boot partition
+        followed by the size and offset of the root partition, in bytes.
+    """
+    assert not media.is_block_device, (
+        "Mount-free assembly can only be used with image files")
+    create_image_file(media.path, image_size)
+    partition_table = create_partitions(
+        board_config, media, should_align_boot_part=should_align_boot_part,
+        part_table=part_table)
+    return calculate_partition_size_and_offset(media.path, partition_table)
+
+
+def make_partition_image(image_path, size, fs_type, label, content_dir,
+                         fat_size=32, uuid=None):
+    """Create a filesystem image of the given size holding content_dir.
+
+    Nothing gets mounted and nothing runs as root: ext2/3/4 images are
+    populated by mkfs itself (through its -d option, which needs e2fsprogs
+    1.43 or later) and vfat images are filled using mtools, so everything in
+    content_dir must be readable by the invoking user.
+
+    :param image_path: The path of the filesystem image to create.
+    :param size: The size of the filesystem, in bytes.
+    :param fs_type: One of 'vfat', 'ext2', 'ext3' or 'ext4'.
+    :param label: The label of the filesystem.
+    :param content_dir: The directory whose contents will be copied into
+        the filesystem.
+    :param fat_size: The FAT size to use for vfat filesystems.
+    :param uuid: The UUID to give to ext filesystems, or None to let mkfs
+        generate one.
+    """
+    size_in_kb = size / 1024
+    if fs_type == 'vfat':
+        cmd_runner.run(
+            ['mkfs.vfat', '-C', '-F', str(fat_size), '-n', label, image_path,
+             str(size_in_kb)]).wait()
+        contents = [os.path.join(content_dir, name)
+                    for name in sorted(os.listdir(content_dir))]
+        if contents:
+            cmd = ['mcopy', '-s', '-m', '-i', image_path]
+            cmd.extend(contents)
+            cmd.append('::/')
+            cmd_runner.run(cmd).wait()
+    elif fs_type in ('ext2', 'ext3', 'ext4'):
+        cmd = ['mkfs.%s' % fs_type, '-F', '-L', label, '-d', content_dir]
+        if uuid is not None:
+            cmd.extend(['-U', uuid])
+        cmd.extend([image_path, '%dk' % size_in_kb])
+        cmd_runner.run(cmd).wait()
+    else:
+        raise ValueError(
+            "Filesystem type '%s' is not supported by the mount-free image "
+            "assembly" % fs_type)
+
+
+def write_partition_image(partition_image, image_file, offset, size):
+    """Write a filesystem image into image_file at the given offset.
+
+    Blocks containing only zeroes are skipped rather than written, so the
+    image file must have been freshly created (see create_image_file()) and
+    stays sparse.
+
+    :param partition_image: The filesystem image to write.
+    :param image_file: The image file to write to.
+    :param offset: The offset of the partition in image_file, in bytes.
+    :param size: The size of the partition, in bytes.
+    """
+    assert os.path.getsize(partition_image) <= size, (
+        "'%s' does not fit in a partition of %d bytes" % (
+            partition_image, size))
+    zero_block = '\0' * IMAGE_WRITE_BLOCK_SIZE
+    with open(partition_image, 'rb') as source:
+        with open(image_file, 'r+b') as dest:
+            dest.seek(offset)
+            while True:
+                block = source.read(IMAGE_WRITE_BLOCK_SIZE)
+                if not block:
+                    break
+                if block == zero_block[:len(block)]:
+                    dest.seek(len(block), os.SEEK_CUR)
+                else:
+                    dest.write(block)
+
+
 def umount(path):
     # The old code used to ignore failures here, but I don't think that's
     # desirable so I'm using cmd_runner.run()'s standard behaviour, which will
@@ -196,8 +369,15 @@ def partition_mounted(device, path, *args):
     We use a try/finally to make sure the device is umounted even if there's
     an uncaught exception in the with block.
 
+    If device is None nothing is mounted and path is used as a plain
+    directory; that's how the mount-free image assembly stages the contents
+    of a partition.
+
     :param *args: Extra arguments to the mount command.
     """
+    if device is None:
+        yield
+        return
     subprocess_args = ['mount', device, path]
     subprocess_args.extend(args)
     cmd_runner.run(subprocess_args, as_root=True).wait()
@@ -244,26 +424,33 @@ def is_partition_mounted(partition):
         device_path, 'DeviceIsMounted', dbus_interface=DBUS_PROPERTIES)
 
 
-def get_boot_and_root_loopback_devices(image_file):
+def get_boot_and_root_loopback_devices(image_file, partition_table=None):
     """Return the boot and root loopback devices for the given image file.
 
     Register the loopback devices as well.
+
+    :param partition_table: The partitions of the image file, as returned by
+        create_partitions(), or None to read them from the image file.
     """
     vfat_size, vfat_offset, linux_size, linux_offset = (
-        calculate_partition_size_and_offset(image_file))
+        calculate_partition_size_and_offset(image_file, partition_table))
     boot_device = register_loopback(image_file, vfat_offset, vfat_size)
     root_device = register_loopback(image_file, linux_offset, linux_size)
     return boot_device, root_device
 
 
-def get_android_loopback_devices(image_file):
+def get_android_loopback_devices(image_file, partition_table=None):
     """Return the loopback devices for the given image file.
 
     Assumes a particular order of devices in the file.
     Register the loopback devices as well.
+
+    :param partition_table: The partitions of the image file, as returned by
+        create_partitions(), or None to read them from the image file.
     """
     devices = []
-    device_info = calculate_android_partition_size_and_offset(image_file)
+    device_info = calculate_android_partition_size_and_offset(
+        image_file, partition_table)
     for device_offset, device_size in device_info:
         devices.append(register_loopback(image_file, device_offset,
                                          device_size))
@@ -286,39 +473,32 @@ def register_loopback(image_file, offset, size):
     return device
 
 
-def calculate_partition_size_and_offset(image_file):
+def calculate_partition_size_and_offset(image_file, partition_table=None):
     """Return the size and offset of the boot and root partitions.
 
-    Both the size and offset are in sectors.
+    Both the size and offset are in bytes.
 
     :param image_file: A string containing the path to the image_file.
-    :return: A 4-tuple containing the offset and size of the boot partition
-        followed by the offset and size of the root partition.
+    :param partition_table: The partitions of the image file, as returned by
+        create_partitions(), or None to read them from the image file.
+    :return: A 4-tuple containing the size and offset of the boot partition
+        followed by the size and offset of the root partition.
     """
-    # Here we can use parted.Device to read the partitions because we're
-    # reading from a regular file rather than a block device.  If it was a
-    # block device we'd need root rights.
-    disk = Disk(Device(image_file))
+    if partition_table is None:
+        partition_table = read_partition_table(image_file)
     vfat_partition = None
     linux_partition = None
-    for partition in disk.partitions:
-        assert partition.type == PARTITION_NORMAL, (
-            "Parted should only return normal partitions but got type %i" %
-            partition.type)
-        if 'boot' in partition.getFlagsAsString():
-            geometry = partition.geometry
-            vfat_offset = geometry.start * SECTOR_SIZE
-            vfat_size = geometry.length * SECTOR_SIZE
+    for partition in partition_table:
+        assert not partition.logical, (
+            "Expected only primary partitions but got %r" % partition)
+        if partition.bootable:
+            vfat_offset = partition.offset
+            vfat_size = partition.size
             vfat_partition = partition
         elif vfat_partition is not None:
             # next partition after boot partition is the root partition
-            # NB: don't use vfat_partition.nextPartition() as that might return
-            # a partition of type PARTITION_FREESPACE; it's much easier to
-            # iterate disk.partitions which only returns
-            # parted.PARTITION_NORMAL partitions
-            geometry = partition.geometry
-            linux_offset = geometry.start * SECTOR_SIZE
-            linux_size = geometry.length * SECTOR_SIZE
+            linux_offset = partition.offset
+            linux_size = partition.size
             linux_partition = partition
             break
 
@@ -329,36 +509,28 @@ def calculate_partition_size_and_offset(image_file):
     return vfat_size, vfat_offset, linux_size, linux_offset
 
 
-def calculate_android_partition_size_and_offset(image_file):
+def calculate_android_partition_size_and_offset(image_file,
+                                                partition_table=None):
     """Return the size and offset of the android partitions.
 
     Both the size and offset are in bytes.
 
     :param image_file: A string containing the path to the image_file.
+    :param partition_table: The partitions of the image file, as returned by
+        create_partitions(), or None to read them from the image file.
     :return: A list of (offset, size) pairs.
     """
-    # Here we can use parted.Device to read the partitions because we're
-    # reading from a regular file rather than a block device.  If it was a
-    # block device we'd need root rights.
+    if partition_table is None:
+        partition_table = read_partition_table(image_file)
     vfat_partition = None
-    disk = Disk(Device(image_file))
     partition_info = []
-    for partition in disk.partitions:
-        # Will ignore any partitions before boot and of type EXTENDED
-        if 'boot' in partition.getFlagsAsString():
+    for partition in partition_table:
+        # Will ignore any partitions before boot; extended partitions are
+        # never part of the partition table.
+        if partition.bootable:
             vfat_partition = partition
-            geometry = partition.geometry
-            partition_info.append((geometry.start * SECTOR_SIZE,
-                                   geometry.length * SECTOR_SIZE))
-        elif (vfat_partition is not None and
-              partition.type != PARTITION_EXTENDED):
-            geometry = partition.geometry
-            partition_info.append((geometry.start * SECTOR_SIZE,
-                                   geometry.length * SECTOR_SIZE))
-        # NB: don't use vfat_partition.nextPartition() as that might return
-        # a partition of type PARTITION_FREESPACE; it's much easier to
-        # iterate disk.partitions which only returns
-        # parted.PARTITION_NORMAL partitions
+        if vfat_partition is not None:
+            partition_info.append((partition.offset, partition.size))
     assert vfat_partition is not None, (
         "Couldn't find boot partition on %s" % image_file)
     assert len(partition_info) == 5
@@ -557,7 +729,15 @@ def create_partitions(board_config, media, should_align_boot_part=False,
     :param media: A setup_partitions.Media object to partition.
     :param should_align_boot_part: Whether to align the boot partition too.
     :param part_table Type of partition table, either 'mbr' or 'gpt'.
+    :return: The new partitions, as returned by
+        partition_table.read_partition_table(), if we could write the
+        partition table ourselves, or None if it had to be written with
+        sfdisk/sgdisk.
     """
+    if os.access(media.path, os.W_OK):
+        return _write_partition_table(
+            board_config, media, should_align_boot_part, part_table)
+
     label = 'msdos'
     if part_table == 'gpt':
         label = part_table
@@ -568,7 +748,7 @@ def create_partitions(board_config, media, should_align_boot_part=False,
             ['parted', '-s', media.path, 'mklabel', label], as_root=True)
         proc.wait()
 
-    wait_partition_to_settle(media, part_table)
+    wait_partition_to_settle(media, part_table, expect_partitions=False)
 
     if part_table == 'gpt':
         sgdisk_cmd = board_config.get_sgdisk_cmd(
@@ -581,36 +761,123 @@ def create_partitions(board_config, media, should_align_boot_part=False,
 
         run_sfdisk_commands(sfdisk_cmd, media.path)
 
-    # sleep to wait for the partition to settle.
     wait_partition_to_settle(media, part_table)
 
 
-def wait_partition_to_settle(media, part_table):
-    """Sleep in a loop to wait partition to settle
+def _write_partition_table(board_config, media, should_align_boot_part,
+                           part_table):
+    """Write the partition table for create_partitions() in-process."""
+    if part_table == 'gpt':
+        commands = board_config.get_sgdisk_cmd(
+            should_align_boot_part=should_align_boot_part)
+    else:
+        commands = board_config.get_sfdisk_cmd(
+            should_align_boot_part=should_align_boot_part)
+    partitions = write_partition_table(media.path, commands, part_table)
+    if media.is_block_device:
+        reread_partition_table(media.path)
+        wait_partition_to_settle(media, part_table)
+    return partitions
+
+
+def reread_partition_table(device):
+    """Ask the kernel to re-read the partition table of the given device.
+
+    The BLKRRPART ioctl fails when a partition of the device is in use, in
+    which case partprobe, which updates the partitions one by one, is run
+    instead.
+
+    :raises cmd_runner.SubcommandNonZeroReturnValue: if partprobe fails too.
+    """
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        fcntl.ioctl(fd, BLKRRPART)
+        return
+    except IOError, e:
+        logger.warning(
+            "Couldn't re-read the partition table of %s: %s; trying "
+            "partprobe" % (device, e))
+    finally:
+        os.close(fd)
+    cmd_runner.run(['partprobe', device], as_root=True).wait()
+
+
+def wait_partition_to_settle(media, part_table, expect_partitions=True):
+    """Wait for the partition table of the given media to settle.
+
+    Image files need no settling. For block devices we wait for udev to
+    process the events for the new partition table, then for the kernel to
+    list the partitions in sysfs with their device nodes in place, and for
+    the partition table to be readable, retrying the latter less and less
+    often as it needs root.
 
     :param media: A setup_partitions.Media object to partition.
+    :param part_table: Type of partition table, either 'mbr' or 'gpt'.
+    :param expect_partitions: Whether the partition table should have any
+        partitions; if not, only its readability is checked.
+    :raises cmd_runner.SubcommandNonZeroReturnValue: if the partition table
+        can't be read after SETTLE_TIMEOUT seconds.
     """
-    tts = 1
-    while (tts > 0) and (tts <= MAX_TTS):
-        try:
-            logger.info("Sleeping for %s second(s) to wait "
-                        "for the partition to settle" % tts)
-            time.sleep(tts)
+    if not media.is_block_device:
+        return 0
 
-            args = ['sfdisk', '-l', media.path]
-            if part_table == 'gpt':
-                args = ['sgdisk', '-L', media.path]
+    try:
+        cmd_runner.run(
+            ['udevadm', 'settle', '--timeout=%d' % SETTLE_TIMEOUT]).wait()
+    except (OSError, cmd_runner.SubcommandNonZeroReturnValue):
+        logger.info("Couldn't wait for udev to settle, polling %s instead" %
+                    media.path)
+
+    # The partitions showing up in sysfs and /dev needs no root to check, so
+    # poll for that and only ask for the partition table once they're there.
+    waited = 0
+    while (expect_partitions and not _partition_nodes_exist(media.path) and
+           waited < SETTLE_TIMEOUT):
+        time.sleep(SETTLE_POLL_INTERVAL)
+        waited += SETTLE_POLL_INTERVAL
+
+    args = ['sfdisk', '-l', media.path]
+    if part_table == 'gpt':
+        args = ['sgdisk', '-L', media.path]
+    interval = SETTLE_POLL_INTERVAL
+    while True:
+        try:
             proc = cmd_runner.run(args, as_root=True,
                                   stdout=open('/dev/null', 'w'))
             proc.wait()
             return 0
         except cmd_runner.SubcommandNonZeroReturnValue:
-            logger.info("Partition table is not available "
-                        "for device %s" % media.path)
-            tts += 1
-    logger.error("Couldn't read partition table "
-                 "for a reasonable time for device %s" % media.path)
-    raise
+            if waited >= SETTLE_TIMEOUT:
+                logger.error("Couldn't read partition table "
+                             "for a reasonable time for device %s" %
+                             media.path)
+                raise
+            logger.debug("Partition table is not available "
+                         "for device %s" % media.path)
+        time.sleep(interval)
+        waited += interval
+        interval = min(interval * 2, SETTLE_MAX_RETRY_INTERVAL)
+
+
+def _partition_nodes_exist(device):
+    """Whether the kernel has created the partitions of the given device.
+
+    That is, whether it lists any partitions for the device in sysfs and all
+    of them have their device node. If the device is not in sysfs we can't
+    tell, so we assume they do.
+    """
+    name = os.path.basename(os.path.realpath(device))
+    sysfs_dir = os.path.join('/sys/class/block', name)
+    if not os.path.isdir(sysfs_dir):
+        return True
+    partitions = [
+        entry for entry in os.listdir(sysfs_dir)
+        if entry.startswith(name) and
+        os.path.exists(os.path.join(sysfs_dir, entry, 'partition'))]
+    if not partitions:
+        return False
+    return all(os.path.exists(os.path.join('/dev', partition))
+               for partition in partitions)
 
 
 class Media(object):
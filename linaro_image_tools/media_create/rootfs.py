@@ -19,7 +19,6 @@
 
 import os
 import subprocess
-import tempfile
 
 from linaro_image_tools import cmd_runner
 
@@ -55,14 +54,22 @@ def populate_rootfs(content_dir, root_disk, partition, rootfs_type,
       5. If should_create_swap, then create it with the given size.
       6. Add fstab entries for the / filesystem and swap (if created).
       7. Create a /etc/flash-kernel.conf containing the target's boot device.
+
+    If partition is None the first four steps are skipped and the tweaks are
+    made to content_dir itself, which is what the mount-free image assembly
+    later turns into the root filesystem image.
     """
     print "\nPopulating rootfs partition"
     print "Be patient, this may take a few minutes\n"
-    # Create a directory to mount the rootfs partition.
-    os.makedirs(root_disk)
+    if partition is None:
+        root_disk = content_dir
+    else:
+        # Create a directory to mount the rootfs partition.
+        os.makedirs(root_disk)
 
     with partition_mounted(partition, root_disk):
-        move_contents(content_dir, root_disk)
+        if partition is not None:
+            move_contents(content_dir, root_disk)
 
         mount_options = rootfs_mount_options(rootfs_type)
         fstab_additions = ["%s / %s  %s 0 1" % (
@@ -178,11 +185,7 @@ def append_to_fstab(root_disk, fstab_additions):
 def write_data_to_protected_file(path, data):
     """Write data to the file on the given path.
 
-    This is meant to be used when the given file is only writable by root, and
-    we overcome that by writing the data to a tempfile and then moving the
-    tempfile on top of the given one using sudo.
+    This is meant to be used when the given file is only writable by root;
+    see cmd_runner.write_file().
     """
-    _, tmpfile = tempfile.mkstemp()
-    with open(tmpfile, 'w') as fd:
-        fd.write(data)
-    cmd_runner.run(['mv', '-f', tmpfile, path], as_root=True).wait()
+    cmd_runner.write_file(path, data, as_root=True)
@@ -0,0 +1,270 @@
+# Copyright (C) 2010, 2011 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A cache of root filesystems with their hardware packs installed.
+
+Unpacking the binary tarball and installing the hardware packs onto it is
+the bulk of the work of linaro-media-create, and its result only depends on
+the tarball, the hardware packs and the version of linaro-media-create, so
+it can be reused when creating more than one image out of them.
+
+The cache is a directory with one sub-directory per rootfs, named after the
+SHA-256 of what went into it, and an index recording the size of each
+rootfs and when it was last used. The least recently used ones are removed
+when the cache grows bigger than its maximum size.
+
+Each rootfs has a lock file next to it, which is locked shared while the
+rootfs is copied out of the cache, and exclusively to remove it, so that
+the cache can be shared by several runs at the same time.
+"""
+
+from contextlib import contextmanager
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import time
+
+from linaro_image_tools import cmd_runner
+from linaro_image_tools.__version__ import __version__
+from linaro_image_tools.utils import DEFAULT_LOGGER_NAME
+
+logger = logging.getLogger(DEFAULT_LOGGER_NAME)
+
+# Bump this whenever what is stored in the cache changes.
+CACHE_FORMAT = '1'
+INDEX_NAME = 'index.json'
+LOCK_SUFFIX = '.lock'
+# The default maximum size of the cache, in MiB.
+DEFAULT_MAX_SIZE = 20 * 1024
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def copy_rootfs(src, dest):
+    """Copy the contents of src into dest, preserving everything.
+
+    Reflinks are used when both are on a filesystem which supports them, so
+    that nothing is copied until it's changed.
+    """
+    cmd_runner.run(
+        ['cp', '-a', '--reflink=auto', os.path.join(src, '.'), dest],
+        as_root=True).wait()
+
+
+class RootfsCache(object):
+    """A cache of root filesystems with their hardware packs installed."""
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE * 1024 * 1024):
+        """
+        :param directory: The directory of the cache, which is created if it
+            doesn't exist.
+        :param max_size: The size, in bytes, the cache is trimmed to.
+        """
+        self.directory = os.path.abspath(directory)
+        self.max_size = max_size
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.index_path = os.path.join(self.directory, INDEX_NAME)
+        # The lock files of the roots looked up, by key.
+        self._locks = {}
+
+    @contextmanager
+    def _index(self):
+        """Lock the index and give it to the block, saving it afterwards."""
+        fd = os.open(self.index_path, os.O_RDWR | os.O_CREAT, 0644)
+        index_file = os.fdopen(fd, 'r+')
+        try:
+            fcntl.flock(index_file, fcntl.LOCK_EX)
+            content = index_file.read()
+            index = {'entries': {}, 'digests': {}}
+            if content:
+                index = json.loads(content)
+            yield index
+            index_file.seek(0)
+            index_file.truncate()
+            json.dump(index, index_file, indent=2, sort_keys=True)
+        finally:
+            index_file.close()
+
+    def _digest(self, path, digests):
+        """Return the SHA-256 of the given file.
+
+        The digests of the files we've already seen are remembered, along
+        with their size and mtime, so that big tarballs are not read again
+        unless they have changed.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        known = digests.get(path)
+        if known is not None and known[:2] == [stat.st_size, stat.st_mtime]:
+            return known[2]
+        sha = hashlib.sha256()
+        with open(path, 'rb') as fd:
+            for block in iter(lambda: fd.read(HASH_BLOCK_SIZE), ''):
+                sha.update(block)
+        digest = sha.hexdigest()
+        digests[path] = [stat.st_size, stat.st_mtime, digest]
+        return digest
+
+    def get_key(self, binary, hwpacks, options=(), files=()):
+        """Return the key of the rootfs made out of the given files.
+
+        :param binary: The binary tarball the rootfs is unpacked from.
+        :param hwpacks: The hardware packs installed onto it, in the order
+            they're installed.
+        :param options: Any other strings which affect the content of the
+            rootfs.
+        :param files: Any other files which affect the content of the
+            rootfs, like the linaro-hwpack-install run.
+        """
+        with self._index() as index:
+            parts = [CACHE_FORMAT, __version__, self._digest(
+                binary, index['digests'])]
+            parts.extend(
+                self._digest(hwpack, index['digests']) for hwpack in hwpacks)
+            parts.extend(
+                self._digest(path, index['digests']) for path in files)
+        parts.extend(options)
+        return hashlib.sha256('\0'.join(parts)).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _lock_path(self, key):
+        return self._entry_path(key) + LOCK_SUFFIX
+
+    def _lock_entry(self, key, exclusive=False):
+        """Lock the rootfs with the given key.
+
+        Shared locks are waited for, while exclusive ones are given up on
+        if the rootfs is in use.
+
+        :return: The locked file, to close to release the lock, or None if
+            an exclusive lock couldn't be taken.
+        """
+        path = self._lock_path(key)
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+            lock_file = os.fdopen(fd, 'r+')
+            try:
+                if exclusive:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                else:
+                    fcntl.flock(lock_file, fcntl.LOCK_SH)
+            except IOError, e:
+                lock_file.close()
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                return None
+            # Whoever held the lock before may have removed the rootfs along
+            # with its lock file, in which case we start over.
+            try:
+                removed = os.stat(path).st_ino != os.fstat(fd).st_ino
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                removed = True
+            if not removed:
+                return lock_file
+            lock_file.close()
+
+    def lookup(self, key):
+        """Return the directory of the cached rootfs, or None if not cached.
+
+        The rootfs is kept in the cache until release() is called.
+        """
+        lock_file = self._lock_entry(key)
+        with self._index() as index:
+            entry = index['entries'].get(key)
+            if entry is None or not os.path.isdir(self._entry_path(key)):
+                lock_file.close()
+                return None
+            entry['last_used'] = time.time()
+        self.release(key)
+        self._locks[key] = lock_file
+        return self._entry_path(key)
+
+    def release(self, key):
+        """Let the rootfs returned by lookup() be removed from the cache."""
+        lock_file = self._locks.pop(key, None)
+        if lock_file is not None:
+            lock_file.close()
+
+    def store(self, key, rootfs_dir):
+        """Store a copy of rootfs_dir in the cache, under the given key.
+
+        The least recently used roots are then removed until the cache is
+        no bigger than its maximum size.
+        """
+        logger.info("Storing the rootfs in the cache as %s" % key)
+        tmp_path = '%s.tmp-%d' % (self._entry_path(key), os.getpid())
+        cmd_runner.run(['mkdir', tmp_path], as_root=True).wait()
+        try:
+            copy_rootfs(rootfs_dir, tmp_path)
+            proc = cmd_runner.run(
+                ['du', '-s', '--block-size=1', tmp_path], as_root=True,
+                stdout=subprocess.PIPE)
+            size = int(proc.communicate()[0].split()[0])
+            with self._index() as index:
+                if (not os.path.lexists(self._entry_path(key)) or
+                        self._remove_entry(key)):
+                    cmd_runner.run(
+                        ['mv', tmp_path, self._entry_path(key)],
+                        as_root=True).wait()
+                # Otherwise another run is using the same rootfs, which is
+                # kept instead.
+                index['entries'][key] = {
+                    'size': size, 'last_used': time.time()}
+                self._evict(index)
+        finally:
+            self._remove(tmp_path)
+
+    def _remove(self, path):
+        if os.path.lexists(path):
+            cmd_runner.run(['rm', '-rf', path], as_root=True).wait()
+
+    def _remove_entry(self, key):
+        """Remove the rootfs with the given key, unless it's in use.
+
+        :return: Whether the rootfs was removed.
+        """
+        lock_file = self._lock_entry(key, exclusive=True)
+        if lock_file is None:
+            return False
+        try:
+            self._remove(self._entry_path(key))
+            os.unlink(self._lock_path(key))
+        finally:
+            lock_file.close()
+        return True
+
+    def _evict(self, index):
+        """Remove the least recently used roots, until the cache fits."""
+        entries = index['entries']
+        total = sum(entry['size'] for entry in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k]['last_used']):
+            if total <= self.max_size:
+                break
+            if not self._remove_entry(key):
+                logger.info("Keeping the cached rootfs %s, which is in use"
+                            % key)
+                continue
+            logger.info("Removing the cached rootfs %s" % key)
+            total -= entries.pop(key)['size']
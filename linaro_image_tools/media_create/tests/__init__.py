@@ -22,6 +22,8 @@ def test_suite():
     module_names = [
         'linaro_image_tools.media_create.tests.test_media_create',
         'linaro_image_tools.media_create.tests.test_android_boards',
+        'linaro_image_tools.media_create.tests.test_partition_table',
+        'linaro_image_tools.media_create.tests.test_rootfs_cache',
     ]
     loader = unittest.TestLoader()
     suite = loader.loadTestsFromNames(module_names)
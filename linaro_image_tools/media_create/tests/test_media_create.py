@@ -38,6 +38,12 @@ from StringIO import StringIO
 from testtools import TestCase
 
 from linaro_image_tools import cmd_runner
+from linaro_image_tools.hwpack.compression import create_tarfile
+from linaro_image_tools.hwpack.contents import (
+    Contents,
+    ContentsEntry,
+    REGULAR,
+)
 from linaro_image_tools.hwpack.handler import HardwarepackHandler
 from linaro_image_tools.hwpack.packages import PackageMaker
 import linaro_image_tools.media_create
@@ -79,6 +85,9 @@ from linaro_image_tools.media_create.chroot_utils import (
     run_local_atexit_funcs,
     temporarily_overwrite_file_on_dir,
 )
+from linaro_image_tools.media_create.partition_table import (
+    read_partition_table,
+)
 from linaro_image_tools.media_create.partitions import (
     MIN_IMAGE_SIZE,
     Media,
@@ -94,10 +103,15 @@ from linaro_image_tools.media_create.partitions import (
     get_boot_and_root_partitions_for_media,
     get_partition_size_in_bytes,
     get_uuid,
+    make_partition_image,
+    PartitionFormatError,
     partition_mounted,
+    reread_partition_table,
+    run_mkfs_commands,
     run_sfdisk_commands,
     setup_partitions,
     wait_partition_to_settle,
+    write_partition_image,
 )
 from linaro_image_tools.media_create.rootfs import (
     append_to_fstab,
@@ -113,7 +127,11 @@ from linaro_image_tools.media_create.tests.fixtures import (
     CreateTarballFixture,
     MockRunSfdiskCommandsFixture,
 )
+from linaro_image_tools.media_create import unpack_binary_tarball as ubt
 from linaro_image_tools.media_create.unpack_binary_tarball import (
+    detect_compression,
+    get_decompress_command,
+    unpack_android_binary_tarball,
     unpack_binary_tarball,
 )
 from linaro_image_tools.testing import TestCaseWithFixtures
@@ -124,7 +142,10 @@ from linaro_image_tools.tests.fixtures import (
 )
 from linaro_image_tools.utils import find_command, preferred_tools_dir
 
-from linaro_image_tools.hwpack.testing import ContextManagerFixture
+from linaro_image_tools.hwpack.testing import (
+    ContextManagerFixture,
+    make_deb,
+)
 
 chroot_args = " ".join(cmd_runner.CHROOT_ARGS)
 sudo_args = " ".join(cmd_runner.SUDO_ARGS)
@@ -310,6 +331,90 @@ class TestHardwarepackHandler(TestCaseWithFixtures):
             test_file = hp.get_file('bootloader_file')
             self.assertEquals(data, open(test_file, 'r').read())
 
+    def test_hwpack_is_read_once(self):
+        metadata = self.metadata + "U_BOOT=testfile\n"
+        tarball = self.add_to_tarball(
+            [('FORMAT', '2.0\n'), ('metadata', metadata),
+             ('testfile', 'data')])
+        hp = HardwarepackHandler([tarball])
+        with hp:
+            index = hp.hwpack_indexes[tarball]
+            self.assertEqual(
+                ['FORMAT', 'metadata', 'testfile'], sorted(index['members']))
+            self.assertEqual(metadata, index['metadata'])
+        # Nothing is read out of the hwpack again to look at its metadata.
+        for name in 'extractfile', 'getnames', 'getmembers':
+            self.useFixture(MockSomethingFixture(
+                tarfile.TarFile, name,
+                lambda *args: self.fail('hwpack read again')))
+        with hp:
+            self.assertEqual('2.0', hp.get_format())
+            self.assertEqual('testfile', hp.get_field('bootloader_file')[0])
+            self.assertEqual([], hp.list_packages())
+
+    def add_to_indexed_tarball(self, files):
+        tarball = self.tarball_fixture.get_tarball()
+        with create_tarfile(tarball, 'none', indexed=True) as tar_file:
+            for filename, data in files:
+                tar_file.create_file_from_string(filename, data)
+        return tarball
+
+    def test_indexed_hwpack(self):
+        metadata = self.metadata + "U_BOOT=testfile\n"
+        tarball = self.add_to_indexed_tarball(
+            [('FORMAT', '4.0\n'), ('metadata', metadata),
+             ('pkgs/foo_1.0_all.deb', 'deb'), ('testfile', 'data')])
+        # The index is read instead of the members of the hwpack, past the
+        # first one read when opening it.
+        read_members = []
+        real_next = tarfile.TarFile.next
+
+        def next(tf):
+            member = real_next(tf)
+            read_members.append(member.name)
+            return member
+        self.useFixture(MockSomethingFixture(tarfile.TarFile, 'next', next))
+        hp = HardwarepackHandler([tarball])
+        with hp:
+            self.assertEqual(['FORMAT'], read_members)
+            self.assertEqual(HardwarepackHandler.FORMAT_4, hp.get_format())
+            self.assertEqual([(hp.hwpack_tarfiles[0], 'pkgs/foo_1.0_all.deb')],
+                             hp.list_packages())
+            path = hp.get_file('bootloader_file')
+            self.assertEqual('data', open(path).read())
+
+    def test_get_field_is_cached(self):
+        metadata = self.metadata + "U_BOOT=testfile\n"
+        tarball = self.add_to_tarball([('metadata', metadata)])
+        hp = HardwarepackHandler([tarball])
+        with hp:
+            hp.get_field('bootloader_file')
+            config = hp.configs[tarball]
+            self.useFixture(MockSomethingFixture(
+                config, 'get_option', lambda *args: self.fail('not cached')))
+            data, hwpack_tarfile = hp.get_field('bootloader_file')
+            self.assertEqual('testfile', data)
+            self.assertEqual(hp.hwpack_tarfiles[0], hwpack_tarfile)
+
+    def test_config_per_hwpack(self):
+        tarball1 = self.add_to_tarball(
+            [('metadata', self.metadata + "U_BOOT=a_file\n")],
+            tarball=self.tarball_fixture.get_tarball())
+        tarball_fixture2 = CreateTarballFixture(
+            self.tar_dir_fixture.get_temp_dir(), reldir='tarfile2',
+            filename='secondtarball.tar.gz')
+        self.useFixture(tarball_fixture2)
+        tarball2 = self.add_to_tarball(
+            [('metadata', "SERIAL_TTY=ttyO2\n")],
+            tarball=tarball_fixture2.get_tarball())
+        hp = HardwarepackHandler([tarball1, tarball2])
+        with hp:
+            self.assertEqual(
+                ('a_file', hp.hwpack_tarfiles[0]),
+                hp.get_field('bootloader_file'))
+            self.assertEqual(
+                ('ttyO2', hp.hwpack_tarfiles[1]), hp.get_field('serial_tty'))
+
     def test_list_packages(self):
         metadata = ("format: 3.0\nname: ahwpack\nversion: 4\narchitecture: "
                     "armel\norigin: linaro\n")
@@ -401,6 +506,50 @@ class TestHardwarepackHandler(TestCaseWithFixtures):
             path = hp.get_file_from_package("some/path/config", "package2")
             self.assertTrue(path.endswith("some/path/config"))
 
+    def make_hwpack_with_contents(self):
+        tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        deb_path = make_deb(
+            os.path.join(tempdir, 'foo_1.0_all.deb'),
+            [('usr/lib/foo/real', 'foo'), ('usr/lib/foo/link@', 'real')])
+        contents = Contents()
+        contents.add_deb('foo', deb_path)
+        return self.add_to_tarball(
+            [('FORMAT', '3.0\n'), ('metadata', self.metadata),
+             ('pkgs/foo_1.0_all.deb', open(deb_path).read()),
+             ('pkgs/Contents', str(contents))])
+
+    def test_get_contents(self):
+        tarball = self.make_hwpack_with_contents()
+        hp = HardwarepackHandler([tarball])
+        with hp:
+            self.assertEqual(['usr/lib/foo/real'],
+                             hp.get_contents().glob('usr/lib/foo/*'))
+
+    def test_get_contents_without_contents(self):
+        tarball = self.add_to_tarball([('metadata', self.metadata)])
+        hp = HardwarepackHandler([tarball])
+        with hp:
+            self.assertIs(None, hp.get_contents())
+
+    def test_get_file_from_package_with_contents(self):
+        tarball = self.make_hwpack_with_contents()
+        hp = HardwarepackHandler([tarball])
+        with hp:
+            path = hp.get_file_from_package("usr/lib/foo/link", "foo")
+            self.assertEqual('foo', open(path).read())
+
+    def test_get_file_from_package_missing_from_contents(self):
+        tarball = self.make_hwpack_with_contents()
+        hp = HardwarepackHandler([tarball])
+        with hp:
+            # The package is not even extracted from the hwpack.
+            self.useFixture(MockSomethingFixture(
+                tarfile.TarFile, 'extract',
+                lambda *args: self.fail('package extracted')))
+            self.assertRaises(
+                AssertionError, hp.get_file_from_package, "usr/lib/missing",
+                "foo")
+
 
 class TestSetMetadata(TestCaseWithFixtures):
 
@@ -2425,6 +2574,126 @@ class TestUnpackBinaryTarball(TestCaseWithFixtures):
             self.tarball_fixture.get_tarball(), tmp_dir, as_root=False)
         self.assertEqual(rc, 0)
 
+    def test_unpack_binary_tarball_member_dir(self):
+        tmp_dir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        src_dir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        os.makedirs(os.path.join(src_dir, 'binary', 'boot',
+                                 'filesystem.dir', 'etc'))
+        open(os.path.join(src_dir, 'binary', 'boot', 'filesystem.dir', 'etc',
+                          'fstab'), 'w').close()
+        tarball = os.path.join(src_dir, 'binary.tar.gz')
+        with tarfile.open(tarball, 'w:gz') as tf:
+            tf.add(os.path.join(src_dir, 'binary'), arcname='binary')
+        rc = unpack_binary_tarball(
+            tarball, tmp_dir, as_root=False,
+            member_dir='binary/boot/filesystem.dir')
+        self.assertEqual(rc, 0)
+        self.assertEqual(['etc'], os.listdir(tmp_dir))
+        self.assertTrue(os.path.exists(os.path.join(tmp_dir, 'etc', 'fstab')))
+
+    def _create_file(self, name, contents):
+        tmp_dir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        path = os.path.join(tmp_dir, name)
+        with open(path, 'wb') as fd:
+            fd.write(contents)
+        return path
+
+    def test_unpack_binary_tarball_member_dir_command(self):
+        tarball = self._create_file('binary.tar', 'not compressed')
+        fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        unpack_binary_tarball(
+            tarball, 'root-disc', as_root=False, member_dir='binary')
+        self.assertEqual(
+            ['tar --numeric-owner -C root-disc --strip-components=1 '
+             '-xf %s binary' % tarball],
+            fixture.mock.commands_executed)
+
+    def test_unpack_binary_tarball_without_decompressor(self):
+        tarball = self._create_file('binary.tar.bz2', 'BZh91AY')
+        self.useFixture(MockSomethingFixture(
+            ubt, 'has_command', lambda cmd: False))
+        fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        unpack_binary_tarball(tarball, 'root-disc', as_root=False)
+        self.assertEqual(
+            ['tar --numeric-owner -C root-disc -jxf %s' % tarball],
+            fixture.mock.commands_executed)
+
+    def test_unpack_android_binary_tarball_uncompressed(self):
+        tmp_dir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        tarball = os.path.join(tmp_dir, 'system.tar.bz2')
+        content = os.path.join(tmp_dir, 'build.prop')
+        with open(content, 'w') as fd:
+            fd.write('ro.build=1\n')
+        tar = tarfile.open(tarball, 'w')
+        tar.add(content, 'system/build.prop')
+        tar.close()
+        unpack_dir = os.path.join(tmp_dir, 'unpacked')
+        os.mkdir(unpack_dir)
+        unpack_android_binary_tarball(tarball, unpack_dir, as_root=False)
+        self.assertEqual(
+            'ro.build=1\n',
+            open(os.path.join(unpack_dir, 'system', 'build.prop')).read())
+
+    def test_detect_compression(self):
+        self.assertEqual(
+            'gzip', detect_compression(self._create_file('a', '\x1f\x8bxx')))
+        self.assertEqual(
+            'bzip2', detect_compression(self._create_file('b', 'BZh91AY')))
+        self.assertEqual(
+            'xz', detect_compression(self._create_file('c', '\xfd7zXZ\x00x')))
+        self.assertEqual(
+            None, detect_compression(self._create_file('d', 'ustar')))
+
+    def test_get_decompress_command_prefers_parallel(self):
+        tarball = self._create_file('binary.tar.gz', '\x1f\x8bxx')
+        self.useFixture(MockSomethingFixture(
+            ubt, 'has_command', lambda cmd: cmd in ('pigz', 'gzip')))
+        self.assertEqual(
+            ['pigz', '-d', '-c', '-p', '4', tarball],
+            get_decompress_command(tarball, threads=4))
+
+    def test_get_decompress_command_fallback(self):
+        tarball = self._create_file('binary.tar.bz2', 'BZh91AY')
+        self.useFixture(MockSomethingFixture(
+            ubt, 'has_command', lambda cmd: cmd == 'bzip2'))
+        self.assertEqual(
+            ['bzip2', '-d', '-c', tarball],
+            get_decompress_command(tarball, threads=4))
+
+    def test_get_decompress_command_no_decompressor(self):
+        tarball = self._create_file('binary.tar.xz', '\xfd7zXZ\x00x')
+        self.useFixture(MockSomethingFixture(
+            ubt, 'has_command', lambda cmd: False))
+        self.assertEqual(None, get_decompress_command(tarball))
+
+    def test_unpack_binary_tarball_pipes_decompressor(self):
+        tarball = self._create_file('binary.tar.xz', '\xfd7zXZ\x00x')
+        self.useFixture(MockSomethingFixture(
+            ubt, 'has_command', lambda cmd: True))
+        fixture = self.useFixture(MockCmdRunnerPopenFixture(
+            assert_child_finished=False))
+        unpack_binary_tarball(
+            tarball, 'root-disc', as_root=False, member_dir='binary',
+            threads=2)
+        self.assertEqual(
+            ['xz -d -c -T 2 %s' % tarball,
+             'tar --numeric-owner -C root-disc --strip-components=1 '
+             '-xf - binary'],
+            fixture.mock.commands_executed)
+
+    def test_extract_tarball_reports_tar_error(self):
+        # tar fails straight away, and the decompressor dies of SIGPIPE.
+        tarball = self._create_file('binary.tar.gz', '\x1f\x8bxx')
+        self.useFixture(MockSomethingFixture(
+            ubt, 'get_decompress_command',
+            lambda tarball, threads: ['sh', '-c', 'yes 2>/dev/null']))
+        e = self.assertRaises(
+            cmd_runner.SubcommandNonZeroReturnValue, ubt._extract_tarball,
+            ['tar', '--no-such-option'], tarball, as_root=False,
+            stderr=subprocess.PIPE)
+        self.assertEqual('tar', e.command[0])
+        self.assertIn('no-such-option', e.stderr)
+
 
 class TestGetUuid(TestCaseWithFixtures):
 
@@ -2761,6 +3030,31 @@ class TestBoards(TestCaseWithFixtures):
         board_conf.kernel_flavors = [flavor1, flavor2]
         self.assertRaises(ValueError, board_conf._get_kflavor_files, tempdir)
 
+    def test_find_file_uses_hwpack_contents(self):
+        tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        os.makedirs(os.path.join(tempdir, 'boot'))
+        for name in 'vmlinuz-3.8', 'vmlinuz-3.8.bak':
+            open(os.path.join(tempdir, 'boot', name), 'w').close()
+        board_conf = BoardConfig()
+        board_conf.hwpack_contents = Contents()
+        board_conf.hwpack_contents.add_entry(ContentsEntry(
+            'boot/vmlinuz-3.8', 'linux', REGULAR, 0, 0644, 0))
+        # Only the file from the hwpack matches, so the filesystem is not
+        # searched.
+        self.useFixture(MockSomethingFixture(
+            glob, 'glob', lambda *args: self.fail('filesystem searched')))
+        self.assertEqual(
+            os.path.join(tempdir, 'boot', 'vmlinuz-3.8'),
+            board_conf._find_file(tempdir, 'boot/vmlinuz-*'))
+
+    def test_find_file_not_in_hwpack_contents(self):
+        initrd = self.createTempFileAsFixture('initrd.img-')
+        directory = os.path.dirname(initrd)
+        board_conf = BoardConfig()
+        board_conf.hwpack_contents = Contents()
+        self.assertEqual(initrd, board_conf._find_file(
+            directory, os.path.basename(initrd)[:-1] + '*'))
+
     def test_get_file_matching_no_files_found(self):
         self.assertEqual(
             None, _get_file_matching('/foo/bar/baz/*non-existent'))
@@ -2808,7 +3102,9 @@ class TestCreatePartitions(TestCaseWithFixtures):
 
         self.assertEqual(
             ['%s parted -s %s mklabel msdos' % (sudo_args, self.media.path),
+             'udevadm settle --timeout=55',
              '%s sfdisk -l %s' % (sudo_args, self.media.path),
+             'udevadm settle --timeout=55',
              '%s sfdisk -l %s' % (sudo_args, self.media.path)],
             popen_fixture.mock.commands_executed)
         # Notice that we create all partitions in a single sfdisk run because
@@ -2829,7 +3125,9 @@ class TestCreatePartitions(TestCaseWithFixtures):
 
         self.assertEqual(
             ['%s parted -s %s mklabel msdos' % (sudo_args, self.media.path),
+             'udevadm settle --timeout=55',
              '%s sfdisk -l %s' % (sudo_args, self.media.path),
+             'udevadm settle --timeout=55',
              '%s sfdisk -l %s' % (sudo_args, self.media.path)],
             popen_fixture.mock.commands_executed)
         # Notice that we create all partitions in a single sfdisk run because
@@ -2850,7 +3148,9 @@ class TestCreatePartitions(TestCaseWithFixtures):
 
         self.assertEqual(
             ['%s parted -s %s mklabel msdos' % (sudo_args, self.media.path),
+             'udevadm settle --timeout=55',
              '%s sfdisk -l %s' % (sudo_args, self.media.path),
+             'udevadm settle --timeout=55',
              '%s sfdisk -l %s' % (sudo_args, self.media.path)],
             popen_fixture.mock.commands_executed)
         # Notice that we create all partitions in a single sfdisk run because
@@ -2872,7 +3172,9 @@ class TestCreatePartitions(TestCaseWithFixtures):
 
         self.assertEqual(
             ['%s parted -s %s mklabel msdos' % (sudo_args, self.media.path),
+             'udevadm settle --timeout=55',
              '%s sfdisk -l %s' % (sudo_args, self.media.path),
+             'udevadm settle --timeout=55',
              '%s sfdisk -l %s' % (sudo_args, self.media.path)],
             popen_fixture.mock.commands_executed)
         # Notice that we create all partitions in a single sfdisk run because
@@ -2894,7 +3196,9 @@ class TestCreatePartitions(TestCaseWithFixtures):
 
         self.assertEqual(
             ['%s parted -s %s mklabel msdos' % (sudo_args, self.media.path),
+             'udevadm settle --timeout=55',
              '%s sfdisk -l %s' % (sudo_args, self.media.path),
+             'udevadm settle --timeout=55',
              '%s sfdisk -l %s' % (sudo_args, self.media.path)],
             popen_fixture.mock.commands_executed)
         # Notice that we create all partitions in a single sfdisk run because
@@ -2914,7 +3218,9 @@ class TestCreatePartitions(TestCaseWithFixtures):
 
         self.assertEqual(
             ['%s parted -s %s mklabel msdos' % (sudo_args, self.media.path),
+             'udevadm settle --timeout=55',
              '%s sfdisk -l %s' % (sudo_args, self.media.path),
+             'udevadm settle --timeout=55',
              '%s sfdisk -l %s' % (sudo_args, self.media.path)],
             popen_fixture.mock.commands_executed)
         self.assertEqual(
@@ -2926,21 +3232,20 @@ class TestCreatePartitions(TestCaseWithFixtures):
         sfdisk_fixture = self.useFixture(MockRunSfdiskCommandsFixture())
 
         tmpfile = self.createTempFileAsFixture()
+        with open(tmpfile, 'w') as fd:
+            fd.truncate(128 * 1024 ** 2)
         board_conf = get_board_config('beagle')
         board_conf.hwpack_format = HardwarepackHandler.FORMAT_1
-        create_partitions(board_conf, Media(tmpfile))
+        partitions = create_partitions(board_conf, Media(tmpfile))
 
-        # Unlike the test for partitioning of a regular block device, in this
-        # case parted was not called as there's no existing partition table
-        # for us to overwrite on the image file.
+        # We can write to the image file, so the partition table is written
+        # without running parted or sfdisk, and there's nothing to wait for.
+        self.assertIsNone(popen_fixture.mock.calls)
+        self.assertIsNone(sfdisk_fixture.mock.calls)
         self.assertEqual(
-            ['%s sfdisk -l %s' % (sudo_args, tmpfile),
-             '%s sfdisk -l %s' % (sudo_args, tmpfile)],
-            popen_fixture.mock.commands_executed)
-
-        self.assertEqual(
-            [('63,106432,0x0C,*\n106496,,,-', tmpfile)],
-            sfdisk_fixture.mock.calls)
+            [(63, 106432, 0x0C, True), (106496, 155648, 0x83, False)],
+            [(p.start, p.length, p.type_id, p.bootable) for p in partitions])
+        self.assertEqual(partitions, read_partition_table(tmpfile))
 
     def test_run_sfdisk_commands(self):
         tmpfile = self.createTempFileAsFixture()
@@ -3009,6 +3314,80 @@ class TestCreatePartitions(TestCaseWithFixtures):
         self.assertRaises(cmd_runner.SubcommandNonZeroReturnValue,
                           wait_partition_to_settle, media, 'mbr')
 
+    def test_wait_partition_to_settle_image_file(self):
+        popen_fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        media = Media(self.createTempFileAsFixture())
+
+        self.assertEqual(0, wait_partition_to_settle(media, 'mbr'))
+        self.assertIsNone(popen_fixture.mock.calls)
+
+    def test_wait_partition_to_settle_waits_for_partition_nodes(self):
+        checks = [False, False, True]
+        self.useFixture(MockSomethingFixture(
+            partitions, '_partition_nodes_exist',
+            lambda device: checks.pop(0)))
+        # setUp() stubs time.sleep() and tearDown() restores it.
+        sleeps = []
+        time.sleep = sleeps.append
+        self.useFixture(MockSomethingFixture(os, 'getuid', lambda: 1000))
+        popen_fixture = self.useFixture(MockCmdRunnerPopenFixture())
+
+        self.assertEqual(0, wait_partition_to_settle(self.media, 'mbr'))
+        # The partition table is only probed once the partitions are there.
+        self.assertEqual(
+            ['udevadm settle --timeout=55',
+             '%s sfdisk -l %s' % (sudo_args, self.media.path)],
+            popen_fixture.mock.commands_executed)
+        self.assertEqual([], checks)
+        self.assertEqual([partitions.SETTLE_POLL_INTERVAL] * 2, sleeps)
+
+    def test_wait_partition_to_settle_backs_off_reading_partition_table(self):
+        self.useFixture(MockSomethingFixture(
+            partitions, '_partition_nodes_exist', lambda device: True))
+        # setUp() stubs time.sleep() and tearDown() restores it.
+        sleeps = []
+        time.sleep = sleeps.append
+        runs = []
+
+        def mock_run(args, as_root=False, stdout=None):
+            runs.append(args)
+            raise cmd_runner.SubcommandNonZeroReturnValue(args, 1)
+
+        self.useFixture(MockSomethingFixture(cmd_runner, 'run', mock_run))
+
+        self.assertRaises(cmd_runner.SubcommandNonZeroReturnValue,
+                          wait_partition_to_settle, self.media, 'mbr')
+        self.assertEqual(partitions.SETTLE_POLL_INTERVAL * 2, sleeps[1])
+        self.assertEqual(partitions.SETTLE_MAX_RETRY_INTERVAL, sleeps[-1])
+        self.assertTrue(sum(sleeps[:-1]) < partitions.SETTLE_TIMEOUT)
+        self.assertTrue(sum(sleeps) >= partitions.SETTLE_TIMEOUT)
+        # The udevadm call, then one sfdisk call per retry and a last one.
+        self.assertEqual(len(sleeps) + 2, len(runs))
+
+    def test_reread_partition_table(self):
+        ioctls = []
+        self.useFixture(MockSomethingFixture(
+            partitions.fcntl, 'ioctl',
+            lambda fd, request: ioctls.append(request)))
+        popen_fixture = self.useFixture(MockCmdRunnerPopenFixture())
+
+        reread_partition_table(self.createTempFileAsFixture())
+        self.assertEqual([partitions.BLKRRPART], ioctls)
+        self.assertIsNone(popen_fixture.mock.calls)
+
+    def test_reread_partition_table_falls_back_to_partprobe(self):
+        def busy(fd, request):
+            raise IOError(16, 'Device or resource busy')
+        self.useFixture(MockSomethingFixture(partitions.fcntl, 'ioctl', busy))
+        self.useFixture(MockSomethingFixture(os, 'getuid', lambda: 1000))
+        popen_fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        device = self.createTempFileAsFixture()
+
+        reread_partition_table(device)
+        self.assertEqual(
+            ['%s partprobe %s' % (sudo_args, device)],
+            popen_fixture.mock.commands_executed)
+
 
 class TestPartitionSetup(TestCaseWithFixtures):
 
@@ -3269,7 +3648,10 @@ class TestPartitionSetup(TestCaseWithFixtures):
         # (via dd) inside setup_partitions.  That's why we pass an
         # already setup image file.
         tmpfile = self._create_tmpfile()
-        popen_fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        # The filesystems are created concurrently, so the mkfs children are
+        # not waited for one at a time.
+        popen_fixture = self.useFixture(MockCmdRunnerPopenFixture(
+            assert_child_finished=False))
         self.useFixture(MockSomethingFixture(
             sys, 'stdout', open('/dev/null', 'w')))
 
@@ -3284,7 +3666,12 @@ class TestPartitionSetup(TestCaseWithFixtures):
             'ensure_partition_is_not_mounted', ensure_partition_not_mounted))
         self.useFixture(MockSomethingFixture(
             partitions, 'get_boot_and_root_loopback_devices',
-            lambda image: ('/dev/loop99', '/dev/loop98')))
+            lambda image, partition_table=None: (
+                '/dev/loop99', '/dev/loop98')))
+        # The dd call that would grow the image file is mocked, so grow it
+        # here to make room for the partitions.
+        with open(tmpfile, 'r+') as fd:
+            fd.truncate(2 * 1024 ** 3)
 
         board_conf = get_board_config('beagle')
         board_conf.hwpack_format = HardwarepackHandler.FORMAT_1
@@ -3293,13 +3680,9 @@ class TestPartitionSetup(TestCaseWithFixtures):
             board_conf, Media(tmpfile), '2G', 'boot',
             'root', 'ext3', True, True, True)
         self.assertEqual(
-            # This is the call that would create a 2 GiB image file.
+            # This is the call that would create a 2 GiB image file; the
+            # partition table is then written without running sfdisk.
             ['dd of=%s bs=1 seek=2147483648 count=0' % tmpfile,
-             '%s sfdisk -l %s' % (sudo_args, tmpfile),
-             # This call would partition the image file.
-             '%s sfdisk --force -uS %s' % (sudo_args, tmpfile),
-             # Make sure changes are written to disk.
-             '%s sfdisk -l %s' % (sudo_args, tmpfile),
              '%s mkfs.vfat -F 32 %s -n boot' % (sudo_args, bootfs_dev),
              '%s mkfs.ext3 -F %s -L root' % (sudo_args, rootfs_dev)],
             popen_fixture.mock.commands_executed)
@@ -3311,13 +3694,16 @@ class TestPartitionSetup(TestCaseWithFixtures):
         self.useFixture(MockSomethingFixture(
             partitions, 'is_partition_mounted', lambda part: True))
         tmpfile = self._create_tmpfile()
+        with open(tmpfile, 'r+') as fd:
+            fd.truncate(2 * 1024 ** 3)
         self.useFixture(MockSomethingFixture(
             partitions, '_get_device_file_for_partition_number',
             lambda dev, partition: '%s%d' % (tmpfile, partition)))
         media = Media(tmpfile)
         # Pretend our tmpfile is a block device.
         media.is_block_device = True
-        popen_fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        popen_fixture = self.useFixture(MockCmdRunnerPopenFixture(
+            assert_child_finished=False))
 
         board_conf = get_board_config('beagle')
         board_conf.hwpack_format = HardwarepackHandler.FORMAT_1
@@ -3326,9 +3712,9 @@ class TestPartitionSetup(TestCaseWithFixtures):
             board_conf, media, '2G', 'boot', 'root', 'ext3',
             True, True, True)
         self.assertEqual(
-            ['%s parted -s %s mklabel msdos' % (sudo_args, tmpfile),
-             '%s sfdisk -l %s' % (sudo_args, tmpfile),
-             '%s sfdisk --force -uS %s' % (sudo_args, tmpfile),
+            # The partition table is written without running parted or
+            # sfdisk, but we still wait for the kernel to pick it up.
+            ['udevadm settle --timeout=55',
              '%s sfdisk -l %s' % (sudo_args, tmpfile),
              # Since the partitions are mounted, setup_partitions will umount
              # them before running mkfs.
@@ -3454,6 +3840,153 @@ class TestMountedPartitionContextManager(TestCaseWithFixtures):
         expected = ['sudo -E mount foo bar']
         self.assertEqual(expected, popen_fixture.mock.commands_executed)
 
+    def test_no_device(self):
+        popen_fixture = self.useFixture(MockCmdRunnerPopenFixture())
+
+        def test_func():
+            with partition_mounted(None, 'bar'):
+                pass
+        test_func()
+        self.assertIsNone(popen_fixture.mock.calls)
+
+
+class TestRunMkfsCommands(TestCaseWithFixtures):
+
+    def mock_mkfs(self):
+        """Mock cmd_runner.Popen with mkfs processes which fail on 'bad'.
+
+        :return: The list where the mocked processes are stored as they are
+            started.
+        """
+        started = []
+
+        class MockMkfsProcess(object):
+
+            def __init__(self, args, **kwargs):
+                self.args = args
+                self.terminated = False
+                started.append(self)
+
+            def wait(self):
+                if self.args[-1] == 'bad':
+                    raise cmd_runner.SubcommandNonZeroReturnValue(
+                        self.args, 1)
+                if self.terminated:
+                    raise cmd_runner.SubcommandNonZeroReturnValue(
+                        self.args, -15)
+                return 0
+
+            def poll(self):
+                return None
+
+            def terminate(self):
+                self.terminated = True
+
+        self.useFixture(MockSomethingFixture(
+            cmd_runner, 'Popen', MockMkfsProcess))
+        return started
+
+    def test_runs_all_commands(self):
+        popen_fixture = self.useFixture(MockCmdRunnerPopenFixture(
+            assert_child_finished=False))
+        self.useFixture(MockSomethingFixture(os, 'getuid', lambda: 1000))
+        run_mkfs_commands(
+            [('boot', ['mkfs.vfat', 'boot']), ('root', ['mkfs.ext4', 'root'])])
+        self.assertEqual(
+            ['%s mkfs.vfat boot' % sudo_args, '%s mkfs.ext4 root' % sudo_args],
+            popen_fixture.mock.commands_executed)
+
+    def test_failure_stops_pending_commands(self):
+        started = self.mock_mkfs()
+        error = self.assertRaises(
+            PartitionFormatError, run_mkfs_commands,
+            [('boot', ['mkfs', 'good']), ('root', ['mkfs', 'bad']),
+             ('data', ['mkfs', 'good'])], max_jobs=1)
+        self.assertEqual(['root'], [name for name, _ in error.failures])
+        self.assertEqual(
+            ['good', 'bad'], [proc.args[-1] for proc in started])
+
+    def test_failure_terminates_running_commands(self):
+        started = self.mock_mkfs()
+        error = self.assertRaises(
+            PartitionFormatError, run_mkfs_commands,
+            [('boot', ['mkfs', 'good']), ('root', ['mkfs', 'bad']),
+             ('data', ['mkfs', 'good'])], max_jobs=3)
+        self.assertIn('root', str(error))
+        self.assertEqual(
+            [False, False, True], [proc.terminated for proc in started])
+        # The mkfs terminated is reported as cancelled, not as a failure.
+        self.assertEqual(['root'], [name for name, _ in error.failures])
+        self.assertEqual(['data'], error.cancelled)
+        self.assertIn('cancelled: data', str(error))
+
+
+class TestPartitionImages(TestCaseWithFixtures):
+
+    def test_make_vfat_partition_image(self):
+        popen_fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        tempdir = self.useFixture(CreateTempDirFixture()).tempdir
+        for name in ('uImage', 'boot.scr'):
+            open(os.path.join(tempdir, name), 'w').close()
+        make_partition_image(
+            'boot.img', 64 * 1024 ** 2, 'vfat', 'boot', tempdir, fat_size=16)
+        expected = [
+            'mkfs.vfat -C -F 16 -n boot boot.img 65536',
+            'mcopy -s -m -i boot.img %s/boot.scr %s/uImage ::/' % (
+                tempdir, tempdir)]
+        self.assertEqual(expected, popen_fixture.mock.commands_executed)
+
+    def test_make_empty_vfat_partition_image(self):
+        popen_fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        tempdir = self.useFixture(CreateTempDirFixture()).tempdir
+        make_partition_image('boot.img', 1024 ** 2, 'vfat', 'boot', tempdir)
+        self.assertEqual(
+            ['mkfs.vfat -C -F 32 -n boot boot.img 1024'],
+            popen_fixture.mock.commands_executed)
+
+    def test_make_ext_partition_image(self):
+        popen_fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        self.useFixture(MockSomethingFixture(os, 'getuid', lambda: 1000))
+        make_partition_image(
+            'root.img', 1024 ** 3, 'ext4', 'rootfs', 'rootfs-dir',
+            uuid='2e82008e-1af3-4699-8521-3bf5bac1e67a')
+        # Nothing is run as root.
+        expected = [
+            'mkfs.ext4 -F -L rootfs -d rootfs-dir -U '
+            '2e82008e-1af3-4699-8521-3bf5bac1e67a root.img 1048576k']
+        self.assertEqual(expected, popen_fixture.mock.commands_executed)
+
+    def test_make_unsupported_partition_image(self):
+        self.assertRaises(
+            ValueError, make_partition_image, 'root.img', 1024 ** 3, 'btrfs',
+            'rootfs', 'rootfs-dir')
+
+    def test_write_partition_image(self):
+        tempdir = self.useFixture(CreateTempDirFixture()).tempdir
+        image_file = os.path.join(tempdir, 'sd.img')
+        partition_image = os.path.join(tempdir, 'boot.img')
+        with open(image_file, 'w') as fd:
+            fd.truncate(4 * 1024 ** 2)
+        content = 'boot' + '\0' * (1024 ** 2) + 'data'
+        with open(partition_image, 'w') as fd:
+            fd.write(content)
+        write_partition_image(
+            partition_image, image_file, 1024 ** 2, 2 * 1024 ** 2)
+        with open(image_file) as fd:
+            data = fd.read()
+        self.assertEqual(4 * 1024 ** 2, len(data))
+        self.assertEqual(content, data[1024 ** 2:1024 ** 2 + len(content)])
+        self.assertEqual('\0' * 1024 ** 2, data[:1024 ** 2])
+
+    def test_write_partition_image_too_big(self):
+        tempdir = self.useFixture(CreateTempDirFixture()).tempdir
+        partition_image = os.path.join(tempdir, 'boot.img')
+        with open(partition_image, 'w') as fd:
+            fd.write('too big')
+        self.assertRaises(
+            AssertionError, write_partition_image, partition_image,
+            os.path.join(tempdir, 'sd.img'), 0, 4)
+
 
 class TestPopulateBoot(TestCaseWithFixtures):
 
@@ -3673,6 +4206,31 @@ class TestPopulateRootFS(TestCaseWithFixtures):
             '%s umount %s' % (sudo_args, root_disk)]
         self.assertEqual(expected, popen_fixture.mock.commands_executed)
 
+    def test_populate_rootfs_without_partition(self):
+        def fake_append_to_fstab(disk, additions):
+            self.lines_added_to_fstab = additions
+
+        self.useFixture(MockSomethingFixture(
+            sys, 'stdout', open('/dev/null', 'w')))
+        self.useFixture(MockSomethingFixture(
+            rootfs, 'append_to_fstab', fake_append_to_fstab))
+        popen_fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        tempdir = self.useFixture(CreateTempDirFixture()).tempdir
+        root_disk = os.path.join(tempdir, 'rootdisk')
+
+        populate_rootfs(
+            tempdir, root_disk, partition=None, rootfs_type='ext4',
+            rootfs_id='UUID=uuid', should_create_swap=False, swap_size=None,
+            mmc_device_id=0, partition_offset=0, os_release_id='linux',
+            board_config=None)
+
+        # Nothing is mounted or moved; content_dir is tweaked in place.
+        self.assertIsNone(popen_fixture.mock.calls)
+        self.assertFalse(os.path.exists(root_disk))
+        self.assertEqual(
+            ['UUID=uuid / ext4  errors=remount-ro 0 1'],
+            self.lines_added_to_fstab)
+
     def test_create_flash_kernel_config(self):
         fixture = self.useFixture(MockCmdRunnerPopenFixture())
         tempdir = self.useFixture(CreateTempDirFixture()).tempdir
@@ -0,0 +1,163 @@
+# Copyright (C) 2010, 2011 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from binascii import crc32
+import struct
+
+from linaro_image_tools.media_create.partition_table import (
+    GPT_ESP_TYPE,
+    GPT_SIGNATURE,
+    SECTOR_SIZE,
+    SGDISK_TYPES,
+    Partition,
+    PartitionTableError,
+    parse_sfdisk_cmd,
+    parse_sgdisk_cmd,
+    read_partition_table,
+    write_partition_table,
+)
+from linaro_image_tools.testing import TestCaseWithFixtures
+
+# 256 MiB, in sectors.
+TOTAL_SECTORS = 524288
+SNOWBALL_ANDROID_SFDISK_CMD = (
+    '256,7936,0xDA\n8192,24639,0x0C,*\n32831,65536,L\n'
+    '98367,-,E\n98367,65536,L\n294975,131072,L\n426047,,,-')
+
+
+class TestParseSfdiskCmd(TestCaseWithFixtures):
+
+    def test_primary_partitions(self):
+        self.assertEqual(
+            [Partition(63, 106432, 0x0C, bootable=True),
+             Partition(106496, TOTAL_SECTORS - 106496, 0x83)],
+            parse_sfdisk_cmd('63,106432,0x0C,*\n106496,,,-', TOTAL_SECTORS))
+
+    def test_logical_partitions(self):
+        # Logical partitions which have no room for their EBR right before
+        # them are moved one sector forward, keeping their end.
+        self.assertEqual(
+            [Partition(256, 7936, 0xDA),
+             Partition(8192, 24639, 0x0C, bootable=True),
+             Partition(32831, 65536, 0x83),
+             Partition(98367, TOTAL_SECTORS - 98367, 0x05),
+             Partition(98368, 65535, 0x83, logical=True),
+             Partition(294975, 131072, 0x83, logical=True),
+             Partition(426048, TOTAL_SECTORS - 426048, 0x83, logical=True)],
+            parse_sfdisk_cmd(SNOWBALL_ANDROID_SFDISK_CMD, TOTAL_SECTORS))
+
+    def test_logical_without_extended(self):
+        self.assertRaises(
+            PartitionTableError, parse_sfdisk_cmd,
+            '1,10\n11,10\n21,10\n31,10\n41,10', TOTAL_SECTORS)
+
+    def test_overlapping_partitions(self):
+        self.assertRaises(
+            PartitionTableError, parse_sfdisk_cmd,
+            '63,106432,0x0C,*\n100000,,,-', TOTAL_SECTORS)
+
+    def test_partition_too_big(self):
+        self.assertRaises(
+            PartitionTableError, parse_sfdisk_cmd,
+            '63,%d,0x0C,*' % TOTAL_SECTORS, TOTAL_SECTORS)
+
+    def test_unknown_type(self):
+        self.assertRaises(
+            PartitionTableError, parse_sfdisk_cmd, '63,100,Q', TOTAL_SECTORS)
+
+
+class TestParseSgdiskCmd(TestCaseWithFixtures):
+
+    def test_partitions(self):
+        # Starts are aligned like sgdisk does, and '-' is the last usable
+        # sector, before the backup GPT.
+        self.assertEqual(
+            [Partition(2048, 6144, SGDISK_TYPES['DA00']),
+             Partition(8192, 98305, GPT_ESP_TYPE, bootable=True),
+             Partition(114688, TOTAL_SECTORS - 114688 - 33,
+                       SGDISK_TYPES['8300'])],
+            parse_sgdisk_cmd(
+                '-n 1:1:8191 -t 1:DA00 -n 2:8192:106496 -t 2:EF00 '
+                '-n 3:114688:- -t 3:8300', TOTAL_SECTORS))
+
+    def test_unknown_type_code(self):
+        self.assertRaises(
+            PartitionTableError, parse_sgdisk_cmd, '-n 1:0:- -t 1:FFFF',
+            TOTAL_SECTORS)
+
+
+class TestWritePartitionTable(TestCaseWithFixtures):
+
+    def create_image(self, sectors=TOTAL_SECTORS, boot_code=''):
+        image = self.createTempFileAsFixture()
+        with open(image, 'w') as fd:
+            fd.write(boot_code)
+            fd.truncate(sectors * SECTOR_SIZE)
+        return image
+
+    def read_sector(self, image, sector):
+        with open(image) as fd:
+            fd.seek(sector * SECTOR_SIZE)
+            return fd.read(SECTOR_SIZE)
+
+    def test_mbr_round_trip(self):
+        image = self.create_image()
+        partitions = write_partition_table(
+            image, SNOWBALL_ANDROID_SFDISK_CMD)
+        # The extended partition isn't returned.
+        self.assertEqual(6, len(partitions))
+        self.assertEqual(partitions, read_partition_table(image))
+
+    def test_mbr_keeps_boot_code(self):
+        image = self.create_image(boot_code='boot code')
+        write_partition_table(image, '63,106432,0x0C,*\n106496,,,-')
+        sector = self.read_sector(image, 0)
+        self.assertEqual('boot code', sector[:9])
+        self.assertEqual('\x55\xaa', sector[510:])
+
+    def test_mbr_clears_gpt(self):
+        image = self.create_image()
+        write_partition_table(image, '-n 1:0:- -t 1:8300', 'gpt')
+        write_partition_table(image, '63,106432,0x0C,*\n106496,,,-')
+        self.assertFalse(self.read_sector(image, 1).startswith(GPT_SIGNATURE))
+        self.assertFalse(self.read_sector(
+            image, TOTAL_SECTORS - 1).startswith(GPT_SIGNATURE))
+        self.assertEqual(2, len(read_partition_table(image)))
+
+    def test_gpt_round_trip(self):
+        image = self.create_image()
+        partitions = write_partition_table(
+            image, '-n 1:8192:106496 -t 1:EF00 -n 2:114688:- -t 2:8300',
+            'gpt')
+        self.assertEqual(partitions, read_partition_table(image))
+
+    def test_gpt_headers(self):
+        image = self.create_image()
+        write_partition_table(image, '-n 1:0:- -t 1:8300', 'gpt')
+        for sector, backup in ((1, TOTAL_SECTORS - 1),
+                               (TOTAL_SECTORS - 1, 1)):
+            header = self.read_sector(image, sector)[:92]
+            fields = struct.unpack('<8sIIIIQQ', header[:40])
+            self.assertEqual(GPT_SIGNATURE, fields[0])
+            self.assertEqual((sector, backup), fields[5:7])
+            unsummed = header[:16] + '\x00' * 4 + header[20:]
+            self.assertEqual(
+                fields[3], crc32(unsummed) & 0xffffffff)
+
+    def test_read_without_partition_table(self):
+        image = self.create_image()
+        self.assertRaises(PartitionTableError, read_partition_table, image)
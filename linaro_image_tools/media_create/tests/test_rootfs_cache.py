@@ -0,0 +1,157 @@
+# Copyright (C) 2010, 2011 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+
+from linaro_image_tools import cmd_runner
+from linaro_image_tools.media_create.rootfs_cache import RootfsCache
+from linaro_image_tools.testing import TestCaseWithFixtures
+from linaro_image_tools.tests.fixtures import (
+    CreateTempDirFixture,
+    MockCmdRunnerPopenFixture,
+    MockSomethingFixture,
+)
+
+sudo_args = " ".join(cmd_runner.SUDO_ARGS)
+
+
+class TestRootfsCache(TestCaseWithFixtures):
+
+    def setUp(self):
+        super(TestRootfsCache, self).setUp()
+        self.cache_dir = self.useFixture(
+            CreateTempDirFixture()).get_temp_dir()
+        self.cache = RootfsCache(self.cache_dir, max_size=100)
+        self.binary = self.createTempFileAsFixture()
+        self.hwpack = self.createTempFileAsFixture()
+        for path in self.binary, self.hwpack:
+            with open(path, 'w') as fd:
+                fd.write(path)
+
+    def read_index(self):
+        with open(os.path.join(self.cache_dir, 'index.json')) as fd:
+            return json.load(fd)
+
+    def add_entry(self, key, size, last_used):
+        os.mkdir(os.path.join(self.cache_dir, key))
+        with self.cache._index() as index:
+            index['entries'][key] = {'size': size, 'last_used': last_used}
+
+    def test_get_key_is_stable(self):
+        self.assertEqual(
+            self.cache.get_key(self.binary, [self.hwpack]),
+            self.cache.get_key(self.binary, [self.hwpack]))
+
+    def test_get_key_depends_on_content(self):
+        key = self.cache.get_key(self.binary, [self.hwpack])
+        with open(self.hwpack, 'a') as fd:
+            fd.write('more')
+        self.assertNotEqual(
+            key, self.cache.get_key(self.binary, [self.hwpack]))
+
+    def test_get_key_depends_on_hwpack_order(self):
+        self.assertNotEqual(
+            self.cache.get_key(self.binary, [self.hwpack, self.binary]),
+            self.cache.get_key(self.binary, [self.binary, self.hwpack]))
+
+    def test_get_key_remembers_digests(self):
+        os.utime(self.binary, (1000, 1000))
+        key = self.cache.get_key(self.binary, [])
+        digests = self.read_index()['digests']
+        self.assertEqual([os.path.abspath(self.binary)], digests.keys())
+        # The file isn't read again while its size and mtime are the same.
+        with open(self.binary, 'r+') as fd:
+            fd.write('X')
+        os.utime(self.binary, (1000, 1000))
+        self.assertEqual(key, self.cache.get_key(self.binary, []))
+
+    def test_lookup_missing(self):
+        self.assertEqual(None, self.cache.lookup('foo'))
+
+    def test_lookup(self):
+        self.add_entry('foo', 10, 0)
+        self.assertEqual(
+            os.path.join(self.cache_dir, 'foo'), self.cache.lookup('foo'))
+        self.assertNotEqual(
+            0, self.read_index()['entries']['foo']['last_used'])
+
+    def test_get_key_depends_on_options_and_files(self):
+        key = self.cache.get_key(self.binary, [self.hwpack])
+        self.assertNotEqual(
+            key, self.cache.get_key(self.binary, [self.hwpack], ['foo']))
+        self.assertNotEqual(
+            key, self.cache.get_key(
+                self.binary, [self.hwpack], files=[self.binary]))
+
+    def test_lookup_locks_rootfs_until_released(self):
+        self.add_entry('foo', 10, 0)
+        self.cache.lookup('foo')
+        self.assertIs(None, self.cache._lock_entry('foo', exclusive=True))
+        self.cache.release('foo')
+        lock_file = self.cache._lock_entry('foo', exclusive=True)
+        self.assertIsNot(None, lock_file)
+        lock_file.close()
+
+    def test_store(self):
+        fixture = self.useFixture(MockCmdRunnerPopenFixture('42\tpath\n'))
+        self.useFixture(MockSomethingFixture(os, 'getuid', lambda: 1000))
+        self.cache.store('foo', '/rootfs')
+        entry = os.path.join(self.cache_dir, 'foo')
+        tmp = '%s.tmp-%d' % (entry, os.getpid())
+        self.assertEqual(
+            ['%s mkdir %s' % (sudo_args, tmp),
+             '%s cp -a --reflink=auto /rootfs/. %s' % (sudo_args, tmp),
+             '%s du -s --block-size=1 %s' % (sudo_args, tmp),
+             '%s mv %s %s' % (sudo_args, tmp, entry)],
+            fixture.mock.commands_executed)
+        self.assertEqual(42, self.read_index()['entries']['foo']['size'])
+
+    def test_evict_least_recently_used(self):
+        self.add_entry('old', 50, 1)
+        self.add_entry('new', 50, 3)
+        self.add_entry('older', 50, 0)
+        fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        self.useFixture(MockSomethingFixture(os, 'getuid', lambda: 1000))
+        with self.cache._index() as index:
+            self.cache._evict(index)
+        self.assertEqual(
+            ['%s rm -rf %s' % (sudo_args, os.path.join(self.cache_dir, key))
+             for key in ('older',)],
+            fixture.mock.commands_executed)
+        self.assertEqual(
+            ['new', 'old'], sorted(self.read_index()['entries'].keys()))
+
+    def test_evict_keeps_rootfs_in_use(self):
+        self.add_entry('old', 50, 1)
+        self.add_entry('new', 50, 3)
+        self.add_entry('older', 50, 0)
+        self.cache.lookup('older')
+        self.addCleanup(self.cache.release, 'older')
+        # It's still the least recently used one.
+        with self.cache._index() as index:
+            index['entries']['older']['last_used'] = 0
+        fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        self.useFixture(MockSomethingFixture(os, 'getuid', lambda: 1000))
+        with self.cache._index() as index:
+            self.cache._evict(index)
+        self.assertEqual(
+            ['%s rm -rf %s' % (sudo_args, os.path.join(self.cache_dir, key))
+             for key in ('old',)],
+            fixture.mock.commands_executed)
+        self.assertEqual(
+            ['new', 'older'], sorted(self.read_index()['entries'].keys()))
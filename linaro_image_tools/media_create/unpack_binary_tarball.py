@@ -16,21 +16,143 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with Linaro Image Tools.  If not, see <http://www.gnu.org/licenses/>.
+import multiprocessing
 import re
 import subprocess
+import sys
 from linaro_image_tools import cmd_runner
+from linaro_image_tools.utils import has_command
 
+# The magic bytes at the start of a file for each compression format we know
+# how to decompress.
+COMPRESSION_MAGIC = [
+    ('gzip', '\x1f\x8b'),
+    ('bzip2', 'BZh'),
+    ('xz', '\xfd7zXZ\x00'),
+    ('zstd', '\x28\xb5\x2f\xfd'),
+    ('lz4', '\x04\x22\x4d\x18'),
+]
 
-def unpack_android_binary_tarball(tarball, unpack_dir, as_root=True):
+# The commands that can decompress each format to stdout, in order of
+# preference; the first one found on the system is used.
+DECOMPRESSORS = {
+    'gzip': [
+        ['pigz', '-d', '-c', '-p', '%(threads)d'],
+        ['gzip', '-d', '-c'],
+    ],
+    'bzip2': [
+        ['lbzip2', '-d', '-c', '-n', '%(threads)d'],
+        ['pbzip2', '-d', '-c', '-p%(threads)d'],
+        ['bzip2', '-d', '-c'],
+    ],
+    'xz': [
+        ['xz', '-d', '-c', '-T', '%(threads)d'],
+    ],
+    'zstd': [
+        ['zstd', '-d', '-c', '-T%(threads)d'],
+    ],
+    'lz4': [
+        ['lz4', '-d', '-c'],
+    ],
+}
+
+# The options to extract the formats tar is told about when it decompresses
+# a tarball itself; it detects the others on its own with -xf.
+TAR_EXTRACT_OPTIONS = {
+    'bzip2': '-jxf',
+    'xz': '-Jxf',
+}
+
+
+def detect_compression(path):
+    """Return the compression format of the given file.
+
+    The format is detected from the magic bytes at the start of the file;
+    None is returned for files which are not compressed (or use a format we
+    don't know about).
+    """
+    with open(path, 'rb') as fd:
+        header = fd.read(8)
+    for compression, magic in COMPRESSION_MAGIC:
+        if header.startswith(magic):
+            return compression
+    return None
+
+
+def get_decompress_command(tarball, threads=0):
+    """Return the command to decompress the given tarball to stdout.
+
+    :param threads: The number of threads the decompressor should use, or 0
+        to use one per CPU.
+    :return: The command as a list, or None if the tarball is not compressed
+        or there's no decompressor for it on the system, in which case it
+        should be handed to tar as it is.
+    """
+    compression = detect_compression(tarball)
+    if compression is None:
+        return None
+    if threads <= 0:
+        threads = multiprocessing.cpu_count()
+    for cmd in DECOMPRESSORS[compression]:
+        if has_command(cmd[0]):
+            return [arg % {'threads': threads} for arg in cmd] + [tarball]
+    return None
+
+
+def _extract_tarball(tar_cmd, tarball, as_root=True, threads=0,
+                     members=None, stderr=None):
+    """Extract the given tarball with tar_cmd.
+
+    If the tarball is compressed its decompression is piped into tar;
+    otherwise (or when there's no decompressor available) tar is run on the
+    tarball itself, with the option to extract its format.
+
+    :param tar_cmd: The tar command, without the option to extract and the
+        archive.
+    :param members: The members of the tarball to extract, or None to
+        extract everything.
+    :return: A 2-tuple containing tar's stdout and stderr.
+    """
+    if members is None:
+        members = []
+    decompress_cmd = get_decompress_command(tarball, threads)
+    if decompress_cmd is None:
+        extract_opt = TAR_EXTRACT_OPTIONS.get(
+            detect_compression(tarball), '-xf')
+        proc = cmd_runner.run(
+            tar_cmd + [extract_opt, tarball] + members, as_root=as_root,
+            stderr=stderr)
+        return proc.communicate()
+    decompressor = cmd_runner.run(decompress_cmd, stdout=subprocess.PIPE)
+    proc = cmd_runner.run(
+        tar_cmd + ['-xf', '-'] + members, as_root=as_root,
+        stdin=decompressor.stdout, stderr=stderr)
+    # Make sure the decompressor gets a SIGPIPE if tar exits early.
+    decompressor.stdout.close()
+    try:
+        output = proc.communicate()
+    except:
+        # The decompressor most likely died of that SIGPIPE, so tar's error
+        # is the one to report.
+        tar_error = sys.exc_info()
+        try:
+            decompressor.wait()
+        except cmd_runner.SubcommandNonZeroReturnValue:
+            pass
+        raise tar_error[0], tar_error[1], tar_error[2]
+    decompressor.wait()
+    return output
+
+
+def unpack_android_binary_tarball(tarball, unpack_dir, as_root=True,
+                                  threads=0):
     if is_tar_support_selinux():
-        tar_cmd = ['tar', '--selinux', '--numeric-owner', '-C', unpack_dir,
-                   '-jxf', tarball]
+        tar_cmd = ['tar', '--selinux', '--numeric-owner', '-C', unpack_dir]
     else:
-        tar_cmd = ['tar', '--numeric-owner', '-C', unpack_dir,
-                   '-jxf', tarball]
-    proc = cmd_runner.run(tar_cmd, as_root=as_root,
-                          stderr=subprocess.PIPE)
-    stderr = proc.communicate()[1]
+        tar_cmd = ['tar', '--numeric-owner', '-C', unpack_dir]
+    stderr = _extract_tarball(
+        tar_cmd, tarball, as_root=as_root, threads=threads,
+        stderr=subprocess.PIPE)[1]
     selinux_warn_outputted = False
     selinux_warn1 = "tar: Ignoring unknown extended header keyword"
     selinux_warn2 = "tar: setfileconat: Cannot set SELinux context"
@@ -52,18 +174,28 @@ def unpack_android_binary_tarball(tarball, unpack_dir, as_root=True):
             # same line of selinux_warn1 or selinux_warn2
             continue
 
-    return proc.returncode
+    return 0
 
 
-def unpack_binary_tarball(tarball, unpack_dir, as_root=True):
-    extract_opt = '-xf'
-    if tarball.endswith('.xz'):
-        extract_opt = '-Jxf'
-    proc = cmd_runner.run(
-        ['tar', '--numeric-owner', '-C', unpack_dir, extract_opt, tarball],
-        as_root=as_root)
-    proc.wait()
-    return proc.returncode
+def unpack_binary_tarball(tarball, unpack_dir, as_root=True,
+                          member_dir=None, threads=0):
+    """Unpack the OS binary tarball into unpack_dir.
+
+    :param member_dir: If given, only the contents of this directory of the
+        tarball are unpacked, straight into unpack_dir.
+    :param threads: The number of threads to decompress the tarball with, or
+        0 to use one per CPU.
+    """
+    tar_cmd = ['tar', '--numeric-owner', '-C', unpack_dir]
+    members = None
+    if member_dir:
+        member_dir = member_dir.strip('/')
+        tar_cmd.append(
+            '--strip-components=%d' % len(member_dir.split('/')))
+        members = [member_dir]
+    _extract_tarball(tar_cmd, tarball, as_root=as_root, threads=threads,
+                     members=members)
+    return 0
 
 
 def is_tar_support_selinux():
@@ -0,0 +1,258 @@
+# Copyright (C) 2010, 2011 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Time the major stages of building an image or a hardware pack.
+
+Each stage is recorded with its wall time, the CPU time used by us and the
+commands we ran, the peak RSS and the number of bytes read from and written
+to storage. The stages run more than once (e.g. once per architecture) are
+added up.
+"""
+
+from contextlib import contextmanager
+import atexit
+import json
+import logging
+import resource
+import sys
+import threading
+import time
+
+from linaro_image_tools.utils import DEFAULT_LOGGER_NAME
+
+logger = logging.getLogger(DEFAULT_LOGGER_NAME)
+
+# The StageProfiler recording the stages we go through, if profiling has
+# been started with start_profiling().
+_profiler = None
+
+
+def _read_proc_status_kb(field):
+    try:
+        with open('/proc/self/status') as fd:
+            for line in fd:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    """Reset the peak RSS of this process, where the kernel allows it."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as fd:
+            fd.write('5')
+    except IOError:
+        pass
+
+
+def _read_io_counters():
+    """Return the bytes read and written by us and our finished children."""
+    counters = {}
+    try:
+        with open('/proc/self/io') as fd:
+            for line in fd:
+                name, value = line.split(':')
+                counters[name] = int(value)
+    except IOError:
+        return None, None
+    return counters.get('read_bytes'), counters.get('write_bytes')
+
+
+class StageProfiler(object):
+    """Record the resources used by each stage we go through."""
+
+    def __init__(self):
+        self.stages = []
+        self._by_name = {}
+        self._lock = threading.Lock()
+
+    def _sample(self):
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        read_bytes, write_bytes = _read_io_counters()
+        return {
+            'wall': time.time(),
+            'cpu': (own.ru_utime + own.ru_stime +
+                    children.ru_utime + children.ru_stime),
+            'children_maxrss': children.ru_maxrss,
+            'read_bytes': read_bytes,
+            'write_bytes': write_bytes,
+        }
+
+    @contextmanager
+    def stage(self, name, size=None):
+        """Record the resources used while running the body of the block.
+
+        The block is given the record of the stage, whose 'bytes' can be set
+        to the number of bytes processed if that was not known beforehand;
+        the throughput of the stage is then reported too.
+
+        :param name: The name of the stage.
+        :param size: The number of bytes processed by the stage, if known.
+        """
+        record = {'bytes': size}
+        _reset_peak_rss()
+        before = self._sample()
+        try:
+            yield record
+        finally:
+            after = self._sample()
+            peak_rss = _read_proc_status_kb('VmHWM')
+            if after['children_maxrss'] > before['children_maxrss']:
+                # One of the commands we ran in this stage used more memory
+                # than any we had run before.
+                peak_rss = max(peak_rss, after['children_maxrss'])
+            self._add(name, before, after, peak_rss, record['bytes'])
+
+    def _add(self, name, before, after, peak_rss, size):
+        with self._lock:
+            stage = self._by_name.get(name)
+            if stage is None:
+                stage = self._by_name[name] = {
+                    'name': name, 'runs': 0, 'wall_time': 0.0,
+                    'cpu_time': 0.0, 'peak_rss_kb': None, 'read_bytes': None,
+                    'write_bytes': None, 'bytes': None}
+                self.stages.append(stage)
+            stage['runs'] += 1
+            stage['wall_time'] += after['wall'] - before['wall']
+            stage['cpu_time'] += after['cpu'] - before['cpu']
+            if peak_rss is not None:
+                stage['peak_rss_kb'] = max(stage['peak_rss_kb'], peak_rss)
+            for key in ('read_bytes', 'write_bytes'):
+                if after[key] is not None:
+                    stage[key] = (
+                        (stage[key] or 0) + after[key] - before[key])
+            if size is not None:
+                stage['bytes'] = (stage['bytes'] or 0) + size
+
+    def take_stages(self):
+        """Return the stages recorded, and forget them."""
+        with self._lock:
+            stages, self.stages, self._by_name = self.stages, [], {}
+        return stages
+
+    def merge_stages(self, stages):
+        """Add up the stages recorded by another profiler with ours."""
+        with self._lock:
+            for other in stages:
+                stage = self._by_name.get(other['name'])
+                if stage is None:
+                    stage = self._by_name[other['name']] = dict(other)
+                    self.stages.append(stage)
+                    continue
+                for key in ('runs', 'wall_time', 'cpu_time'):
+                    stage[key] += other[key]
+                stage['peak_rss_kb'] = max(
+                    stage['peak_rss_kb'], other['peak_rss_kb'])
+                for key in ('read_bytes', 'write_bytes', 'bytes'):
+                    if other[key] is not None:
+                        stage[key] = (stage[key] or 0) + other[key]
+
+    def report(self):
+        """Return the stages recorded, with the throughput of each."""
+        with self._lock:
+            stages = [dict(stage) for stage in self.stages]
+        for stage in stages:
+            stage['throughput'] = None
+            if stage['bytes'] is not None and stage['wall_time'] > 0:
+                stage['throughput'] = stage['bytes'] / stage['wall_time']
+        return stages
+
+    def write(self, fd):
+        """Write the report as JSON, in a stable order so it can be diffed.
+        """
+        json.dump({'stages': self.report()}, fd, indent=2, sort_keys=True)
+        fd.write('\n')
+
+    def table(self):
+        """Return the report as a table to be read by humans."""
+
+        def megs(value, fmt='%10.1f'):
+            if value is None:
+                return '%10s' % '-'
+            return fmt % (value / float(1024 * 1024))
+
+        lines = ['%-28s %9s %9s %10s %10s %10s %10s' % (
+            'Stage', 'Wall (s)', 'CPU (s)', 'RSS (MB)', 'Read (MB)',
+            'Write (MB)', 'MB/s')]
+        for stage in self.report():
+            rss = stage['peak_rss_kb']
+            if rss is not None:
+                rss *= 1024
+            lines.append('%-28s %9.2f %9.2f %s %s %s %s' % (
+                stage['name'], stage['wall_time'], stage['cpu_time'],
+                megs(rss), megs(stage['read_bytes']),
+                megs(stage['write_bytes']), megs(stage['throughput'])))
+        return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def stage(name, size=None):
+    """Profile the body of the block as the given stage, if profiling.
+
+    See StageProfiler.stage().
+    """
+    if _profiler is None:
+        yield {'bytes': size}
+    else:
+        with _profiler.stage(name, size) as record:
+            yield record
+
+
+def take_stages():
+    """Return the stages recorded so far, and forget them.
+
+    For child processes to hand the stages they went through to their
+    parent, which adds them up with merge_stages().
+    """
+    if _profiler is None:
+        return []
+    return _profiler.take_stages()
+
+
+def merge_stages(stages):
+    """Add up the stages returned by take_stages() with ours, if profiling.
+    """
+    if _profiler is not None:
+        _profiler.merge_stages(stages)
+
+
+def start_profiling(path):
+    """Profile the stages we go through, writing a report at exit.
+
+    The report is written as JSON to the given path, and as a table to
+    stderr.
+    """
+    global _profiler
+    if _profiler is not None:
+        return
+    _profiler = StageProfiler()
+    atexit.register(stop_profiling, path)
+
+
+def stop_profiling(path):
+    """Write the report of the profiling started by start_profiling()."""
+    global _profiler
+    if _profiler is None:
+        return
+    profiler, _profiler = _profiler, None
+    with open(path, 'w') as fd:
+        profiler.write(fd)
+    sys.stderr.write(profiler.table())
+    logger.info("Wrote profile to %s" % path)
@@ -0,0 +1,260 @@
+# Copyright (C) 2010, 2011 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A privileged helper which runs commands on behalf of cmd_runner.
+
+The helper is started once, as root, by cmd_runner.start_root_helper() and
+then reads requests from its stdin and writes replies to its stdout. Each
+message is a marshalled dict prefixed by its length.
+
+A 'run' request has an 'id', the 'args', 'cwd' and 'env' of the command, the
+data to feed to its stdin (or None, for /dev/null) and how to wire its
+stdout and stderr ('capture', 'stream' or 'devnull', and 'stdout' for
+stderr). A 'write-file' request has an 'id', a 'path' and the 'data' to
+write there. A 'terminate' request has the 'id' of a running command to
+terminate. Every 'run' and 'write-file' request gets a reply with its 'id',
+a 'returncode' and the captured 'stdout' and 'stderr'. Before that, what a
+command writes to a streamed stdout or stderr is sent as it comes, in
+messages with its 'id', the 'output' it was written to ('stdout' or
+'stderr') and the 'data'.
+
+The mkdir, mv and cp commands are carried out by the helper itself when
+they are given no options it doesn't know about.
+"""
+
+import errno
+import marshal
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import threading
+
+HEADER = '!I'
+HEADER_SIZE = struct.calcsize(HEADER)
+
+
+def read_message(fd):
+    """Read a message from the given file, returning None at EOF."""
+    header = fd.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE:
+        return None
+    size, = struct.unpack(HEADER, header)
+    return marshal.loads(fd.read(size))
+
+
+def write_message(fd, message):
+    data = marshal.dumps(message)
+    fd.write(struct.pack(HEADER, len(data)) + data)
+    fd.flush()
+
+
+def _native_mkdir(args, cwd):
+    parents = False
+    paths = []
+    for arg in args:
+        if arg == '-p':
+            parents = True
+        elif arg.startswith('-'):
+            return None
+        else:
+            paths.append(os.path.join(cwd, arg))
+    for path in paths:
+        if parents:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        else:
+            os.mkdir(path)
+    return 0
+
+
+def _native_mv(args, cwd):
+    if args and args[0] == '-f':
+        args = args[1:]
+    if len(args) != 2 or args[0].startswith('-'):
+        return None
+    src, dest = [os.path.join(cwd, arg) for arg in args]
+    if os.path.isdir(dest):
+        dest = os.path.join(dest, os.path.basename(src))
+    try:
+        os.rename(src, dest)
+    except OSError, e:
+        if e.errno == errno.EXDEV:
+            # Moving across filesystems is best left to mv.
+            return None
+        raise
+    return 0
+
+
+def _native_cp(args, cwd):
+    if len(args) != 2 or args[0].startswith('-'):
+        return None
+    shutil.copy(*[os.path.join(cwd, arg) for arg in args])
+    return 0
+
+
+# The commands the helper runs natively. Each of them is given the arguments
+# of the command and the directory to resolve relative paths against, and
+# returns its exit status, or None if it should be run with exec instead.
+NATIVE_COMMANDS = {
+    'mkdir': _native_mkdir,
+    'mv': _native_mv,
+    'cp': _native_cp,
+}
+
+
+class RootHelperServer(object):
+    """Serve the requests read from one file, writing replies to another."""
+
+    def __init__(self, requests, replies):
+        self.requests = requests
+        self.replies = replies
+        self.lock = threading.Lock()
+        self.running = {}
+
+    def reply(self, request_id, returncode, stdout='', stderr=''):
+        with self.lock:
+            self.running.pop(request_id, None)
+            write_message(self.replies, {
+                'id': request_id, 'returncode': returncode,
+                'stdout': stdout, 'stderr': stderr})
+
+    def output(self, request_id, name, fd):
+        """Send what's read from fd as the output of the request."""
+        while True:
+            data = os.read(fd, 65536)
+            if not data:
+                break
+            with self.lock:
+                write_message(self.replies, {
+                    'id': request_id, 'output': name, 'data': data})
+
+    def run_native(self, request):
+        args = request['args']
+        native = NATIVE_COMMANDS.get(args[0])
+        if native is None or request['stdin'] is not None:
+            return None
+        try:
+            return native(args[1:], request['cwd'] or os.getcwd())
+        except (IOError, OSError, shutil.Error), e:
+            return 1, '%s: %s\n' % (args[0], e)
+
+    def run(self, request):
+        request_id = request['id']
+        result = self.run_native(request)
+        if result is not None:
+            if isinstance(result, tuple):
+                returncode, stderr = result
+                self.reply(request_id, returncode, stderr=stderr)
+            else:
+                self.reply(request_id, result)
+            return
+
+        devnull = open(os.devnull, 'r+')
+        wiring = {'capture': subprocess.PIPE, 'devnull': devnull,
+                  'stdout': subprocess.STDOUT}
+        # The read end of the pipe of each streamed output, by name.
+        streams = {}
+        targets = {}
+        for name in ('stdout', 'stderr'):
+            if request[name] == 'stream':
+                streams[name], targets[name] = os.pipe()
+            else:
+                targets[name] = wiring[request[name]]
+        stdin = devnull
+        if request['stdin'] is not None:
+            stdin = subprocess.PIPE
+        try:
+            try:
+                proc = subprocess.Popen(
+                    request['args'], cwd=request['cwd'], env=request['env'],
+                    stdin=stdin, stdout=targets['stdout'],
+                    stderr=targets['stderr'], close_fds=True)
+            finally:
+                # Only the command writes to them.
+                for name in streams:
+                    os.close(targets[name])
+        except OSError, e:
+            devnull.close()
+            for fd in streams.values():
+                os.close(fd)
+            self.reply(request_id, 127, stderr='%s: %s\n' % (
+                request['args'][0], e))
+            return
+        with self.lock:
+            self.running[request_id] = proc
+        threads = []
+        for name, fd in streams.items():
+            thread = threading.Thread(
+                target=self.output, args=(request_id, name, fd))
+            thread.start()
+            threads.append(thread)
+        stdout, stderr = proc.communicate(request['stdin'])
+        for thread in threads:
+            thread.join()
+        for fd in streams.values():
+            os.close(fd)
+        devnull.close()
+        self.reply(request_id, proc.returncode, stdout or '', stderr or '')
+
+    def write_file(self, request):
+        try:
+            with open(request['path'], 'w') as fd:
+                fd.write(request['data'])
+        except IOError, e:
+            self.reply(request['id'], 1, stderr='%s\n' % e)
+        else:
+            self.reply(request['id'], 0)
+
+    def terminate(self, request):
+        with self.lock:
+            proc = self.running.get(request['id'])
+        if proc is not None and proc.poll() is None:
+            proc.terminate()
+
+    def serve(self):
+        handlers = {'run': self.run, 'write-file': self.write_file}
+        threads = []
+        while True:
+            request = read_message(self.requests)
+            if request is None:
+                break
+            if request['op'] == 'terminate':
+                self.terminate(request)
+                continue
+            thread = threading.Thread(
+                target=handlers[request['op']], args=(request,))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+
+def main():
+    # Keep the protocol on fds of its own so that nothing we run can write
+    # to it by accident.
+    requests = os.fdopen(os.dup(0), 'rb')
+    replies = os.fdopen(os.dup(1), 'wb')
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(2, 1)
+    RootHelperServer(requests, replies).serve()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
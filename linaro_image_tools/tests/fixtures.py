@@ -132,6 +132,10 @@ class MockCmdRunnerPopen(object):
     def stdin(self):
         return StringIO()
 
+    @property
+    def stdout(self):
+        return StringIO()
+
 
 class MockCmdRunnerPopenFixture(MockSomethingFixture):
     """A test fixture which mocks cmd_runner.do_run with the given mock.
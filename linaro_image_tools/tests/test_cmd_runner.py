@@ -17,11 +17,16 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from StringIO import StringIO
+import json
 import os
+import subprocess
+import sys
 
 from linaro_image_tools import cmd_runner
 from linaro_image_tools.testing import TestCaseWithFixtures
 from linaro_image_tools.tests.fixtures import (
+    CreateTempDirFixture,
     MockCmdRunnerPopenFixture,
     MockSomethingFixture,
 )
@@ -111,3 +116,195 @@ class TestCmdRunner(TestCaseWithFixtures):
         proc = cmd_runner.Popen('true')
         returncode = proc.wait()
         self.assertEqual(0, returncode)
+
+
+class TestRootHelper(TestCaseWithFixtures):
+    """Test the root helper, running it as ourselves."""
+
+    def setUp(self):
+        super(TestRootHelper, self).setUp()
+        env = os.environ.copy()
+        env['PYTHONPATH'] = os.path.dirname(
+            os.path.dirname(os.path.abspath(cmd_runner.__file__)))
+        helper = cmd_runner.RootHelper(
+            [sys.executable, '-c',
+             'from linaro_image_tools.root_helper import main; main()'],
+            env=env)
+        self.addCleanup(helper.close)
+        self.useFixture(MockSomethingFixture(
+            cmd_runner, '_root_helper', helper))
+        self.tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+
+    def test_run_uses_helper(self):
+        proc = cmd_runner.run(
+            ['echo', 'foo'], as_root=True, stdin=open(os.devnull),
+            stdout=subprocess.PIPE)
+        self.assertIsInstance(proc, cmd_runner.RootHelperPopen)
+        self.assertEqual(('foo\n', None), proc.communicate())
+        self.assertEqual(0, proc.returncode)
+
+    def test_stdin(self):
+        proc = cmd_runner.run(
+            ['cat'], as_root=True, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+        self.assertEqual(('foo', None), proc.communicate('foo'))
+
+    def test_non_zero_return_code(self):
+        proc = cmd_runner.run(
+            ['sh', '-c', 'echo oops >&2; exit 3'], as_root=True,
+            stdin=open(os.devnull), stdout=open(os.devnull, 'w'),
+            stderr=subprocess.PIPE)
+        self.assertIsInstance(proc, cmd_runner.RootHelperPopen)
+        error = self.assertRaises(
+            cmd_runner.SubcommandNonZeroReturnValue, proc.communicate)
+        self.assertEqual(3, error.retval)
+        self.assertEqual('oops\n', error.stderr)
+
+    def test_wait_raises_on_non_zero_return_code(self):
+        proc = cmd_runner.run(
+            ['false'], as_root=True, stdin=open(os.devnull),
+            stdout=subprocess.PIPE)
+        self.assertRaises(cmd_runner.SubcommandNonZeroReturnValue, proc.wait)
+
+    def test_native_commands(self):
+        path = os.path.join(self.tempdir, 'a', 'b')
+        cmd_runner.run(['mkdir', '-p', path], as_root=True).wait()
+        self.assertTrue(os.path.isdir(path))
+        src = os.path.join(self.tempdir, 'src')
+        open(src, 'w').write('data')
+        cmd_runner.run(['cp', src, path], as_root=True).wait()
+        cmd_runner.run(
+            ['mv', '-f', src, os.path.join(path, 'moved')],
+            as_root=True).wait()
+        self.assertEqual(['moved', 'src'], sorted(os.listdir(path)))
+        self.assertFalse(os.path.exists(src))
+
+    def test_native_command_failure(self):
+        proc = cmd_runner.run(
+            ['mkdir', os.path.join(self.tempdir, 'a', 'b')], as_root=True,
+            stderr=subprocess.PIPE)
+        self.assertRaises(
+            cmd_runner.SubcommandNonZeroReturnValue, proc.communicate)
+
+    def test_write_file(self):
+        path = os.path.join(self.tempdir, 'file')
+        cmd_runner.write_file(path, 'data', as_root=True)
+        self.assertEqual('data', open(path).read())
+
+    def test_unsupported_stdio_uses_sudo(self):
+        fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        self.useFixture(MockSomethingFixture(os, 'getuid', lambda: 1000))
+        with open(os.path.join(self.tempdir, 'out'), 'w') as out:
+            cmd_runner.run(['foo'], as_root=True, stdout=out).wait()
+        self.assertEqual(['%s foo' % sudo_args],
+                         fixture.mock.commands_executed)
+
+    def test_interactive_uses_sudo(self):
+        fixture = self.useFixture(MockCmdRunnerPopenFixture())
+        self.useFixture(MockSomethingFixture(os, 'getuid', lambda: 1000))
+        cmd_runner.run(['foo'], as_root=True, interactive=True).wait()
+        self.assertEqual(['%s foo' % sudo_args],
+                         fixture.mock.commands_executed)
+
+    def test_inherited_stdio_uses_helper(self):
+        stdout = self.useFixture(
+            MockSomethingFixture(sys, 'stdout', StringIO())).mock
+        proc = cmd_runner.run(['mount', '--version'], as_root=True)
+        self.assertIsInstance(proc, cmd_runner.RootHelperPopen)
+        proc.wait()
+        self.assertIn('mount', stdout.getvalue())
+
+    def test_output_streamed(self):
+        stdout = self.useFixture(
+            MockSomethingFixture(sys, 'stdout', StringIO())).mock
+        stderr = self.useFixture(
+            MockSomethingFixture(sys, 'stderr', StringIO())).mock
+        # Their stdin is /dev/null, so cat doesn't wait for input.
+        cmd_runner.run(
+            ['sh', '-c', 'cat; echo out; echo err >&2'], as_root=True).wait()
+        self.assertEqual('out\n', stdout.getvalue())
+        self.assertEqual('err\n', stderr.getvalue())
+
+    def test_native_commands_with_inherited_stdio_use_helper(self):
+        proc = cmd_runner.run(
+            ['mkdir', os.path.join(self.tempdir, 'a')], as_root=True)
+        self.assertIsInstance(proc, cmd_runner.RootHelperPopen)
+        proc.wait()
+
+
+class TestCommandTracer(TestCaseWithFixtures):
+
+    def setUp(self):
+        super(TestCommandTracer, self).setUp()
+        self.tracer = cmd_runner.CommandTracer()
+        self.useFixture(MockSomethingFixture(
+            cmd_runner, '_tracer', self.tracer))
+
+    def test_records_commands(self):
+        proc = cmd_runner.run(['echo', 'foo'], stdout=subprocess.PIPE)
+        proc.communicate()
+        [record] = self.tracer.records
+        self.assertEqual(['echo', 'foo'], record['argv'])
+        self.assertEqual(0, record['returncode'])
+        self.assertEqual(4, record['stdout_bytes'])
+        self.assertTrue(record['end'] >= record['start'])
+
+    def test_records_failures(self):
+        proc = cmd_runner.run(['false'])
+        self.assertRaises(
+            cmd_runner.SubcommandNonZeroReturnValue, proc.wait)
+        self.assertEqual(1, self.tracer.records[0]['returncode'])
+
+    def test_records_as_root_and_chroot(self):
+        self.useFixture(MockSomethingFixture(os, 'getuid', lambda: 0))
+        self.useFixture(MockSomethingFixture(cmd_runner, 'Popen', Popen))
+        cmd_runner.run(['foo'], chroot='chroot_dir')
+        record = self.tracer.records[0]
+        self.assertEqual(
+            ['chroot', 'chroot_dir', 'foo'], record['argv'])
+        self.assertEqual((True, 'chroot_dir'),
+                         (record['as_root'], record['chroot']))
+        self.assertEqual('foo', self.tracer.command_name(record))
+
+    def test_command_name_without_sudo(self):
+        self.assertEqual('mkfs.vfat', self.tracer.command_name(
+            {'argv': cmd_runner.SUDO_ARGS + ['/sbin/mkfs.vfat', '-F', '32']}))
+
+    def test_summary(self):
+        for duration, returncode in ((1, 0), (3, 1)):
+            record = self.tracer.start(['parted', '-s'])
+            record['start'] = 0
+            self.tracer.finish(record, returncode)
+            record['end'] = duration
+        summary = self.tracer.summary().splitlines()
+        self.assertEqual(2, len(summary))
+        self.assertEqual(
+            ['parted', '2', '1', '4.00', '3.00'], summary[1].split())
+
+    def test_write_chrome(self):
+        record = self.tracer.start(['true'])
+        self.tracer.finish(record, 0)
+        # Unfinished commands are left out.
+        self.tracer.start(['sleep', '10'])
+        output = StringIO()
+        self.tracer.write(output, 'chrome')
+        [event] = json.loads(output.getvalue())['traceEvents']
+        self.assertEqual(('true', 'X'), (event['name'], event['ph']))
+        self.assertEqual(['true'], event['args']['argv'])
+
+    def test_write_jsonl(self):
+        for args in (['true'], ['false']):
+            self.tracer.finish(self.tracer.start(args), 0)
+        output = StringIO()
+        self.tracer.write(output, 'jsonl')
+        self.assertEqual(
+            [['true'], ['false']],
+            [json.loads(line)['argv']
+             for line in output.getvalue().splitlines()])
+
+
+class Popen(cmd_runner.Popen):
+    """A cmd_runner.Popen which doesn't run anything."""
+
+    def __init__(self, args, **kwargs):
+        self._trace = cmd_runner._tracer.start(args)
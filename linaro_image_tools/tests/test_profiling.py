@@ -0,0 +1,102 @@
+# Copyright (C) 2010, 2011 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from StringIO import StringIO
+import json
+
+from linaro_image_tools import cmd_runner, profiling
+from linaro_image_tools.testing import TestCaseWithFixtures
+from linaro_image_tools.tests.fixtures import MockSomethingFixture
+
+
+class TestStageProfiler(TestCaseWithFixtures):
+
+    def setUp(self):
+        super(TestStageProfiler, self).setUp()
+        self.profiler = profiling.StageProfiler()
+        self.useFixture(MockSomethingFixture(
+            profiling, '_profiler', self.profiler))
+
+    def test_stage_without_profiler(self):
+        self.useFixture(MockSomethingFixture(profiling, '_profiler', None))
+        with profiling.stage('foo', 10) as record:
+            self.assertEqual({'bytes': 10}, record)
+        self.assertEqual([], self.profiler.stages)
+
+    def test_stage(self):
+        with profiling.stage('foo'):
+            cmd_runner.run(['true']).wait()
+        [stage] = self.profiler.report()
+        self.assertEqual(('foo', 1), (stage['name'], stage['runs']))
+        self.assertTrue(stage['wall_time'] >= 0)
+        self.assertTrue(stage['cpu_time'] >= 0)
+        self.assertEqual(None, stage['throughput'])
+
+    def test_stage_on_failure(self):
+        def fail():
+            with profiling.stage('foo'):
+                raise ValueError()
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(['foo'], [s['name'] for s in self.profiler.stages])
+
+    def test_stages_are_added_up(self):
+        for size in (10, 20):
+            with profiling.stage('foo', size):
+                pass
+        with profiling.stage('bar') as record:
+            record['bytes'] = 5
+        foo, bar = self.profiler.report()
+        self.assertEqual((2, 30), (foo['runs'], foo['bytes']))
+        self.assertEqual(('bar', 5), (bar['name'], bar['bytes']))
+
+    def test_take_and_merge_stages(self):
+        with profiling.stage('foo', 10):
+            pass
+        stages = profiling.take_stages()
+        self.assertEqual([], self.profiler.report())
+        with profiling.stage('foo', 20):
+            pass
+        profiling.merge_stages(stages + [dict(stages[0], name='bar')])
+        foo, bar = self.profiler.report()
+        self.assertEqual((2, 30), (foo['runs'], foo['bytes']))
+        self.assertEqual(
+            ('bar', 1, 10), (bar['name'], bar['runs'], bar['bytes']))
+
+    def test_throughput(self):
+        with profiling.stage('foo', 100):
+            pass
+        self.profiler.stages[0]['wall_time'] = 4
+        self.assertEqual(25, self.profiler.report()[0]['throughput'])
+
+    def test_write(self):
+        with profiling.stage('foo'):
+            pass
+        output = StringIO()
+        self.profiler.write(output)
+        [stage] = json.loads(output.getvalue())['stages']
+        self.assertEqual(
+            ['bytes', 'cpu_time', 'name', 'peak_rss_kb', 'read_bytes',
+             'runs', 'throughput', 'wall_time', 'write_bytes'],
+            sorted(stage.keys()))
+
+    def test_table(self):
+        for name in ('foo', 'bar'):
+            with profiling.stage(name):
+                pass
+        lines = self.profiler.table().splitlines()
+        self.assertEqual(
+            ['Stage', 'foo', 'bar'], [line.split()[0] for line in lines])
@@ -350,6 +350,57 @@ class TestAdditionalOptionChecks(TestCaseWithFixtures):
                                board="testboard"))
         sys.argv.remove("--mmc")
 
+    def test_mount_free_checks(self):
+        class MountFreeArgs:
+            def __init__(self, rootfs):
+                self.directory = None
+                self.hwpacks = []
+                self.mount_free = True
+                self.rootfs = rootfs
+                self.unpack_to_partition = False
+
+        self.useFixture(MockCmdRunnerPopenFixture(
+            'mke2fs 1.43.4 (31-Jan-2017)\n'))
+        additional_option_checks(MountFreeArgs('ext4'))
+        self.assertRaises(IncompatibleOptions, additional_option_checks,
+                          MountFreeArgs('btrfs'))
+        sys.argv.append("--mmc")
+        try:
+            self.assertRaises(IncompatibleOptions, additional_option_checks,
+                              MountFreeArgs('ext4'))
+        finally:
+            sys.argv.remove("--mmc")
+
+    def test_mount_free_checks_mkfs_version(self):
+        class MountFreeArgs:
+            directory = None
+            hwpacks = []
+            mount_free = True
+            rootfs = 'ext4'
+            unpack_to_partition = False
+
+        fixture = self.useFixture(MockCmdRunnerPopenFixture(
+            'mke2fs 1.42.9 (4-Feb-2014)\n'))
+        self.assertRaises(IncompatibleOptions, additional_option_checks,
+                          MountFreeArgs())
+        self.assertEqual(['mkfs.ext4 -V'], fixture.mock.commands_executed)
+
+    def test_unpack_to_partition_checks(self):
+        class UnpackArgs:
+            def __init__(self, mount_free=False, should_format_rootfs=True):
+                self.directory = None
+                self.hwpacks = []
+                self.mount_free = mount_free
+                self.rootfs = 'ext4'
+                self.should_format_rootfs = should_format_rootfs
+                self.unpack_to_partition = True
+
+        additional_option_checks(UnpackArgs())
+        self.assertRaises(IncompatibleOptions, additional_option_checks,
+                          UnpackArgs(mount_free=True))
+        self.assertRaises(IncompatibleOptions, additional_option_checks,
+                          UnpackArgs(should_format_rootfs=False))
+
 
 class TestAndroidOptionChecks(TestCaseWithFixtures):
 
@@ -249,6 +249,23 @@ def has_command(command):
         return False
 
 
+def mkfs_can_populate(fs_type):
+    """Whether mkfs.<fs_type> can populate a filesystem from a directory.
+
+    That's mke2fs' -d option, which first appeared in e2fsprogs 1.43.
+    """
+    try:
+        output, _ = cmd_runner.run(
+            ['mkfs.%s' % fs_type, '-V'], stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT).communicate()
+    except (OSError, cmd_runner.SubcommandNonZeroReturnValue):
+        return False
+    match = re.search(r'mke2fs (\d+)\.(\d+)', output)
+    if match is None:
+        return False
+    return tuple(int(part) for part in match.groups()) >= (1, 43)
+
+
 def ensure_command(command):
     """Ensure the given command is available.
 
@@ -364,6 +381,26 @@ def additional_option_checks(args):
             raise InvalidHwpackFile(
                 "--hwpack argument (%s) is not a regular file" % hwpack)
 
+    if args.mount_free:
+        if "--mmc" in sys.argv:
+            raise IncompatibleOptions("--mount-free option incompatible with "
+                                      "option --mmc")
+        if args.rootfs not in ('ext2', 'ext3', 'ext4'):
+            raise IncompatibleOptions("--mount-free option can only be used "
+                                      "with ext2, ext3 or ext4 rootfs")
+        if not mkfs_can_populate(args.rootfs):
+            raise IncompatibleOptions(
+                "--mount-free option needs mkfs.%s from e2fsprogs 1.43 or "
+                "later, which supports its -d option" % args.rootfs)
+
+    if args.unpack_to_partition:
+        if args.mount_free:
+            raise IncompatibleOptions("--unpack-to-partition option "
+                                      "incompatible with option --mount-free")
+        if not args.should_format_rootfs:
+            raise IncompatibleOptions("--unpack-to-partition option "
+                                      "incompatible with option --no-rootfs")
+
 
 def additional_android_option_checks(args):
     """Checks that some of the args passed to l-a-m-c are valid."""